@@ -0,0 +1,102 @@
+import logging
+import zipfile
+from pathlib import Path, PurePosixPath
+
+import rarfile
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+CHUNK_SIZE = 1024 * 1024
+# Сколько всего можно распаковать из одного архива
+MAX_UNCOMPRESSED_SIZE = 500 * 1024 * 1024
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def open_archive(path: str, archive_type: str | None = None) -> zipfile.ZipFile | rarfile.RarFile:
+    """
+    Открывает ZIP/CBZ или RAR/CBR по содержимому, а не по расширению.
+    :param archive_type: "zip" или "rar", если формат уже определён при скачивании (файл не перечитывается)
+    """
+    if archive_type == "zip" or archive_type is None and zipfile.is_zipfile(path):
+        return zipfile.ZipFile(path)
+    if archive_type == "rar" or archive_type is None and rarfile.is_rarfile(path):
+        return rarfile.RarFile(path)
+    raise ArchiveError("Unsupported or corrupted archive")
+
+
+def _is_junk(name: str) -> bool:
+    parts = PurePosixPath(name.replace("\\", "/")).parts
+    return any(p == "__MACOSX" or p.startswith(".") for p in parts)
+
+
+def select_members(members: list, allow_fb2: bool = True) -> tuple[str | None, list]:
+    """
+    Выбирает нужные файлы по оглавлению архива, ничего не распаковывая:
+    первый .fb2 (если allow_fb2) или все изображения в порядке имён.
+    :return: ("fb2" | "images" | None, список элементов)
+    """
+    files = [m for m in members if not m.is_dir() and not _is_junk(m.filename)]
+    if allow_fb2:
+        fb2 = sorted((m for m in files if m.filename.lower().endswith(".fb2")), key=lambda m: m.filename)
+        if fb2:
+            return "fb2", fb2[:1]
+    images = sorted(
+        (m for m in files if PurePosixPath(m.filename).suffix.lower() in IMAGE_EXTENSIONS),
+        key=lambda m: m.filename,
+    )
+    if images:
+        return "images", images
+    return None, []
+
+
+def extract_members(archive, members: list, extract_dir: str,
+                    max_uncompressed_size: int = MAX_UNCOMPRESSED_SIZE, max_ratio: int = 200) -> list[str]:
+    """
+    Потоково распаковывает только указанные элементы, считая реально прочитанные байты.
+    Заявленным размерам в архиве не доверяем: прерываемся, как только превышен общий лимит
+    или коэффициент сжатия элемента.
+    """
+    extract_dir = Path(extract_dir).resolve()
+    total = 0
+    paths = []
+    for member in members:
+        target = Path(extract_dir, member.filename).resolve()
+        if not target.is_relative_to(extract_dir):
+            raise ArchiveError(f"Blocked path traversal in archive: {member.filename}")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # Маленькие файлы сжимаются сильнее, поэтому коэффициент проверяем после первого мегабайта
+        member_limit = max(member.compress_size * max_ratio, CHUNK_SIZE)
+        written = 0
+        with archive.open(member) as src, open(target, "wb") as dst:
+            while chunk := src.read(CHUNK_SIZE):
+                written += len(chunk)
+                total += len(chunk)
+                if total > max_uncompressed_size:
+                    raise ArchiveError("Aborted extraction: too much data (possible zip bomb)")
+                if written > member_limit:
+                    raise ArchiveError(f"Aborted extraction: suspicious compression ratio in {member.filename}")
+                dst.write(chunk)
+        paths.append(str(target))
+    return paths
+
+
+def extract_book(path: str, extract_dir: str, allow_fb2: bool = True,
+                 max_uncompressed_size: int = MAX_UNCOMPRESSED_SIZE,
+                 archive_type: str | None = None) -> tuple[str | None, list[str]]:
+    """
+    Распаковывает из архива только книгу: первый FB2 или изображения для манги/комикса.
+    :param archive_type: формат по сигнатуре, см. open_archive
+    :return: ("fb2" | "images" | None, пути к извлечённым файлам)
+    """
+    try:
+        with open_archive(path, archive_type) as archive:
+            members = archive.infolist()
+            kind, selected = select_members(members, allow_fb2)
+            logger.info(f"Archive {path}: {len(members)} members, extracting {len(selected)} ({kind})")
+            return kind, extract_members(archive, selected, extract_dir, max_uncompressed_size)
+    except (zipfile.BadZipFile, rarfile.Error) as e:
+        raise ArchiveError(f"Failed to read archive: {e}")
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+# Лимит длины сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+
+class Batcher:
+    """
+    Собирает элементы с одним ключом (например, документы одного пользователя), пришедшие подряд,
+    в одну пачку. Пачка отдаётся flush, когда window секунд не приходило новых элементов,
+    набралось max_items или с первого элемента прошло max_wait секунд.
+    """
+
+    def __init__(self, flush: Callable[[Hashable, list], Awaitable[None]],
+                 max_items: int = 30, max_wait: float = 10):
+        self.flush = flush
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self._pending: dict[Hashable, list] = {}
+        self._started: dict[Hashable, float] = {}
+        self._timers: dict[Hashable, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def add(self, key: Hashable, item, window: float):
+        items = self._pending.setdefault(key, [])
+        items.append(item)
+        started = self._started.setdefault(key, time.monotonic())
+        if timer := self._timers.pop(key, None):
+            timer.cancel()
+        delay = min(window, started + self.max_wait - time.monotonic())
+        if len(items) >= self.max_items or delay <= 0:
+            self._flush(key)
+        else:
+            self._timers[key] = asyncio.get_running_loop().call_later(delay, self._flush, key)
+
+    def _flush(self, key: Hashable):
+        self._timers.pop(key, None)
+        self._started.pop(key, None)
+        items = self._pending.pop(key, None)
+        if not items:
+            return
+        task = asyncio.create_task(self._run(key, items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key: Hashable, items: list):
+        try:
+            await self.flush(key, items)
+        except Exception:
+            logger.exception(f"Flushing batch of {len(items)} for {key} failed")
+
+    async def drain(self):
+        """Немедленно отдаёт все накопленные пачки и ждёт их обработки (при остановке)."""
+        for key in list(self._pending):
+            if timer := self._timers.get(key):
+                timer.cancel()
+            self._flush(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def pack(items: list, size_of: Callable[[object], int], limit: int, max_count: int = 25) -> list[list]:
+    """
+    Раскладывает элементы по минимальному числу групп весом не больше limit и не длиннее max_count
+    (first fit decreasing). Элемент тяжелее limit попадает в отдельную группу.
+    """
+    bins: list[tuple[int, list]] = []
+    for item in sorted(items, key=size_of, reverse=True):
+        size = size_of(item)
+        for i, (used, group) in enumerate(bins):
+            if used + size <= limit and len(group) < max_count:
+                group.append(item)
+                bins[i] = (used + size, group)
+                break
+        else:
+            bins.append((size, [item]))
+    return [group for _, group in bins]
+
+
+class BatchProgress:
+    """
+    Одно сообщение со строкой состояния на каждый файл пачки вместо отдельных ответов.
+    Правки не чаще раза в min_interval секунд (лимиты Bot API на редактирование), последняя — всегда.
+    """
+
+    def __init__(self, message, names: list[str], header: str, min_interval: float = 2.0):
+        self.message = message
+        self.names = names
+        self.header = header
+        self.statuses = ["🕒 queued"] * len(names)
+        self.min_interval = min_interval
+        self._last_edit = 0.0
+        self._lock = asyncio.Lock()
+
+    def render(self) -> str:
+        lines = [self.header, ""]
+        lines += [f"{status} — {name}" for name, status in zip(self.names, self.statuses)]
+        text = "\n".join(lines)
+        return text if len(text) <= MESSAGE_LIMIT else text[:MESSAGE_LIMIT - 1] + "…"
+
+    async def update(self, index: int, status: str):
+        self.statuses[index] = status
+        await self._edit(force=False)
+
+    async def finish(self, header: str):
+        self.header = header
+        await self._edit(force=True)
+
+    async def _edit(self, force: bool):
+        async with self._lock:
+            if not force and time.monotonic() - self._last_edit < self.min_interval:
+                return
+            self._last_edit = time.monotonic()
+            try:
+                await self.message.edit_text(self.render())
+            except Exception as e:
+                # Например, «message is not modified» или превышение лимита правок
+                logger.debug(f"Failed to edit progress message: {e}")
@@ -0,0 +1,655 @@
+"""
+Офлайн-бенчмарк handle_file: синтетические Update/Document, локальный SMTP-приёмник,
+HTTP-заглушка Google Books/Amazon и (по желанию) заглушки ebook-convert/ebook-meta/gs.
+
+    python benchmark.py corpus ./bench-corpus
+    python benchmark.py run --corpus ./bench-corpus --concurrency 8 --repeat 5 --output run.json
+    python benchmark.py compare base.json run.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import zipfile
+import zlib
+from pathlib import Path
+from types import SimpleNamespace
+from urllib.parse import quote, unquote
+
+BENCH_EMAIL = "bench@kindle.com"
+BENCH_USER_ID = 1000
+STUB_TOOLS = ("ebook-convert", "ebook-meta", "gs")
+# Сообщения бота, после которых задача считается завершённой
+FINAL_PREFIXES = {"✅": "ok", "❌": "failed", "⚠️": "failed", "⏳": "rejected"}
+
+
+# --- Синтетический корпус ---
+def _gray_pixels(width: int, height: int, seed: int, row_prefix: bytes = b"") -> bytes:
+    """Серое изображение с шумом, чтобы сжатие было похоже на настоящий скан."""
+    rows = []
+    state = seed or 1
+    for y in range(height):
+        row = bytearray(width)
+        for x in range(0, width, 8):
+            state = (state * 1103515245 + 12345) & 0x7FFFFFFF
+            row[x:x + 8] = bytes([(x + y + (state >> 16)) & 0xFF]) * min(8, width - x)
+        rows.append(row_prefix + bytes(row))
+    return b"".join(rows)
+
+
+def _png(width: int, height: int, seed: int) -> bytes:
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    pixels = _gray_pixels(width, height, seed, row_prefix=b"\x00")
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(pixels)) + chunk(b"IEND", b"")
+
+
+def _pdf(title: str, pages: int, scanned: bool = False) -> bytes:
+    """Текстовый PDF или, при scanned, PDF со страницей-картинкой на каждой странице."""
+    per_page = 3 if scanned else 2
+    objects: list[str | bytes] = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + i * per_page} 0 R" for i in range(pages))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>")
+    for i in range(pages):
+        number = 3 + i * per_page
+        if scanned:
+            content = "q 612 0 0 792 0 0 cm /Im0 Do Q"
+            resources = f"/XObject << /Im0 {number + 2} 0 R >>"
+        else:
+            content = f"BT /F1 24 Tf 72 720 Td ({title} page {i + 1}) Tj ET"
+            resources = "/Font << /F1 << /Type /Font /Subtype /Type1 /BaseFont /Helvetica >> >>"
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {number + 1} 0 R /Resources << {resources} >> >>"
+        )
+        objects.append(f"<< /Length {len(content)} >>\nstream\n{content}\nendstream")
+        if scanned:
+            pixels = _gray_pixels(1200, 1600, i + 1)
+            objects.append(
+                f"<< /Type /XObject /Subtype /Image /Width 1200 /Height 1600 /ColorSpace /DeviceGray "
+                f"/BitsPerComponent 8 /Length {len(pixels)} >>\nstream\n".encode() + pixels + b"\nendstream"
+            )
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        body = body if isinstance(body, bytes) else body.encode()
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def _fb2(title: str, author: str, paragraphs: int) -> bytes:
+    first, _, last = author.partition(" ")
+    body = "".join(f"<p>{title}, paragraph {i}. " + "Lorem ipsum dolor sit amet. " * 20 + "</p>" for i in range(paragraphs))
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0"><description><title-info>'
+        f"<author><first-name>{first}</first-name><last-name>{last}</last-name></author>"
+        f"<book-title>{title}</book-title><lang>en</lang></title-info></description>"
+        f"<body><section>{body}</section></body></FictionBook>"
+    ).encode()
+
+
+def write_epub(path: str, title: str, author: str, chapters: int = 3):
+    """Минимальный корректный EPUB 2 с одной главой на chapters."""
+    manifest = "".join(
+        f'<item id="c{i}" href="c{i}.xhtml" media-type="application/xhtml+xml"/>' for i in range(chapters)
+    )
+    spine = "".join(f'<itemref idref="c{i}"/>' for i in range(chapters))
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip")
+        zf.writestr(
+            "META-INF/container.xml",
+            '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>',
+            zipfile.ZIP_DEFLATED,
+        )
+        zf.writestr(
+            "content.opf",
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">'
+            f'<dc:title>{title}</dc:title><dc:creator opf:role="aut">{author}</dc:creator>'
+            f'<dc:identifier id="id">urn:uuid:{uuid.uuid4()}</dc:identifier><dc:language>en</dc:language></metadata>'
+            f'<manifest>{manifest}</manifest><spine>{spine}</spine></package>',
+            zipfile.ZIP_DEFLATED,
+        )
+        for i in range(chapters):
+            text = f"<p>{title}, chapter {i}.</p>" + "<p>Lorem ipsum dolor sit amet.</p>" * 200
+            zf.writestr(
+                f"c{i}.xhtml",
+                f'<html xmlns="http://www.w3.org/1999/xhtml"><head><title>{i}</title></head><body>{text}</body></html>',
+                zipfile.ZIP_DEFLATED,
+            )
+
+
+def generate_corpus(out_dir: str, pages: int = 20):
+    """Создаёт по файлу каждого формата. CBR добавляется, только если установлен rar."""
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    (out / "Bench Author - Plain PDF.pdf").write_bytes(_pdf("Plain PDF", pages))
+    (out / "Bench Author - Scanned PDF.pdf").write_bytes(_pdf("Scanned PDF", pages, scanned=True))
+    with zipfile.ZipFile(out / "Bench Author - Zipped Novel.zip", "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("Zipped Novel.fb2", _fb2("Zipped Novel", "Bench Author", pages * 10))
+    images = [(f"{i:03d}.png", _png(800, 1200, i)) for i in range(pages)]
+    with zipfile.ZipFile(out / "Bench Author - Comic Book.cbz", "w", zipfile.ZIP_STORED) as zf:
+        for name, data in images:
+            zf.writestr(name, data)
+    write_epub(str(out / "Bench Author - Ready Epub.epub"), "Ready Epub", "Bench Author", chapters=pages // 4 or 1)
+    if shutil.which("rar"):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, data in images:
+                Path(tmp, name).write_bytes(data)
+            subprocess.run(
+                ["rar", "a", "-ep", "-idq", str(out / "Bench Author - Rar Comic.cbr"), *sorted(Path(tmp).iterdir())],
+                check=True,
+            )
+    else:
+        print("rar not found, skipping CBR sample", file=sys.stderr)
+    return sorted(p.name for p in out.iterdir())
+
+
+# --- Заглушки внешних инструментов ---
+def run_stub(tool: str, args: list[str]) -> int:
+    """Имитирует внешний инструмент: пишет минимальный результат после BENCH_STUB_DELAY секунд."""
+    time.sleep(float(os.getenv("BENCH_STUB_DELAY", "0")))
+    if tool == "ebook-convert":
+        source, output, options = args[0], args[1], args[2:]
+        named = dict(zip(options[::2], options[1::2]))
+        # Уникальное название, чтобы параллельные повторы одного файла вели себя как разные книги
+        title = f"{named.get('--title') or Path(source).stem} {uuid.uuid4().hex[:6]}"
+        write_epub(output, title, named.get("--authors") or "Bench Author")
+    elif tool == "ebook-meta":
+        if len(args) == 1:
+            print(f"Title               : {Path(args[0]).stem}\nAuthor(s)           : Bench Author")
+    elif tool == "gs":
+        output = next(a.split("=", 1)[1] for a in args if a.startswith("-sOutputFile="))
+        if "-sDEVICE=pdfwrite" in args:
+            # Имитируем сжатие вдвое
+            with open(args[-1], "rb") as src, open(output, "wb") as dst:
+                dst.write(src.read()[: os.path.getsize(args[-1]) // 2])
+        else:
+            Path(output).write_bytes(_png(60, 80, 1))
+    return 0
+
+
+def install_stubs(bin_dir: str) -> dict[str, str]:
+    paths = {}
+    for tool in STUB_TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" stub {tool} "$@"\n')
+        os.chmod(path, 0o755)
+        paths[tool] = path
+    return paths
+
+
+# --- Локальный SMTP-приёмник ---
+class SmtpSink:
+    """Принимает письма и считает их, ничего не сохраняя. Поддерживает AUTH PLAIN и SIZE."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.server: asyncio.AbstractServer | None = None
+
+    async def start(self, host: str = "127.0.0.1") -> int:
+        self.server = await asyncio.start_server(self._session, host, 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(b"220 bench ESMTP\r\n")
+        try:
+            while line := await reader.readline():
+                command = line.decode("latin-1").strip().upper()
+                if command.startswith(("EHLO", "HELO")):
+                    writer.write(b"250-bench\r\n250-SIZE 0\r\n250-8BITMIME\r\n250 AUTH PLAIN\r\n")
+                elif command.startswith("AUTH"):
+                    writer.write(b"235 2.7.0 Authentication successful\r\n")
+                elif command == "DATA":
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    await writer.drain()
+                    while (chunk := await reader.readline()) not in (b".\r\n", b""):
+                        self.bytes += len(chunk)
+                    self.messages += 1
+                    writer.write(b"250 OK queued\r\n")
+                elif command == "QUIT":
+                    writer.write(b"221 Bye\r\n")
+                    await writer.drain()
+                    break
+                else:
+                    # MAIL, RCPT, NOOP, RSET
+                    writer.write(b"250 OK\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # Пул бота держит соединения открытыми до конца прогона
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.server.close()
+
+
+# --- HTTP-заглушка Google Books и поиска Amazon ---
+class LookupStub:
+    """
+    Google Books отвечает ISBN для половины запросов, для остальных срабатывает поиск ASIN.
+    По /file/<имя> отдаются файлы корпуса, как их отдаёт Bot API.
+    """
+
+    def __init__(self, delay: float = 0.0, files: dict[str, str] | None = None):
+        self.delay = delay
+        self.files = files or {}
+        self.requests = 0
+        self.server: asyncio.AbstractServer | None = None
+
+    async def start(self, host: str = "127.0.0.1") -> int:
+        self.server = await asyncio.start_server(self._handle, host, 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode("latin-1")
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if len(request_line.split()) < 2:
+                # Клиент закрыл соединение, не отправив запрос (отменённый поиск)
+                return
+            target = request_line.split()[1]
+            if target.startswith("/file/"):
+                await self._send_file(writer, self.files[unquote(target.removeprefix("/file/"))])
+                return
+            self.requests += 1
+            await asyncio.sleep(self.delay)
+            digest = int(hashlib.sha1(target.encode()).hexdigest(), 16)
+            if target.startswith("/books"):
+                items = [{"volumeInfo": {"industryIdentifiers": [{"type": "ISBN_13", "identifier": f"978{digest % 10**10:010d}"}]}}]
+                body = json.dumps({"items": items if digest % 2 else []}).encode()
+                content_type = "application/json"
+            else:
+                body = f'<a href="/dp/B{digest % 10**9:09d}">result</a>'.encode()
+                content_type = "text/html"
+            writer.write(
+                f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _send_file(writer: asyncio.StreamWriter, path: str):
+        writer.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+            f"Content-Length: {os.path.getsize(path)}\r\nConnection: close\r\n\r\n".encode()
+        )
+        with open(path, "rb") as f:
+            while chunk := f.read(256 * 1024):
+                writer.write(chunk)
+                await writer.drain()
+
+    def close(self):
+        self.server.close()
+
+
+# --- Поддельные объекты Telegram ---
+class FakeFile:
+    def __init__(self, file_path: str):
+        # URL на заглушке или путь на диске, как у локального Bot API сервера
+        self.file_path = file_path
+
+
+class FakeDocument:
+    def __init__(self, source: str, file_name: str, file_unique_id: str, file_path: str):
+        self.source = source
+        self.file_name = file_name
+        self.file_unique_id = file_unique_id
+        self.file_size = os.path.getsize(source)
+        self.file_path = file_path
+
+    async def get_file(self) -> FakeFile:
+        return FakeFile(self.file_path)
+
+
+class FakeMessage:
+    """Запоминает ответы бота; done выставляется на первом итоговом сообщении."""
+
+    def __init__(self, document: FakeDocument):
+        self.document = document
+        self.media_group_id = None
+        self.replies: list[str] = []
+        self.status: str | None = None
+        self.done = asyncio.Event()
+
+    async def reply_text(self, text: str, **kwargs):
+        self.replies.append(text)
+        for prefix, status in FINAL_PREFIXES.items():
+            if text.startswith(prefix) and not self.done.is_set():
+                self.status = status
+                self.done.set()
+        # Сообщение о ходе пачки редактируется, итог — в его заголовке
+        return self
+
+    async def edit_text(self, text: str, **kwargs):
+        await self.reply_text(text)
+
+
+class FakeUpdate(SimpleNamespace):
+    def to_json(self) -> str:
+        # Журнал задач сохраняет Update целиком; прогон задачи не возобновляет, хватает идентификаторов
+        document = self.message.document
+        return json.dumps({"user_id": self.effective_user.id, "file_unique_id": document.file_unique_id})
+
+
+def fake_update(document: FakeDocument, user_id: int = BENCH_USER_ID) -> FakeUpdate:
+    user = SimpleNamespace(id=user_id, username="bench", full_name="Bench User")
+    return FakeUpdate(message=FakeMessage(document), effective_user=user)
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+# --- Статистика ---
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def summarize(latencies: list[float], statuses: list[str]) -> dict:
+    ok = [lat for lat, status in zip(latencies, statuses) if status == "ok"]
+    return {
+        "jobs": len(statuses),
+        "ok": len(ok),
+        "failed": len(statuses) - len(ok),
+        "mean": sum(ok) / len(ok) if ok else None,
+        "p50": percentile(ok, 0.50),
+        "p95": percentile(ok, 0.95),
+        "p99": percentile(ok, 0.99),
+        "max": max(ok) if ok else None,
+    }
+
+
+# --- Прогон ---
+def prepare_environment(work_dir: str, args: argparse.Namespace, smtp_port: int, http_port: int):
+    """Настраивает окружение до импорта bot: конфигурация читается при импорте модуля."""
+    env = {
+        "TELEGRAM_TOKEN": "bench",
+        "ADMIN_USER_ID": "0",
+        "DB_PATH": os.path.join(work_dir, "users.db"),
+        "CACHE_DIR": os.path.join(work_dir, "cache"),
+        "WORKSPACE_DIR": os.path.join(work_dir, "jobs"),
+        "CACHE_MAX_BYTES": str(2 * 1024 ** 3) if args.cache else "0",
+        "SMTP_SERVER": "127.0.0.1",
+        "SMTP_PORT": str(smtp_port),
+        "SMTP_STARTTLS": "0",
+        "SMTP_LOGIN": "bot@bench.local",
+        "SMTP_PASSWORD": "bench",
+        "GOOGLE_BOOKS_URL": f"http://127.0.0.1:{http_port}/books",
+        "AMAZON_SEARCH_URL": f"http://127.0.0.1:{http_port}/s",
+        "JOB_WORKERS": str(args.concurrency),
+        "MAX_QUEUED_JOBS": str(max(100, args.concurrency * 4)),
+        "BENCH_STUB_DELAY": str(args.stub_delay),
+        # Окно сбора пачек выключено: пачки (--batch) подаются целиком
+        "BATCH_WINDOW": "0",
+        "PER_USER_JOBS": str(args.per_user or args.concurrency),
+    }
+    if args.tools == "stub":
+        bin_dir = os.path.join(work_dir, "bin")
+        os.makedirs(bin_dir)
+        stubs = install_stubs(bin_dir)
+        env.update({
+            "CONVERT_PATH": stubs["ebook-convert"],
+            "METADATA_TOOL": stubs["ebook-meta"],
+            "CALIBRE_WORKERS": "0",
+            "PATH": bin_dir + os.pathsep + os.environ.get("PATH", ""),
+        })
+    os.environ.update(env)
+
+
+async def replay(bot, corpus: list[Path], args: argparse.Namespace, file_url: str | None) -> list[dict]:
+    """
+    Подаёт корпус repeat раз, держа в работе не больше concurrency задач.
+    :param file_url: откуда скачивать файлы по HTTP; None — отдавать пути, как локальный Bot API сервер
+    """
+    gate = asyncio.Semaphore(args.concurrency)
+    context = SimpleNamespace(args=[], bot=SimpleNamespace(send_message=_noop))
+
+    def make_update(source: Path, rep: int) -> FakeUpdate:
+        unique_id = source.stem if args.cache else f"{source.stem}-{rep}"
+        file_path = f"{file_url}/{quote(source.name)}" if file_url else str(source.resolve())
+        document = FakeDocument(
+            str(source), source.name, hashlib.sha1(unique_id.encode()).hexdigest()[:16], file_path
+        )
+        # Файлы раздаются пользователям по кругу, чтобы проверить справедливость очереди
+        return fake_update(document, BENCH_USER_ID + corpus.index(source) % args.users)
+
+    async def one(items: list[tuple[Path, int]]) -> list[dict]:
+        updates = [make_update(source, rep) for source, rep in items]
+        async with gate:
+            started = time.monotonic()
+            if len(updates) == 1:
+                await bot.handle_file(updates[0], context)
+            else:
+                # Пачка подаётся целиком, без окна сбора; итог — в сообщении о ходе пачки первого файла
+                await bot.submit(updates)
+            message = updates[0].message
+            try:
+                await asyncio.wait_for(message.done.wait(), timeout=args.timeout)
+            except asyncio.TimeoutError:
+                message.status = "timeout"
+            elapsed = time.monotonic() - started
+        return [
+            {
+                "file": source.name,
+                "ext": source.suffix.lower(),
+                "rep": rep,
+                "seconds": elapsed,
+                "status": message.status,
+                "replies": message.replies,
+            }
+            for source, rep in items
+        ]
+
+    items = [(source, rep) for rep in range(args.repeat) for source in corpus]
+    if args.batch > 1:
+        # Пачки собираются из файлов одного пользователя
+        by_user: dict[int, list[tuple[Path, int]]] = {}
+        for source, rep in items:
+            by_user.setdefault(corpus.index(source) % args.users, []).append((source, rep))
+        groups = [
+            files[i:i + args.batch] for files in by_user.values() for i in range(0, len(files), args.batch)
+        ]
+    else:
+        groups = [[item] for item in items]
+    results = await asyncio.gather(*(one(group) for group in groups))
+    return [result for batch in results for result in batch]
+
+
+def stage_breakdown(metrics) -> dict:
+    stages: dict[str, dict] = {}
+    for (stage, ext), (total, count) in metrics.STAGE_SECONDS.totals().items():
+        stages.setdefault(stage, {})[ext] = {"count": count, "mean": total / count if count else None}
+    return stages
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    corpus = sorted(p for p in Path(args.corpus).iterdir() if p.is_file())
+    if not corpus:
+        raise SystemExit(f"Corpus {args.corpus} is empty, create one with: python benchmark.py corpus DIR")
+    work_dir = tempfile.mkdtemp(prefix="kindle-bench-")
+    sink, lookups = SmtpSink(), LookupStub(args.lookup_delay, {p.name: str(p) for p in corpus})
+    http_port = await lookups.start()
+    prepare_environment(work_dir, args, await sink.start(), http_port)
+
+    import bot
+    import metrics
+
+    bot.init_db()
+    bot.init_cache()
+    for user in range(args.users):
+        await bot.user_store.set_email(BENCH_USER_ID + user, BENCH_EMAIL)
+    await bot.pipeline.start()
+    await bot.workspaces.start()
+    await bot.pipeline.run("convert", bot.calibre.start)
+    started = time.monotonic()
+    try:
+        file_url = f"http://127.0.0.1:{http_port}/file" if args.downloads == "http" else None
+        results = await replay(bot, corpus, args, file_url)
+    finally:
+        wall = time.monotonic() - started
+        await bot.pipeline.stop()
+        await bot.workspaces.stop()
+        # QUIT уходит в SMTP-приёмник на этом же цикле событий
+        await asyncio.to_thread(bot.smtp_pool.close)
+        bot.user_store.close()
+        await bot.resolver.aclose()
+        bot.image_prep.shutdown()
+        bot.calibre.close()
+        sink.close()
+        lookups.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    by_ext: dict[str, list[dict]] = {}
+    for result in results:
+        by_ext.setdefault(result["ext"], []).append(result)
+    completed = sum(1 for r in results if r["status"] == "ok")
+    return {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {
+            "corpus": [p.name for p in corpus],
+            "concurrency": args.concurrency,
+            "repeat": args.repeat,
+            "tools": args.tools,
+            "stub_delay": args.stub_delay,
+            "lookup_delay": args.lookup_delay,
+            "cache": args.cache,
+            "batch": args.batch,
+        },
+        "wall_seconds": wall,
+        "throughput_jobs_per_s": completed / wall if wall else None,
+        "overall": summarize([r["seconds"] for r in results], [r["status"] for r in results]),
+        "formats": {
+            ext: summarize([r["seconds"] for r in items], [r["status"] for r in items])
+            for ext, items in sorted(by_ext.items())
+        },
+        "stages": stage_breakdown(metrics),
+        "peak_rss_bytes": {
+            "bot": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        },
+        "smtp": {"messages": sink.messages, "bytes": sink.bytes},
+        "lookup_requests": lookups.requests,
+        "failures": [
+            {"file": r["file"], "rep": r["rep"], "status": r["status"], "replies": r["replies"]}
+            for r in results if r["status"] != "ok"
+        ],
+    }
+
+
+# --- Вывод и сравнение ---
+def _ms(value: float | None) -> str:
+    return "-" if value is None else f"{value * 1000:.0f}ms"
+
+
+def print_report(report: dict):
+    print(f"{report['overall']['ok']}/{report['overall']['jobs']} jobs in {report['wall_seconds']:.2f}s, "
+          f"{report['throughput_jobs_per_s']:.2f} jobs/s")
+    print(f"{'format':<8}{'jobs':>6}{'fail':>6}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for ext, stats in [*report["formats"].items(), ("all", report["overall"])]:
+        print(f"{ext:<8}{stats['jobs']:>6}{stats['failed']:>6}"
+              f"{_ms(stats['p50']):>10}{_ms(stats['p95']):>10}{_ms(stats['p99']):>10}")
+    rss = report["peak_rss_bytes"]
+    print(f"peak RSS: bot {rss['bot'] / 2**20:.0f} MiB, largest child {rss['children'] / 2**20:.0f} MiB")
+
+
+def compare(base: dict, new: dict):
+    print(f"{'format':<8}{'metric':>8}{'base':>10}{'new':>10}{'change':>10}")
+    formats = sorted(set(base["formats"]) | set(new["formats"]))
+    for ext in [*formats, "all"]:
+        old_stats = base["overall"] if ext == "all" else base["formats"].get(ext, {})
+        new_stats = new["overall"] if ext == "all" else new["formats"].get(ext, {})
+        for key in ("p50", "p95", "p99"):
+            old, cur = old_stats.get(key), new_stats.get(key)
+            change = f"{(cur - old) / old * 100:+.1f}%" if old and cur is not None else "-"
+            print(f"{ext:<8}{key:>8}{_ms(old):>10}{_ms(cur):>10}{change:>10}")
+    print(f"throughput: {base['throughput_jobs_per_s']:.2f} -> {new['throughput_jobs_per_s']:.2f} jobs/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark for the Kindle bot")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    corpus = commands.add_parser("corpus", help="generate a synthetic corpus")
+    corpus.add_argument("out_dir")
+    corpus.add_argument("--pages", type=int, default=20, help="pages/images per sample")
+
+    run = commands.add_parser("run", help="replay a corpus through handle_file")
+    run.add_argument("--corpus", required=True, help="directory with input files")
+    run.add_argument("--concurrency", type=int, default=4, help="jobs submitted at once")
+    run.add_argument("--repeat", type=int, default=3, help="how many times each file is replayed")
+    run.add_argument("--tools", choices=("stub", "real"), default="stub",
+                     help="stub: fake ebook-convert/ebook-meta/gs; real: tools from the environment")
+    run.add_argument("--stub-delay", type=float, default=0.0, help="seconds every stub tool sleeps")
+    run.add_argument("--lookup-delay", type=float, default=0.05, help="seconds every ISBN/ASIN stub request takes")
+    run.add_argument("--cache", action="store_true", help="enable the conversion cache (repeats become cache hits)")
+    run.add_argument("--users", type=int, default=1, help="spread the corpus files over this many users")
+    run.add_argument("--batch", type=int, default=1, help="submit each user's files in batches of this size")
+    run.add_argument("--per-user", type=int, default=0, help="PER_USER_JOBS (default: --concurrency, no cap)")
+    run.add_argument("--downloads", choices=("http", "local"), default="http",
+                     help="stream files over HTTP or pick them up from disk like a local Bot API server")
+    run.add_argument("--timeout", type=float, default=600, help="per-job timeout, seconds")
+    run.add_argument("--output", help="write the JSON report here")
+
+    diff = commands.add_parser("compare", help="compare two JSON reports")
+    diff.add_argument("base")
+    diff.add_argument("new")
+
+    stub = commands.add_parser("stub", help=argparse.SUPPRESS)
+    stub.add_argument("tool", choices=STUB_TOOLS)
+    stub.add_argument("args", nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    if args.command == "stub":
+        sys.exit(run_stub(args.tool, args.args))
+    if args.command == "corpus":
+        for name in generate_corpus(args.out_dir, args.pages):
+            print(name)
+    elif args.command == "compare":
+        with open(args.base) as f_base, open(args.new) as f_new:
+            compare(json.load(f_base), json.load(f_new))
+    else:
+        report = asyncio.run(run_benchmark(args))
+        print_report(report)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
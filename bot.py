@@ -1,33 +1,65 @@
 from telegram.request import HTTPXRequest
 from httpx import Timeout
+import asyncio
+import json
 import os
+import signal
 import logging
-import smtplib
-import sqlite3
 import subprocess
-from email.message import EmailMessage
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import asdict
 from pathlib import Path
-import rarfile
-import re
-import requests
-from unzip_safe import unzip_safe
+from typing import Awaitable, Callable
+from urllib.parse import urlparse
+from archive_reader import MAX_UNCOMPRESSED_SIZE, extract_book
+from pipeline import JobPipeline, QueueFull, stage_limits_from_env
+from scheduler import CostModel
+from conversion_cache import ConversionCache, make_key
+from smtp_pool import SmtpPool
+from downloads import Download, Downloader, unshare
+from streaming_mime import StreamingMessage, encoded_file_size
+from lookup_cache import LookupCache
+from metadata_resolver import AmazonSearchProvider, GoogleBooksProvider, MetadataResolver
+import epub_meta
+from epub_meta import EpubMetadataError
+from comic_epub import build_comic_epub
+import fb2_epub
+from fb2_epub import Fb2Error
+import image_prep
+from image_prep import DeviceProfile
+from calibre_pool import CalibrePool
+from user_store import UserStore
+from durable_queue import LEASE_EXPIRED, DurableQueue, LeasedJob, QueueConsumer
+from batching import Batcher, BatchProgress, pack
+from workspace import Workspace, WorkspaceManager
+from job_journal import JobJournal, JournalEntry
+from notifications import BACKGROUND, AdminNotifier, RateLimiter
+import metrics
+import pdf_tools
+import size_optimizer
 
 def compress_pdf(input_path: str, output_path: str) -> bool:
     try:
-        subprocess.run([
-            "gs",
-            "-sDEVICE=pdfwrite",
-            "-dCompatibilityLevel=1.4",
-            "-dPDFSETTINGS=/ebook",
-            "-dNOPAUSE", "-dQUIET", "-dBATCH",
-            f"-sOutputFile={output_path}",
-            input_path
-        ], check=True)
-        return True
-    except subprocess.CalledProcessError as e:
+        with metrics.track("compress_pdf"):
+            return pdf_tools.compress_pdf(
+                input_path, output_path, threads=GS_THREADS,
+                min_size=PDF_COMPRESS_MIN_BYTES, min_page_bytes=PDF_COMPRESS_MIN_PAGE_BYTES,
+            )
+    except (subprocess.CalledProcessError, OSError) as e:
         logger.warning(f"Ghostscript compression failed: {e}")
         return False
 
+def extract_pdf_cover(pdf_path: str, cover_path: str) -> bool:
+    try:
+        with metrics.track("cover"):
+            pdf_tools.render_cover(pdf_path, cover_path, threads=GS_THREADS)
+        return os.path.exists(cover_path)
+    except (subprocess.CalledProcessError, OSError) as e:
+        logger.warning(f"Failed to extract cover from PDF: {e}")
+        return False
+
 def guess_author_title_from_filename(name: str) -> tuple[str, str]:
     name = Path(name).stem
     if " - " in name:
@@ -37,51 +69,6 @@ def guess_author_title_from_filename(name: str) -> tuple[str, str]:
         return author, title
     return "", name.strip()
 
-# --- Поиск ISBN по названию и автору ---
-def find_isbn_by_title_author(title: str, author: str) -> str | None:
-    query = f"{title} {author}".strip()
-    try:
-        resp = requests.get("https://www.googleapis.com/books/v1/volumes", params={"q": query})
-        if resp.ok:
-            data = resp.json()
-            for item in data.get("items", []):
-                industry_ids = item.get("volumeInfo", {}).get("industryIdentifiers", [])
-                for id_entry in industry_ids:
-                    if id_entry["type"] in {"ISBN_10", "ISBN_13"}:
-                        return id_entry["identifier"]
-    except Exception as e:
-        logger.warning(f"Failed to fetch ISBN: {e}")
-    return None
-
-
-# --- Поиск ASIN по названию и автору ---
-def find_asin_by_title_author(title: str, author: str) -> str | None:
-    query = f"{title} {author}".strip()
-    # Try to use ISBN as ASIN directly if available
-    isbn = find_isbn_by_title_author(title, author)
-    if isbn:
-        logger.info(f"Using ISBN as ASIN directly: {isbn}")
-        return f"amazon:{isbn}"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
-    }
-    logger.info(f"Searching ASIN for: {query}")
-    try:
-        resp = requests.get("https://www.amazon.com/s", params={"k": query}, headers=headers, timeout=10)
-        if resp.ok:
-            matches = re.findall(r"/dp/([A-Z0-9]{10})", resp.text)
-            logger.info(f"ASIN raw matches: {matches}")
-            if matches:
-                logger.info(f"Using ASIN: {matches[0]}")
-                return matches[0]
-            else:
-                logger.info("No ASIN found in page.")
-        else:
-            logger.warning(f"Amazon search failed: HTTP {resp.status_code}")
-    except Exception as e:
-        logger.warning(f"Failed to fetch ASIN: {e}")
-    return None
-
 from telegram import Update, Document
 from telegram.ext import (
     Application,
@@ -96,12 +83,80 @@ DB_PATH = os.getenv("DB_PATH", "/data/users.db")
 DEFAULT_COVER = os.getenv("DEFAULT_COVER", "/app/default_cover.jpg")
 CONVERT_PATH = os.getenv("CONVERT_PATH", "/usr/bin/ebook-convert")
 METADATA_TOOL = os.getenv("METADATA_TOOL", "/usr/bin/ebook-meta")
+CALIBRE_DEBUG_PATH = os.getenv("CALIBRE_DEBUG_PATH", "/opt/calibre/calibre-debug")
 SMTP_SERVER = os.getenv("SMTP_SERVER")
 SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
 SMTP_LOGIN = os.getenv("SMTP_LOGIN")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") == "1"
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "0"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "100"))
+# Сколько задач одного пользователя обрабатывается одновременно, остальные ждут в справедливой очереди
+PER_USER_JOBS = int(os.getenv("PER_USER_JOBS", "2"))
+CACHE_DIR = os.getenv("CACHE_DIR", "/data/cache")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Увеличить при изменении логики конвертации, чтобы не отдавать устаревшие артефакты
+CACHE_VERSION = 2
+LOOKUP_TTL = int(os.getenv("LOOKUP_TTL", str(30 * 24 * 3600)))
+LOOKUP_NEGATIVE_TTL = int(os.getenv("LOOKUP_NEGATIVE_TTL", str(24 * 3600)))
+METADATA_DEADLINE = float(os.getenv("METADATA_DEADLINE", "8"))
+GOOGLE_BOOKS_URL = os.getenv("GOOGLE_BOOKS_URL", "https://www.googleapis.com/books/v1/volumes")
+AMAZON_SEARCH_URL = os.getenv("AMAZON_SEARCH_URL", "https://www.amazon.com/s")
+CALIBRE_TIMEOUT = int(os.getenv("CALIBRE_TIMEOUT", "600"))
+CALIBRE_MAX_JOBS = int(os.getenv("CALIBRE_MAX_JOBS", "50"))
+IMAGE_PREP = os.getenv("IMAGE_PREP", "0") == "1"
+# FB2 → EPUB встроенным потоковым конвертером; calibre — только если он не справился
+NATIVE_FB2 = os.getenv("NATIVE_FB2", "1") == "1"
+IMAGE_PROFILE = DeviceProfile.parse(
+    os.getenv("IMAGE_PROFILE", "1264x1680"),
+    grayscale=os.getenv("IMAGE_GRAYSCALE", "1") == "1",
+    quality=int(os.getenv("IMAGE_QUALITY", "80")),
+)
+# Роль процесса: all — всё в одном; frontend — только принимает обновления и ставит задачи;
+# worker — только выполняет задачи из общей очереди (нужен JOB_QUEUE_PATH)
+BOT_ROLE = os.getenv("BOT_ROLE", "all")
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "")
+JOB_LEASE = float(os.getenv("JOB_LEASE", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+PDF_COMPRESS_MIN_BYTES = int(os.getenv("PDF_COMPRESS_MIN_BYTES", str(2 * 1024 * 1024)))
+PDF_COMPRESS_MIN_PAGE_BYTES = int(os.getenv("PDF_COMPRESS_MIN_PAGE_BYTES", str(64 * 1024)))
+# Лимит письма с вложением после base64 (Send to Kindle принимает до 50 МБ, у некоторых SMTP-релеев меньше)
+MAX_EMAIL_BYTES = int(os.getenv("MAX_EMAIL_BYTES", str(50 * 1024 * 1024)))
+# Свой Bot API сервер (telegram-bot-api --local): файлы до 2 ГБ, забираются с общего тома без HTTP
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")
+BOT_API_FILE_URL = os.getenv("BOT_API_FILE_URL", "https://api.telegram.org/file/bot")
+BOT_API_LOCAL = os.getenv("BOT_API_LOCAL", "0") == "1"
+MAX_DOWNLOAD_BYTES = int(os.getenv(
+    "MAX_DOWNLOAD_BYTES", str((2000 if BOT_API_LOCAL else 50) * 1024 * 1024)
+))
+# Документы пользователя, пришедшие с паузами меньше BATCH_WINDOW секунд, обрабатываются одной пачкой (0 — выкл.)
+BATCH_WINDOW = float(os.getenv("BATCH_WINDOW", "2"))
+MEDIA_GROUP_WINDOW = 1.0
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "30"))
+BATCH_MAX_WAIT = float(os.getenv("BATCH_MAX_WAIT", "10"))
+# Send to Kindle принимает не больше 25 вложений в письме
+MAX_ATTACHMENTS = int(os.getenv("MAX_ATTACHMENTS", "25"))
+# Рабочие каталоги задач (можно на tmpfs): лимит на файл задачи и общий (0 — 90% свободного места)
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "/tmp/kindle-jobs")
+WORKSPACE_JOB_BYTES = int(os.getenv("WORKSPACE_JOB_BYTES", str(max(1024 ** 3, 3 * MAX_DOWNLOAD_BYTES))))
+WORKSPACE_TOTAL_BYTES = int(os.getenv("WORKSPACE_TOTAL_BYTES", "0"))
+WORKSPACE_MAX_AGE = float(os.getenv("WORKSPACE_MAX_AGE", str(24 * 3600)))
+WORKSPACE_SWEEP_INTERVAL = float(os.getenv("WORKSPACE_SWEEP_INTERVAL", "600"))
+# Сводка для ADMIN_USER_ID раз в столько секунд (загрузки, ошибки по стадиям, очередь, самые долгие задачи)
+ADMIN_DIGEST_INTERVAL = float(os.getenv("ADMIN_DIGEST_INTERVAL", "60"))
+# Лимиты Telegram на сообщения: всего в секунду и в один чат в секунду
+BOT_API_RATE = float(os.getenv("BOT_API_RATE", "30"))
+BOT_API_CHAT_RATE = float(os.getenv("BOT_API_CHAT_RATE", "1"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
 
 SUPPORTED_KINDLE_EXTENSIONS = {
     ".epub", ".pdf", ".doc", ".docx", ".rtf", ".txt",
@@ -114,30 +169,87 @@ SUPPORTED_KINDLE_EXTENSIONS = {
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# --- Очередь задач ---
+pipeline = JobPipeline(stage_limits_from_env(), workers=JOB_WORKERS, max_queued=MAX_QUEUED_JOBS, per_user=PER_USER_JOBS)
+# Оценка длительности задач по формату и размеру, уточняется по завершённым задачам
+costs = CostModel()
+# Потоки рендеринга Ghostscript: ядра делятся между одновременными задачами стадии preprocess
+GS_THREADS = int(os.getenv("GS_THREADS", str(max(1, (os.cpu_count() or 1) // pipeline.limits["preprocess"]))))
+conversion_cache: ConversionCache | None = None
+job_queue: DurableQueue | None = None
+consumer: QueueConsumer | None = None
+application: Application | None = None
+user_store: UserStore | None = None
+journal: JobJournal | None = None
+calibre = CalibrePool(
+    CONVERT_PATH,
+    CALIBRE_DEBUG_PATH,
+    size=int(os.getenv("CALIBRE_WORKERS", str(pipeline.limits["convert"]))),
+    timeout=CALIBRE_TIMEOUT,
+    max_jobs=CALIBRE_MAX_JOBS,
+)
+resolver = MetadataResolver(
+    [GoogleBooksProvider(GOOGLE_BOOKS_URL), AmazonSearchProvider(AMAZON_SEARCH_URL)],
+    deadline=METADATA_DEADLINE,
+)
+batcher = Batcher(lambda user_id, updates: submit(updates), max_items=BATCH_MAX_FILES, max_wait=BATCH_MAX_WAIT)
+downloader = Downloader()
+workspaces = WorkspaceManager(
+    WORKSPACE_DIR, WORKSPACE_JOB_BYTES, WORKSPACE_TOTAL_BYTES,
+    max_age=WORKSPACE_MAX_AGE, sweep_interval=WORKSPACE_SWEEP_INTERVAL,
+)
+smtp_pool = SmtpPool(SMTP_SERVER, SMTP_PORT, SMTP_LOGIN, SMTP_PASSWORD, size=SMTP_POOL_SIZE, starttls=SMTP_STARTTLS)
+def queue_depth() -> int:
+    return job_queue.depth() if job_queue else pipeline.queue_depth
+
+async def send_admin(text: str):
+    await application.bot.send_message(chat_id=ADMIN_USER_ID, text=text, rate_limit_args=BACKGROUND)
+
+# Все запросы к Bot API — ответы, правки и сводки — проходят через общий лимит
+rate_limiter = RateLimiter(BOT_API_RATE, BOT_API_CHAT_RATE)
+notifier = AdminNotifier(send_admin, ADMIN_DIGEST_INTERVAL, queue_depth) if ADMIN_USER_ID else None
+if notifier:
+    metrics.error_listeners.append(notifier.failure)
+metrics.register(metrics.Gauge("kindle_queue_depth", "Jobs waiting in the queue", queue_depth))
+metrics.register(metrics.Gauge(
+    "kindle_jobs_in_flight", "Jobs being processed",
+    lambda: pipeline.in_flight + (consumer.in_flight if consumer else 0),
+))
+metrics.register(metrics.Gauge(
+    "kindle_workspace_reserved_bytes", "Scratch space reserved by running jobs", lambda: workspaces.reserved,
+))
+
 # --- Инициализация базы ---
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, email TEXT NOT NULL)")
-    conn.commit()
-    conn.close()
-
-def set_email(user_id: int, email: str):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("REPLACE INTO users (user_id, email) VALUES (?, ?)", (user_id, email))
-    conn.commit()
-    conn.close()
-
-def get_email(user_id: int) -> str | None:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.execute("SELECT email FROM users WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else None
+    global user_store, journal
+    user_store = UserStore(DB_PATH)
+    journal = JobJournal(DB_PATH)
+    journal.purge()
+    resolver.cache = LookupCache(DB_PATH, LOOKUP_TTL, LOOKUP_NEGATIVE_TTL)
+    resolver.cache.purge_expired()
+
+def init_queue():
+    global job_queue, consumer
+    if JOB_QUEUE_PATH:
+        job_queue = DurableQueue(JOB_QUEUE_PATH, lease=JOB_LEASE, max_attempts=JOB_MAX_ATTEMPTS, per_user=PER_USER_JOBS)
+        job_queue.purge_failed()
+        consumer = QueueConsumer(job_queue, run_queued_job, workers=JOB_WORKERS, on_failed=report_failed_job)
+
+def init_cache():
+    global conversion_cache
+    if CACHE_MAX_BYTES > 0:
+        conversion_cache = ConversionCache(CACHE_DIR, CACHE_MAX_BYTES)
 
 # --- Метаданные из EPUB ---
+@metrics.track("metadata_read")
 def extract_metadata(epub_path: str) -> dict:
+    if Path(epub_path).suffix.lower() == ".epub":
+        try:
+            return epub_meta.read_metadata(epub_path)
+        except EpubMetadataError as e:
+            logger.warning(f"Native metadata read failed, falling back to {METADATA_TOOL}: {e}")
     try:
-        result = subprocess.run([METADATA_TOOL, epub_path], capture_output=True, text=True, check=True)
+        result = metrics.run_measured([METADATA_TOOL, epub_path], stdout=subprocess.PIPE, text=True)
         lines = result.stdout.splitlines()
         meta = {}
         for line in lines:
@@ -152,17 +264,66 @@ def extract_metadata(epub_path: str) -> dict:
         logger.warning(f"Metadata read failed: {e}")
         return {}
 
+async def convert_fb2_native(input_path: str, output_path: str) -> dict | None:
+    """
+    FB2 → EPUB без calibre. None — книга не разобрана или встроенный конвертер сбоил, нужен calibre.
+    Ошибки ввода-вывода (например, кончилось место) calibre не исправит, они пробрасываются.
+    """
+    try:
+        with metrics.track("convert_native"):
+            return await pipeline.run("convert", fb2_epub.convert_fb2, input_path, output_path)
+    except OSError:
+        raise
+    except Exception as e:
+        if isinstance(e, Fb2Error):
+            logger.warning(f"Native FB2 conversion failed, falling back to calibre: {e}")
+        else:
+            logger.exception("Native FB2 converter crashed, falling back to calibre")
+        if os.path.exists(output_path):
+            os.unlink(output_path)
+        return None
+
+@metrics.track("metadata_write")
+def write_metadata(path: str, title: str | None = None, authors: str | None = None,
+                   isbn: str | None = None, asin: str | None = None, cover_path: str | None = None) -> bool:
+    """Записывает метаданные за один проход: EPUB правится на месте, прочие форматы через ebook-meta."""
+    if Path(path).suffix.lower() == ".epub":
+        try:
+            epub_meta.update_metadata(path, title, authors, isbn, asin, cover_path)
+            return True
+        except EpubMetadataError as e:
+            logger.warning(f"Native metadata write failed, falling back to {METADATA_TOOL}: {e}")
+    # ebook-meta правит файл на месте: файл локального Bot API сервера сначала копируем
+    unshare(path)
+    cmd = [METADATA_TOOL, path]
+    if title:
+        cmd += ["--title", title]
+    if authors:
+        cmd += ["--authors", authors]
+    if isbn:
+        cmd += ["--isbn", isbn]
+    if asin:
+        cmd += ["--identifier", f"amazon:{asin.removeprefix('amazon:')}"]
+    if cover_path:
+        cmd += ["--cover", cover_path]
+    try:
+        run_tool(cmd)
+        return True
+    except (subprocess.CalledProcessError, OSError) as e:
+        logger.warning(f"Failed to set metadata for {path}: {e}")
+        return False
+
 # --- Команды Telegram ---
 async def cmd_setemail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("❌ Usage: /setemail your_kindle_email@kindle.com")
         return
     email = context.args[0]
-    set_email(update.effective_user.id, email)
+    await user_store.set_email(update.effective_user.id, email)
     await update.message.reply_text(f"✅ Kindle email set to: {email}")
 
 async def cmd_getemail(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    email = get_email(update.effective_user.id)
+    email = await user_store.get_email(update.effective_user.id)
     if email:
         await update.message.reply_text(f"📬 Your Kindle email: {email}")
     else:
@@ -183,33 +344,268 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+# Ответ пользователю о ходе обработки
+Reply = Callable[[str], Awaitable]
+
+
+def format_eta(seconds: float) -> str:
+    minutes = round(seconds / 60)
+    return "a minute" if minutes <= 1 else f"{minutes} minutes"
+
+
+# --- Блокирующие операции (выполняются в пулах стадий) ---
+def run_tool(cmd: list[str]):
+    metrics.run_measured(cmd)
+
+def fits_email(path: str) -> bool:
+    # Адрес получателя здесь неизвестен, запас в 1 КБ покрывает разницу в заголовках
+    msg = StreamingMessage(SMTP_LOGIN or "", "kindle@kindle.com", path, Path(path).name)
+    return msg.encoded_size() + 1024 <= MAX_EMAIL_BYTES
+
+def fit_for_delivery(path: str) -> bool:
+    with metrics.track("optimize"):
+        return size_optimizer.fit_artifact(path, fits_email, threads=GS_THREADS)
+
+@metrics.track("deliver")
+def send_to_kindle(path: str, kindle_email: str, filename: str | None = None):
+    msg = StreamingMessage(SMTP_LOGIN, kindle_email, path, filename or Path(path).name)
+    smtp_pool.send(msg)
+
+@metrics.track("deliver")
+def send_batch(messages: list[StreamingMessage], on_sent: Callable[[int], None] | None = None) -> list[Exception | None]:
+    return smtp_pool.send_many(messages, on_sent)
+
+
 # --- Основная логика получения файла ---
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    doc: Document = update.message.document
+    file_name = doc.file_name or f"{doc.file_unique_id}"
+    ext = Path(file_name).suffix.lower()
+
+    if not ext:
+        await update.message.reply_text("❌ Cannot determine file extension.")
+        return
+
+    # Check file size before downloading
+    if ext != ".epub" and doc.file_size and doc.file_size > MAX_DOWNLOAD_BYTES:
+        await update.message.reply_text(
+            f"❌ File too large. The bot can only download files up to {MAX_DOWNLOAD_BYTES // (1024 * 1024)} MB."
+        )
+        return
+
+    # Документы одной медиагруппы приходят отдельными обновлениями с интервалом до секунды
+    window = max(BATCH_WINDOW, MEDIA_GROUP_WINDOW) if update.message.media_group_id else BATCH_WINDOW
+    if window > 0:
+        batcher.add(update.effective_user.id, update, window)
+    else:
+        await submit([update])
+
+
+async def submit(updates: list[Update]):
+    """Одна задача на пачку документов пользователя; администратор узнает о загрузке из сводки."""
+    update = updates[0]
     user_id = update.effective_user.id
     user_name = update.effective_user.username or update.effective_user.full_name or f"id:{user_id}"
-    if ADMIN_USER_ID:
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_USER_ID,
-                text=f"📥 User @{user_name} (id: {user_id}) uploaded: {update.message.document.file_name or 'unnamed file'}"
-            )
-        except Exception as e:
-            logger.warning(f"Failed to notify admin: {e}")
-    kindle_email = get_email(user_id)
+    if notifier:
+        notifier.upload(f"@{user_name} (id: {user_id})", [u.message.document.file_name or "unnamed file" for u in updates])
+    kindle_email = await user_store.get_email(user_id)
     if not kindle_email:
         await update.message.reply_text("⚠️ Please set your Kindle email first using /setemail.")
         return
 
+    docs = [u.message.document for u in updates]
+    cost = sum(costs.estimate(Path(doc.file_name or "").suffix.lower(), doc.file_size) for doc in docs)
+    priority = user_id == ADMIN_USER_ID
+    # Update сериализуется целиком: обработчик в другом процессе или после перезапуска восстановит его через Update.de_json
+    payload = {"updates": [json.loads(u.to_json()) for u in updates], "kindle_email": kindle_email}
+    entry = None
+    try:
+        if job_queue:
+            # Запись в журнале создаёт обработчик; id общий для всех повторных выдач задачи
+            payload["journal_id"] = uuid.uuid4().hex
+            _, position, ahead = await asyncio.to_thread(
+                job_queue.enqueue, payload, MAX_QUEUED_JOBS, user_id, cost, priority
+            )
+        else:
+            entry = await asyncio.to_thread(journal.open, payload)
+            position, ahead = enqueue_entry(entry, updates, cost, priority)
+    except QueueFull:
+        if entry:
+            await entry.finish()
+        await update.message.reply_text("⏳ The bot is busy right now, please try again in a few minutes.")
+        return
+    if position > 1:
+        # Задачи перед этой делят между собой JOB_WORKERS обработчиков
+        eta = ahead / max(JOB_WORKERS, 1) + cost
+        await update.message.reply_text(f"🕒 Queued, position {position}, ready in about {format_eta(eta)}.")
+
+
+def enqueue_entry(entry: JournalEntry, updates: list[Update], cost: float, priority: bool = False) -> tuple[int, float]:
+    user_id = updates[0].effective_user.id
+    if len(updates) == 1:
+        name = f"{user_id}:{updates[0].message.document.file_unique_id}"
+        return pipeline.enqueue(name, lambda: run_entry(entry, updates), user_id, cost, priority)
+    # Файлы пачки встают в очередь по отдельности (см. process_batch), сама пачка обработчик не занимает
+    position = pipeline.preview(user_id, cost, len(updates), priority)
+    pipeline.spawn(run_entry(entry, updates), f"{user_id}:batch:{len(updates)}")
+    return position
+
+
+async def run_entry(entry: JournalEntry, updates: list[Update]):
+    """
+    Выполняет задачу из журнала. Запись удаляется, когда задача завершена; если задачу прервала
+    остановка бота (CancelledError), запись и рабочий каталог остаются для возобновления.
+    """
+    kindle_email = entry.payload["kindle_email"]
+    if len(updates) == 1:
+        await run_job(updates[0], kindle_email, entry)
+    else:
+        await run_batch(updates, kindle_email, entry)
+    await entry.finish()
+
+
+async def resume_jobs():
+    """Ставит в очередь задачи, прерванные перезапуском, — они продолжатся с последней сохранённой стадии."""
+    for entry in await asyncio.to_thread(journal.unfinished):
+        updates = [Update.de_json(data, application.bot) for data in entry.payload["updates"]]
+        message = updates[0].message
+        if entry.resumes > JOB_MAX_ATTEMPTS:
+            logger.warning(f"Giving up on job {entry.id} after {entry.resumes - 1} restarts")
+            await entry.finish()
+            await message.reply_text("❌ Processing failed: the bot restarted too many times while working on it.")
+            continue
+        docs = [u.message.document for u in updates]
+        cost = sum(costs.estimate(Path(doc.file_name or "").suffix.lower(), doc.file_size) for doc in docs)
+        try:
+            # Прерванные задачи своё уже отстояли в очереди
+            enqueue_entry(entry, updates, cost, priority=True)
+        except QueueFull:
+            # Остаётся в журнале до следующего запуска
+            logger.warning(f"Queue is full, job {entry.id} is not resumed")
+            continue
+        logger.info(f"Resuming job {entry.id} ({len(updates)} files)")
+        try:
+            await message.reply_text("🔄 The bot was restarted, resuming your file...")
+        except Exception as e:
+            logger.warning(f"Failed to notify about resumed job {entry.id}: {e}")
+
+
+@asynccontextmanager
+async def job_workspace(entry: JournalEntry, size: int, files: int = 1):
+    """Рабочий каталог задачи из журнала: после перезапуска — тот же каталог с уже готовыми файлами."""
+    async with workspaces.job(size, files, name=entry.state.get("workspace"), keep_on_cancel=True) as ws:
+        if entry.state.get("workspace") != ws.name:
+            entry.state["workspace"] = ws.name
+            await entry.checkpoint("started")
+        yield ws
+
+
+async def run_job(update: Update, kindle_email: str, entry: JournalEntry):
+    doc: Document = update.message.document
+    ext = Path(doc.file_name or "").suffix.lower()
+    metrics.current_ext.set(ext)
+    started = time.monotonic()
+    try:
+        with metrics.track("job"):
+            async with job_workspace(entry, doc.file_size or 0) as ws:
+                await process_document(update, kindle_email, ws, entry)
+        elapsed = time.monotonic() - started
+        costs.observe(ext, doc.file_size or 0, elapsed)
+        if notifier:
+            notifier.finished(doc.file_name or doc.file_unique_id, elapsed)
+    except Exception as e:
+        metrics.JOBS_TOTAL.inc(ext, "error")
+        logger.exception(f"Processing failed for {doc.file_name or doc.file_unique_id}")
+        await update.message.reply_text(f"❌ Processing failed: {e}")
+
+
+async def run_batch(updates: list[Update], kindle_email: str, entry: JournalEntry):
+    try:
+        # Место под файлы резервируется по одному, когда до них доходит очередь (WorkspaceManager.part)
+        async with job_workspace(entry, 0, files=len(updates)) as ws:
+            await process_batch(updates, kindle_email, ws, entry)
+    except Exception as e:
+        logger.exception(f"Batch of {len(updates)} files failed")
+        await updates[0].message.reply_text(f"❌ Processing failed: {e}")
+
+
+async def run_queued_job(payload: dict):
+    # Задачи, поставленные до появления пачек, хранят один Update под ключом "update"
+    updates = [Update.de_json(data, application.bot) for data in payload.get("updates") or [payload["update"]]]
+    # Повторная выдача той же задачи (аренда истекла) продолжает её по записи в журнале
+    entry = await asyncio.to_thread(journal.open, payload, payload.get("journal_id"), True)
+    await run_entry(entry, updates)
+
+
+async def report_failed_job(job: LeasedJob, error: str):
+    """Задача общей очереди окончательно не выполнена: сообщаем пользователю и в сводку администратору."""
+    if notifier:
+        notifier.failure("queue", error)
+    payload = job.payload
+    if payload.get("journal_id"):
+        await asyncio.to_thread(journal.finish, payload["journal_id"])
+    message = Update.de_json((payload.get("updates") or [payload["update"]])[0], application.bot).message
+    if error == LEASE_EXPIRED:
+        await message.reply_text("❌ Processing failed: the bot restarted too many times while working on it.")
+    else:
+        await message.reply_text(f"❌ Processing failed: {error}")
+
+
+async def run_worker(app: Application):
+    """Процесс-обработчик без приёма обновлений: только выполняет задачи из общей очереди."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with app:
+        await app.post_init(app)
+        try:
+            await stop.wait()
+        finally:
+            await app.post_stop(app)
+            await app.post_shutdown(app)
+
+
+async def download_document(doc: Document, path: str, max_bytes: int | None = None) -> Download:
+    async with pipeline.slot("download"):
+        with metrics.track("download"):
+            telegram_file = await doc.get_file()
+            return await downloader.fetch(telegram_file.file_path, path, max_bytes)
+
+
+async def split_comic(reply: Reply, ws: Workspace, image_files: list[str], base_name: str,
+                      title: str, author: str) -> list[str] | None:
+    """Собирает комикс, не влезающий в одно письмо, в несколько томов, каждый в пределах лимита."""
+    # base64 увеличивает размер на треть, ещё 5% — на разметку EPUB
+    groups = size_optimizer.split_volumes(image_files, int(MAX_EMAIL_BYTES * 3 / 4 * 0.95))
+    await reply(f"📚 Too large for one e-mail, splitting into {len(groups)} volumes...")
+    volumes = []
+    for number, group in enumerate(groups, start=1):
+        volume_path = ws.file(f"{base_name} - Vol. {number}.epub")
+        with metrics.track("comic_package"):
+            await pipeline.run("convert", build_comic_epub, group, volume_path, f"{title}, Vol. {number}", author)
+        if not await pipeline.run("preprocess", fit_for_delivery, volume_path):
+            await reply("❌ A single volume is still too large for e-mail delivery.")
+            return None
+        volumes.append(volume_path)
+    return volumes
+
+
+async def build_artifact(update: Update, download: Download, reply: Reply,
+                         ws: Workspace) -> tuple[list[str], dict] | None:
+    """
+    Конвертирует скачанный документ; все файлы создаются в рабочем каталоге задачи ws. Возвращает пути к готовым файлам (несколько — для комикса,
+    разбитого на тома) и найденные метаданные или None, если пользователю уже отправлено сообщение об ошибке.
+    :param reply: куда писать о ходе обработки (ответ в чат или строка в общем сообщении пачки)
+    """
     doc: Document = update.message.document
     if Path(doc.file_name or "").suffix.lower() == ".epub":
         # EPUB не требует конвертации, сразу отправляем
-        raw_input_path = f"/tmp/{doc.file_unique_id}.epub"
-        telegram_file = await doc.get_file()
-        await telegram_file.download_to_drive(raw_input_path)
+        raw_input_path = download.path
         logger.info(f"Downloaded EPUB: {raw_input_path}")
 
         # --- Метаданные и переименование EPUB ---
-        meta = extract_metadata(raw_input_path)
+        meta = await pipeline.run("metadata", extract_metadata, raw_input_path)
         title = meta.get("title", "").strip()
         author = meta.get("author(s)", meta.get("authors", "")).strip()
 
@@ -220,96 +616,71 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             safe_title = "".join(c for c in title if c.isalnum() or c in " _-").strip()
             safe_author = "".join(c for c in author if c.isalnum() or c in " _-").strip()
             final_name = f"{safe_title} - {safe_author}".strip(" -") + ".epub"
-            final_output_path = f"/tmp/{final_name}"
+            final_output_path = ws.file(final_name)
             os.rename(raw_input_path, final_output_path)
             raw_input_path = final_output_path
-            try:
-                meta_cmd = [METADATA_TOOL, raw_input_path]
-                if title:
-                    meta_cmd += ["--title", title]
-                if author:
-                    meta_cmd += ["--authors", author]
-                subprocess.run(meta_cmd, check=True)
-            except subprocess.CalledProcessError:
-                logger.warning(f"Failed to set EPUB metadata for {raw_input_path}")
-
-        await update.message.reply_text("📤 Sending EPUB to Kindle...")
-
-        msg = EmailMessage()
-        msg["Subject"] = ""
-        msg["From"] = SMTP_LOGIN
-        msg["To"] = kindle_email
-        msg.set_content("Document for Kindle")
-
-        with open(raw_input_path, "rb") as f:
-            msg.add_attachment(
-                f.read(),
-                maintype="application",
-                subtype="octet-stream",
-                filename=Path(raw_input_path).name
-            )
+            await pipeline.run("metadata", write_metadata, raw_input_path, title=title, authors=author)
 
-        try:
-            with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-                server.starttls()
-                server.login(SMTP_LOGIN, SMTP_PASSWORD)
-                server.send_message(msg)
-            logger.info(f"Sent EPUB to {kindle_email}: {raw_input_path}")
-            await update.message.reply_text("✅ EPUB sent to Kindle.")
-        except Exception as e:
-            logger.warning(f"Failed to send EPUB: {e}")
-            await update.message.reply_text(f"❌ Failed to send email: {e}")
-        return
+        return [raw_input_path], {"title": title, "author": author}
     file_name = doc.file_name or f"{doc.file_unique_id}"
     ext = Path(file_name).suffix.lower()
 
-    if not ext:
-        await update.message.reply_text("❌ Cannot determine file extension.")
-        return
-
-    raw_input_path = f"/tmp/{doc.file_unique_id}{ext}"
+    raw_input_path = download.path
+    title, author, isbn, asin = "", "", None, None
+    cover_image_path = None
 
-    # Check file size before downloading
-    if doc.file_size and doc.file_size > 50 * 1024 * 1024:
-        await update.message.reply_text("❌ File too large. Telegram bots can only download files up to 50 MB.")
-        return
-
-    telegram_file = await doc.get_file()
-    await telegram_file.download_to_drive(raw_input_path)
     logger.info(f"Downloaded: {raw_input_path}")
 
     # Сжимаем PDF при необходимости
     if ext == ".pdf":
+        # Сжатие и обложка независимы: обложку рендерим с исходника параллельно со сжатием
         compressed_path = raw_input_path.replace(".pdf", "_compressed.pdf")
-        if compress_pdf(raw_input_path, compressed_path):
+        cover_image_path = ws.file("cover.jpg")
+        compressed, has_cover = await asyncio.gather(
+            pipeline.run("preprocess", compress_pdf, raw_input_path, compressed_path),
+            pipeline.run("preprocess", extract_pdf_cover, raw_input_path, cover_image_path),
+        )
+        if compressed:
             raw_input_path = compressed_path
             logger.info(f"PDF compressed to {raw_input_path}")
-    elif ext in [".zip", ".cbz"]:
-        import tempfile
-        from unzip_safe import unzip_safe
-
-        extract_dir = tempfile.mkdtemp()
+        if not has_cover:
+            cover_image_path = None
+    elif ext in [".zip", ".cbz", ".cbr"]:
+        extract_dir = ws.mkdir("extract")
         try:
-            unzip_safe(raw_input_path, extract_dir)
+            with metrics.track("extract"):
+                kind, extracted = await pipeline.run(
+                    "preprocess", extract_book, raw_input_path, extract_dir,
+                    allow_fb2=ext != ".cbr",
+                    max_uncompressed_size=min(MAX_UNCOMPRESSED_SIZE, ws.remaining()),
+                    archive_type={"zip": "zip", "epub": "zip", "rar": "rar"}.get(download.kind),
+                )
         except Exception as e:
-            await update.message.reply_text(f"❌ Failed to extract archive: {e}")
+            await reply(f"❌ Failed to extract archive: {e}")
             return
+        logger.info(f"Extracted {ext} to {extract_dir}")
 
-        fb2_files = sorted(Path(extract_dir).rglob("*.fb2"))
-        if fb2_files:
-            raw_input_path = str(fb2_files[0])
+        if kind == "fb2":
+            raw_input_path = extracted[0]
             ext = ".fb2"
         else:
             # Проверка изображений как манга/комикс
-            image_files = sorted([
-                str(p) for p in Path(extract_dir).rglob("*")
-                if p.suffix.lower() in {".jpg", ".jpeg", ".png"}
-            ])
+            image_files = extracted
             if not image_files:
-                await update.message.reply_text("❌ ZIP does not contain FB2 or supported images.")
+                await reply("❌ Archive does not contain FB2 or supported images.")
                 return
 
-            # Конвертация изображений в EPUB (аналогично как было до этого)
+            if IMAGE_PREP and image_prep.available():
+                with metrics.track("image_prep"):
+                    prep = await pipeline.run(
+                        "preprocess", image_prep.prepare_images, image_files, os.path.join(extract_dir, "_kindle"), IMAGE_PROFILE
+                    )
+                image_files = prep.paths
+                if prep.saved > 0:
+                    await reply(
+                        f"🗜 Images optimized for Kindle: {prep.bytes_before / 1e6:.1f} MB → {prep.bytes_after / 1e6:.1f} MB"
+                    )
+
             author, title = guess_author_title_from_filename(file_name)
             title = title or "Untitled Manga"
             author = author or "Unknown"
@@ -317,115 +688,28 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             safe_title = "".join(c for c in title if c.isalnum() or c in " _-").strip()
             safe_author = "".join(c for c in author if c.isalnum() or c in " _-").strip()
             base_name = f"{safe_author} - {safe_title}".strip(" -")
-
-            epub_output = f"/tmp/{base_name}.epub"
-            input_html = os.path.join(extract_dir, f"{base_name}.html")
-            cover_image_path = image_files[0]
-
-            with open(input_html, "w") as f:
-                f.write('<!DOCTYPE html>\n<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n<meta charset="utf-8"/>\n')
-                f.write(f"<title>{title}</title></head>\n<body>\n")
-                for img_path in image_files:
-                    rel_path = os.path.relpath(img_path, extract_dir)
-                    f.write(f'<div><img src="{rel_path}" style="width:100%;"/></div>\n')
-                f.write("</body>\n</html>\n")
+            epub_output = ws.file(f"{base_name}.epub")
 
             try:
-                subprocess.run([CONVERT_PATH, input_html, epub_output, "--cover", cover_image_path, "--page-breaks-before", "/"], check=True)
-                raw_input_path = epub_output
-                ext = ".epub"
-            except subprocess.CalledProcessError as e:
-                await update.message.reply_text("❌ Failed to convert manga archive.")
+                with metrics.track("comic_package"):
+                    await pipeline.run("convert", build_comic_epub, image_files, epub_output, title, author)
+            except Exception as e:
+                logger.warning(f"Failed to package comic: {e}")
+                await reply("❌ Failed to convert manga archive.")
                 return
-    elif ext == ".cbr":
-        import tempfile
-        import rarfile
-        import shutil
-
-        with rarfile.RarFile(raw_input_path) as rar:
-            extract_dir = tempfile.mkdtemp()
-            rar.extractall(extract_dir)
-            logger.info(f"Extracted CBR to {extract_dir}")
-
-        author, title = guess_author_title_from_filename(file_name)
-        title = title or "Untitled Manga"
-        author = author or "Unknown"
-
-        safe_title = "".join(c for c in title if c.isalnum() or c in " _-").strip()
-        safe_author = "".join(c for c in author if c.isalnum() or c in " _-").strip()
-        base_name = f"{safe_author} - {safe_title}".strip(" -")
-
-        epub_output = f"/tmp/{base_name}.epub"
-
-        image_files = sorted([
-            str(p) for p in Path(extract_dir).rglob("*")
-            if p.suffix.lower() in {".jpg", ".jpeg", ".png"}
-        ])
-
-        if not image_files:
-            await update.message.reply_text("❌ CBR does not contain supported images.")
-            return
-
-        cover_image_path = image_files[0]
-        input_html = os.path.join(extract_dir, f"{base_name}.html")
-
-        with open(input_html, "w") as f:
-            f.write('<!DOCTYPE html>\n<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n<meta charset="utf-8"/>\n')
-            f.write(f"<title>{title}</title>")
-            f.write("</head>\n")
-            f.write("<body>\n")
-            for img_path in image_files:
-                rel_path = os.path.relpath(img_path, extract_dir)
-                f.write(f'<div><img src="{rel_path}" style="width:100%;"/></div>\n')
-            f.write("</body>\n</html>\n")
-
-        # await update.message.reply_document(document=open(input_html, "rb"), filename=Path(input_html).name)
-
-        # --- EPUB conversion with input_html/epub_output collision check ---
-        if os.path.abspath(input_html) == os.path.abspath(epub_output):
-            epub_output = epub_output.replace(".epub", "_converted.epub")
-            pass
-        cmd = [CONVERT_PATH, input_html, epub_output, "--cover", cover_image_path, "--page-breaks-before", "/"]
-        try:
-            subprocess.run(cmd, check=True)
-            logger.info(f"Converted CBR to EPUB: {epub_output}")
-            # Make sure input_path/output_path refer to the actual output
-            input_path = epub_output
-            output_path = epub_output
-            # Avoid further accidental re-conversion
-            ext = ".epub"
-            try:
-                meta_cmd = [METADATA_TOOL, epub_output, "--title", title]
-                if author:
-                    meta_cmd += ["--authors", author]
-                subprocess.run(meta_cmd, check=True)
-                logger.info(f"Set EPUB metadata for CBR: title='{title}' author='{author}'")
-            except subprocess.CalledProcessError as e:
-                pass
-            # --- Установка ISBN для EPUB ---
-            isbn = find_isbn_by_title_author(title, author)
-            if isbn:
-                logger.info(f"Found ISBN: {isbn}")
-                try:
-                    subprocess.run([METADATA_TOOL, epub_output, "--isbn", isbn], check=True)
-                    logger.info(f"Set ISBN for EPUB: {isbn}")
-                except subprocess.CalledProcessError as e:
-                    pass
-            # --- Установка ASIN для EPUB ---
-            asin = find_asin_by_title_author(title, author)
-            if asin:
-                logger.info(f"Found ASIN: {asin}")
-                try:
-                    subprocess.run([METADATA_TOOL, epub_output, "--identifier", f"BookId:amazon:{asin}"], check=True)
-                    logger.info(f"ASIN metadata set using scheme 'BookId:amazon': {asin}")
-                except subprocess.CalledProcessError as e:
-                    pass
-            # Отправка EPUB с полной метаинформацией в Telegram (после ISBN и ASIN)
-            # await update.message.reply_document(document=open(output_path, "rb"), filename=Path(output_path).name, caption="📎 EPUB with full metadata")
-        except subprocess.CalledProcessError as e:
-            pass
-            await update.message.reply_text("❌ Failed to convert CBR archive.")
-            return
+            if not await pipeline.run("preprocess", fit_for_delivery, epub_output):
+                os.unlink(epub_output)
+                volumes = await split_comic(reply, ws, image_files, base_name, title, author)
+                return (volumes, {"title": title, "author": author}) if volumes else None
+
+            # --- ISBN и ASIN для EPUB ---
+            with metrics.track("lookup"):
+                ids = await resolver.resolve(title, author)
+            isbn, asin = ids.get("isbn"), ids.get("asin")
+            if isbn or asin:
+                if await pipeline.run("metadata", write_metadata, epub_output, isbn=isbn, asin=asin):
+                    logger.info(f"Set identifiers for comic EPUB: isbn={isbn} asin={asin}")
+            return [epub_output], {"title": title, "author": author, "isbn": isbn, "asin": asin}
     # input_path = raw_input_path
     # output_path = input_path
 
@@ -435,20 +719,17 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if ext not in SUPPORTED_KINDLE_EXTENSIONS or Path(output_path).suffix.lower() != ".epub":
         output_path = str(Path(input_path).with_suffix(".epub"))
-        await update.message.reply_text(f"⚙️ Converting {ext} to EPUB...")
+        await reply(f"⚙️ Converting {ext} to EPUB...")
 
+        meta = None
+        if ext == ".fb2" and NATIVE_FB2:
+            meta = await convert_fb2_native(input_path, output_path)
         try:
             cmd = [CONVERT_PATH, input_path, output_path]
-            # --- Вырезаем обложку из первой страницы PDF (требуется ImageMagick) ---
-            if ext == ".pdf":
-                cover_image_path = f"/tmp/{Path(file_name).stem}_cover.jpg"
-                try:
-                    subprocess.run(["convert", f"{raw_input_path}[0]", cover_image_path], check=True)
-                    if os.path.exists(cover_image_path):
-                        cmd += ["--cover", cover_image_path]
-                        logger.info(f"Extracted cover from first page: {cover_image_path}")
-                except Exception as e:
-                    logger.warning(f"Failed to extract cover from PDF: {e}")
+            # --- Обложка из первой страницы PDF ---
+            if cover_image_path:
+                cmd += ["--cover", cover_image_path]
+                logger.info(f"Extracted cover from first page: {cover_image_path}")
             # --- ВСТАВКА: Добавление метаданных для PDF→EPUB ---
             if ext == ".pdf":
                 # Попытка угадать название и автора из имени файла
@@ -457,13 +738,16 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     cmd += ["--title", title]
                 if author:
                     cmd += ["--authors", author]
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            pass
-            await update.message.reply_text("❌ Conversion failed.")
+            if meta is None:
+                with metrics.track("convert"):
+                    await pipeline.run("convert", calibre.convert, cmd[1:])
+        except subprocess.SubprocessError as e:
+            logger.warning(f"Conversion failed: {e}")
+            await reply("❌ Conversion failed.")
             return
 
-        meta = extract_metadata(output_path)
+        if meta is None:
+            meta = await pipeline.run("metadata", extract_metadata, output_path)
         title = meta.get("title", "").strip()
         author = meta.get("author(s)", meta.get("authors", "")).strip()
 
@@ -474,52 +758,36 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             final_name = Path(file_name).stem + ".epub"
 
-        final_output_path = f"/tmp/{final_name}"
+        final_output_path = ws.file(final_name)
         os.rename(output_path, final_output_path)
         output_path = final_output_path
-        # --- Установка ISBN для EPUB ---
-        isbn = find_isbn_by_title_author(title, author)
-        if isbn:
-            logger.info(f"Found ISBN: {isbn}")
-            try:
-                subprocess.run([METADATA_TOOL, output_path, "--isbn", isbn], check=True)
-                logger.info(f"Set ISBN for EPUB: {isbn}")
-            except subprocess.CalledProcessError as e:
-                pass
-        # --- Установка ASIN для EPUB ---
-        asin = find_asin_by_title_author(title, author)
-        if asin:
-            logger.info(f"Found ASIN: {asin}")
-            try:
-                subprocess.run([METADATA_TOOL, output_path, "--identifier", f"BookId:amazon:{asin}"], check=True)
-                logger.info(f"ASIN metadata set using scheme 'BookId:amazon': {asin}")
-            except subprocess.CalledProcessError as e:
-                pass
+        # --- Установка ISBN и ASIN для EPUB ---
+        with metrics.track("lookup"):
+            ids = await resolver.resolve(title, author)
+        # ISBN из самой FB2 (publish-info) надёжнее найденного по названию
+        isbn, asin = meta.get("isbn") or ids.get("isbn"), ids.get("asin")
+        if isbn or asin:
+            if await pipeline.run("metadata", write_metadata, output_path, isbn=isbn, asin=asin):
+                logger.info(f"Set identifiers for EPUB: isbn={isbn} asin={asin}")
         # Отправка EPUB с полной метаинформацией в Telegram (после ISBN и ASIN)
         # await update.message.reply_document(document=open(output_path, "rb"), filename=Path(output_path).name, caption="📎 EPUB with full metadata")
     else:
         if not doc.file_name:
             final_name = f"{doc.file_unique_id}{ext}"
-            final_output_path = f"/tmp/{final_name}"
+            final_output_path = ws.file(final_name)
             os.rename(input_path, final_output_path)
             output_path = final_output_path
         elif ext == ".pdf":
             author, title = guess_author_title_from_filename(file_name)
             if title:
-                try:
-                    cmd = [METADATA_TOOL, input_path, "--title", title]
-                    if author:
-                        cmd += ["--authors", author]
-                    subprocess.run(cmd, check=True)
+                if await pipeline.run("metadata", write_metadata, input_path, title=title, authors=author):
                     logger.info(f"Updated PDF metadata: title='{title}' author='{author}'")
-                except subprocess.CalledProcessError as e:
-                    pass
 
             if author or title:
                 safe_title = "".join(c for c in title if c.isalnum() or c in " _-").strip()
                 safe_author = "".join(c for c in author if c.isalnum() or c in " _-").strip()
                 new_name = f"{safe_title} - {safe_author}".strip(" -") + ".pdf"
-                new_path = f"/tmp/{new_name}"
+                new_path = ws.file(new_name)
                 os.rename(input_path, new_path)
                 input_path = new_path
                 output_path = new_path
@@ -528,37 +796,219 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             output_path = input_path
 
-    await update.message.reply_text("📤 Sending to Kindle...")
+    return [output_path], {"title": title, "author": author, "isbn": isbn, "asin": asin}
 
-    msg = EmailMessage()
-    msg["Subject"] = ""
-    msg["From"] = SMTP_LOGIN
-    msg["To"] = kindle_email
-    msg.set_content("Document for Kindle")
-
-    with open(output_path, "rb") as f:
-        msg.add_attachment(
-            f.read(),
-            maintype="application",
-            subtype="octet-stream",
-            filename=Path(output_path).name
-        )
 
-    try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SMTP_LOGIN, SMTP_PASSWORD)
-            server.send_message(msg)
-        logger.info(f"Sent to {kindle_email}: {output_path}")
-    except Exception as e:
-        pass
-        await update.message.reply_text(f"❌ Failed to send email: {e}")
+async def prepare_delivery(update: Update, reply: Reply, ws: Workspace,
+                           entry: JournalEntry, index: int = 0) -> tuple[list[str], list[str]] | None:
+    """
+    Готовый к отправке результат: из кеша или после конвертации и подгонки под лимит письма.
+    Скачанный файл и готовые вложения сохраняются в журнале, после перезапуска эти стадии пропускаются.
+    :param index: номер документа в задаче (пачке)
+    :return: пути и имена вложений или None, если пользователю уже сообщено об ошибке
+    """
+    doc: Document = update.message.document
+    state = entry.file(index)
+    if state.get("paths") and all(os.path.exists(p) for p in state["paths"]):
+        logger.info(f"Resuming {doc.file_unique_id}: already converted")
+        return state["paths"], state["filenames"]
+    ext = Path(doc.file_name or "").suffix.lower()
+    params = {
+        "ext": ext,
+        "version": CACHE_VERSION,
+        "images": IMAGE_PROFILE.key() if IMAGE_PREP else None,
+        "max_email": MAX_EMAIL_BYTES,
+    }
+    cache_key = make_key(doc.file_unique_id, params)
+    if conversion_cache:
+        cached = await pipeline.run("preprocess", conversion_cache.get, cache_key)
+        if cached:
+            logger.info(f"Cache hit for {doc.file_unique_id}: {cached.filename} {cached.meta}")
+            return [cached.path], [cached.filename]
+
+    saved = state.get("download")
+    if saved and os.path.exists(saved["path"]) and os.path.getsize(saved["path"]) == saved["size"]:
+        download = Download(**saved)
+        logger.info(f"Resuming {doc.file_unique_id}: already downloaded to {download.path}")
+    else:
+        # Лимит рабочего каталога соблюдается уже при скачивании, а не после него
+        download = await download_document(doc, ws.file(f"{doc.file_unique_id}{ext}"), ws.remaining())
+        logger.info(f"Downloaded {download.path}: {download.size} bytes, {download.kind or 'unknown'} format")
+        ws.check()
+        state["download"] = asdict(download)
+        await entry.checkpoint("downloaded")
+    # Тот же файл, загруженный заново, получает другой file_unique_id, но тот же SHA-256
+    content_key = make_key(f"sha256:{download.sha256}", params)
+    if conversion_cache:
+        cached = await pipeline.run("preprocess", conversion_cache.get, content_key)
+        if cached:
+            logger.info(f"Cache hit by content for {doc.file_unique_id}: {cached.filename}")
+            return [cached.path], [cached.filename]
+
+    result = await build_artifact(update, download, reply, ws)
+    if not result:
+        return None
+    ws.check()
+    output_paths, meta = result
+    # Отправляем только то, что почтовый сервер точно примет
+    for output_path in output_paths:
+        if not await pipeline.run("preprocess", fit_for_delivery, output_path):
+            await reply(
+                f"❌ The file is too large for e-mail delivery even after compression "
+                f"(limit {MAX_EMAIL_BYTES / 1e6:.0f} MB)."
+            )
+            return None
+    filenames = [Path(p).name for p in output_paths]
+    state.update(paths=output_paths, filenames=filenames)
+    await entry.checkpoint("converted")
+    if conversion_cache and len(output_paths) == 1:
+        try:
+            await pipeline.run(
+                "preprocess", conversion_cache.put, content_key, output_paths[0], filenames[0], meta, (cache_key,)
+            )
+        except Exception as e:
+            logger.warning(f"Failed to cache {output_paths[0]}: {e}")
+    return output_paths, filenames
+
+
+async def process_document(update: Update, kindle_email: str, ws: Workspace, entry: JournalEntry):
+    doc: Document = update.message.document
+    ext = Path(doc.file_name or "").suffix.lower()
+    prepared = await prepare_delivery(update, update.message.reply_text, ws, entry)
+    if not prepared:
+        metrics.JOBS_TOTAL.inc(ext, "failed")
         return
+    output_paths, filenames = prepared
+
+    await update.message.reply_text("📤 Sending to Kindle...")
+
+    # Тома, отправленные до перезапуска, повторно не отправляются
+    sent = entry.file(0).setdefault("sent", [])
+    for output_path, filename in zip(output_paths, filenames):
+        if filename in sent:
+            continue
+        try:
+            await pipeline.run("deliver", send_to_kindle, output_path, kindle_email, filename)
+            logger.info(f"Sent to {kindle_email}: {output_path}")
+            sent.append(filename)
+            await entry.checkpoint("sent")
+        except Exception as e:
+            await user_store.record_delivery(update.effective_user.id, filename, os.path.getsize(output_path), "failed", str(e))
+            metrics.JOBS_TOTAL.inc(ext, "failed")
+            await update.message.reply_text(f"❌ Failed to send email: {e}")
+            return
+        await user_store.record_delivery(update.effective_user.id, filename, os.path.getsize(output_path))
+    metrics.JOBS_TOTAL.inc(ext, "sent")
     try:
         await update.message.reply_text("✅ Done. Check your Kindle.")
     except Exception as e:
         pass
 
+
+async def process_batch(updates: list[Update], kindle_email: str, ws: Workspace, entry: JournalEntry):
+    """
+    Пачка документов одного пользователя: каждый файл — отдельная задача общей очереди со своей оценкой
+    стоимости (справедливость и PER_USER_JOBS действуют на каждый файл), отправка минимальным числом писем
+    в одной SMTP-сессии, ход работы — в одном редактируемом сообщении.
+    """
+    user_id = updates[0].effective_user.id
+    # Возобновлённые после перезапуска задачи своё уже отстояли в очереди
+    priority = user_id == ADMIN_USER_ID or entry.resumes > 0
+    docs: list[Document] = [u.message.document for u in updates]
+    exts = [Path(doc.file_name or "").suffix.lower() for doc in docs]
+    names = [doc.file_name or doc.file_unique_id for doc in docs]
+    message = await updates[0].message.reply_text(f"📦 Processing {len(updates)} files...")
+    progress = BatchProgress(message, names, f"📦 Processing {len(updates)} files...")
+
+    async def prepare(index: int) -> tuple[list[str], list[str]] | None:
+        metrics.current_ext.set(exts[index])
+        state = entry.file(index)
+        if state.get("filenames") and set(state["filenames"]) <= set(state.get("sent", [])):
+            # Отправлен до перезапуска
+            await progress.update(index, "✅ sent")
+            return state["paths"], state["filenames"]
+        await progress.update(index, "⚙️ converting")
+        started = time.monotonic()
+        try:
+            with metrics.track("job"):
+                async with workspaces.part(ws, str(index), docs[index].file_size or 0) as part:
+                    prepared = await prepare_delivery(
+                        updates[index], lambda text: progress.update(index, text), part, entry, index
+                    )
+            elapsed = time.monotonic() - started
+            costs.observe(exts[index], docs[index].file_size or 0, elapsed)
+            if notifier:
+                notifier.finished(names[index], elapsed)
+        except Exception as e:
+            metrics.JOBS_TOTAL.inc(exts[index], "error")
+            logger.exception(f"Processing failed for {names[index]}")
+            await progress.update(index, f"❌ Processing failed: {e}")
+            return None
+        if not prepared:
+            metrics.JOBS_TOTAL.inc(exts[index], "failed")
+            return None
+        await progress.update(index, "📤 ready to send")
+        return prepared
+
+    def schedule(index: int) -> Awaitable[tuple[list[str], list[str]] | None]:
+        state = entry.file(index)
+        if state.get("filenames") and set(state["filenames"]) <= set(state.get("sent", [])):
+            # Отправлен до перезапуска: обработчик не нужен
+            return prepare(index)
+        cost = costs.estimate(exts[index], docs[index].file_size)
+        return pipeline.call(f"{user_id}:{docs[index].file_unique_id}", lambda: prepare(index), user_id, cost, priority)
+
+    # Каждая задача в своём контексте, чтобы current_ext не смешивались
+    results = await asyncio.gather(*(asyncio.ensure_future(schedule(i)) for i in range(len(updates))))
+
+    # (номер документа, путь, имя вложения); отправленное до перезапуска пропускаем
+    attachments = [
+        (index, path, filename)
+        for index, prepared in enumerate(results) if prepared
+        for path, filename in zip(*prepared)
+        if filename not in entry.file(index).get("sent", [])
+    ]
+    # Запас на заголовки письма и каждой части
+    groups = pack(attachments, lambda a: encoded_file_size(a[1]) + 1024, MAX_EMAIL_BYTES - 1024, MAX_ATTACHMENTS)
+    messages = []
+    for group in groups:
+        _, path, filename = group[0]
+        msg = StreamingMessage(SMTP_LOGIN, kindle_email, path, filename)
+        for _, path, filename in group[1:]:
+            msg.attach(path, filename)
+        messages.append(msg)
+
+    def mark_sent(number: int):
+        # Вызывается из потока отправки сразу после письма, чтобы после сбоя оно не ушло повторно
+        for index, _, filename in groups[number]:
+            entry.file(index).setdefault("sent", []).append(filename)
+        entry.save("sent")
+
+    errors = await pipeline.run("deliver", send_batch, messages, mark_sent) if messages else []
+    failed: dict[int, Exception] = {}
+    for group, error in zip(groups, errors):
+        for index, path, filename in group:
+            status, reason = ("failed", str(error)) if error else ("sent", None)
+            await user_store.record_delivery(updates[index].effective_user.id, filename, os.path.getsize(path), status, reason)
+            if error:
+                failed[index] = error
+    sent = 0
+    for index, prepared in enumerate(results):
+        if not prepared:
+            continue
+        if index in failed:
+            metrics.JOBS_TOTAL.inc(exts[index], "failed")
+            progress.statuses[index] = f"❌ Failed to send email: {failed[index]}"
+        else:
+            sent += 1
+            metrics.JOBS_TOTAL.inc(exts[index], "sent")
+            progress.statuses[index] = "✅ sent"
+    logger.info(f"Batch for {kindle_email}: {sent}/{len(updates)} sent in {len(messages)} e-mails")
+    if sent:
+        await progress.finish(f"✅ Done: {sent} of {len(updates)} files sent in {len(messages)} e-mails. Check your Kindle.")
+    else:
+        await progress.finish(f"❌ None of the {len(updates)} files could be sent.")
+
 # --- Запуск приложения ---
 def main():
     if not TELEGRAM_TOKEN:
@@ -566,9 +1016,70 @@ def main():
         return
 
     init_db()
+    init_cache()
+    init_queue()
+    if BOT_ROLE != "all" and not job_queue:
+        logger.error(f"BOT_ROLE={BOT_ROLE} requires JOB_QUEUE_PATH")
+        return
 
-    request = HTTPXRequest()
-    app = Application.builder().token(TELEGRAM_TOKEN).request(request).build()
+    metrics_server = None
+
+    async def post_init(application: Application):
+        nonlocal metrics_server
+        if BOT_ROLE != "frontend":
+            await pipeline.start()
+            await workspaces.start(keep=await asyncio.to_thread(journal.workspaces))
+            await pipeline.run("convert", calibre.start)
+            if not job_queue:
+                # Задачи общей очереди после перезапуска снова выдаёт сама очередь
+                await resume_jobs()
+            if consumer:
+                await consumer.start()
+        if METRICS_PORT:
+            metrics_server = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        if notifier:
+            await notifier.start()
+
+    async def post_stop(application: Application):
+        # Последняя сводка, пока соединение с Bot API ещё открыто
+        if notifier:
+            await notifier.stop()
+
+    async def post_shutdown(application: Application):
+        if metrics_server:
+            metrics_server.close()
+        await batcher.drain()
+        if consumer:
+            await consumer.stop()
+        await pipeline.stop()
+        await workspaces.stop()
+        smtp_pool.close()
+        user_store.close()
+        journal.close()
+        await resolver.aclose()
+        await downloader.aclose()
+        image_prep.shutdown()
+        calibre.close()
+        if job_queue:
+            job_queue.close()
+
+    global application
+    # Пул соединений к Bot API под одновременные обновления и ответы из задач
+    request = HTTPXRequest(connection_pool_size=CONCURRENT_UPDATES + JOB_WORKERS)
+    app = application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(BOT_API_URL)
+        .base_file_url(BOT_API_FILE_URL)
+        .local_mode(BOT_API_LOCAL)
+        .request(request)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .rate_limiter(rate_limiter)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", cmd_help))
     app.add_handler(CommandHandler("help", cmd_help))
     app.add_handler(CommandHandler("setemail", cmd_setemail))
@@ -580,8 +1091,19 @@ def main():
 
     app.add_error_handler(error_handler)
 
-    logger.info("Bot started.")
-    app.run_polling()
+    logger.info(f"Bot started ({BOT_ROLE}).")
+    if BOT_ROLE == "worker":
+        asyncio.run(run_worker(app))
+    elif WEBHOOK_URL:
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import queue
+import select
+import subprocess
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calibre_worker.py")
+
+
+class WorkerDied(Exception):
+    pass
+
+
+class CalibreWorker:
+    """Один прогретый процесс calibre-debug, выполняющий конвертации по очереди."""
+
+    def __init__(self, calibre_debug: str):
+        self.proc = subprocess.Popen(
+            [calibre_debug, "-e", WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+        self.jobs = 0
+        self.ready = False
+
+    def _read(self, timeout: float) -> dict:
+        readable, _, _ = select.select([self.proc.stdout], [], [], timeout)
+        if not readable:
+            raise subprocess.TimeoutExpired(self.proc.args, timeout)
+        line = self.proc.stdout.readline()
+        if not line:
+            raise WorkerDied(f"calibre worker {self.proc.pid} exited with {self.proc.poll()}")
+        return json.loads(line)
+
+    def run(self, args: list[str], timeout: float, startup_timeout: float) -> dict:
+        """:return: ответ процесса: {"returncode", "cpu" (секунды), "maxrss" (КБ)}"""
+        if not self.ready:
+            try:
+                self._read(startup_timeout)
+            except subprocess.TimeoutExpired:
+                raise WorkerDied(f"calibre worker {self.proc.pid} did not start in {startup_timeout}s")
+            self.ready = True
+        try:
+            self.proc.stdin.write(json.dumps({"args": args}) + "\n")
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            raise WorkerDied(f"calibre worker {self.proc.pid} closed its input")
+        response = self._read(timeout)
+        self.jobs += 1
+        return response
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.kill()
+
+    def kill(self):
+        self.proc.kill()
+        self.proc.wait()
+
+
+class CalibrePool:
+    """
+    Пул прогретых процессов calibre вместо холодного запуска ebook-convert на каждую задачу.
+    Если calibre-debug недоступен, процесс упал или не запустился за startup_timeout,
+    задача выполняется через обычный ebook-convert.
+    :param size: число процессов
+    :param timeout: максимум секунд на одну конвертацию
+    :param max_jobs: после скольких задач процесс перезапускается (защита от утечек памяти)
+    """
+
+    def __init__(self, convert_path: str, calibre_debug: str, size: int = 2,
+                 timeout: float = 600, max_jobs: int = 50, startup_timeout: float = 60):
+        self.convert_path = convert_path
+        self.calibre_debug = calibre_debug
+        self.size = size
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.startup_timeout = startup_timeout
+        self._idle: queue.Queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max(1, size))
+        self._enabled = size > 0 and os.path.exists(calibre_debug)
+        if size > 0 and not self._enabled:
+            logger.warning(f"{calibre_debug} not found, using cold {convert_path} for every conversion")
+
+    def start(self):
+        """Заранее запускает процессы, чтобы первая задача не ждала загрузки calibre."""
+        if not self._enabled:
+            return
+        for _ in range(self.size):
+            self._idle.put(CalibreWorker(self.calibre_debug))
+        logger.info(f"Started {self.size} calibre workers")
+
+    def _acquire(self) -> CalibreWorker:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return CalibreWorker(self.calibre_debug)
+
+    def _release(self, worker: CalibreWorker):
+        if worker.jobs >= self.max_jobs:
+            logger.info(f"Recycling calibre worker {worker.proc.pid} after {worker.jobs} jobs")
+            worker.close()
+            worker = CalibreWorker(self.calibre_debug)
+        self._idle.put(worker)
+
+    def _run_cold(self, args: list[str]):
+        metrics.run_measured([self.convert_path, *args], timeout=self.timeout)
+
+    def convert(self, args: list[str]):
+        """
+        Аргументы как у ebook-convert: [input, output, *options].
+        Бросает subprocess.CalledProcessError или subprocess.TimeoutExpired, как subprocess.run(check=True).
+        Блокирующий вызов, выполнять в пуле потоков.
+        """
+        if not self._enabled:
+            return self._run_cold(args)
+        started = time.monotonic()
+        with self._slots:
+            worker = self._acquire()
+            try:
+                response = worker.run(args, self.timeout, self.startup_timeout)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+                raise
+            except (WorkerDied, OSError, ValueError) as e:
+                worker.kill()
+                logger.warning(f"Calibre worker failed ({e}), retrying with cold {self.convert_path}")
+                return self._run_cold(args)
+            self._release(worker)
+        logger.info(f"Warm conversion of {args[0]} took {time.monotonic() - started:.2f}s")
+        # Те же метрики, что у холодного ebook-convert (metrics.run_measured)
+        tool = os.path.basename(self.convert_path)
+        metrics.TOOL_CPU_SECONDS.inc(tool, amount=response.get("cpu", 0.0))
+        if response.get("maxrss"):
+            metrics.TOOL_MAX_RSS.observe(response["maxrss"] * 1024, tool)
+        if response["returncode"] != 0:
+            raise subprocess.CalledProcessError(response["returncode"], [self.convert_path, *args])
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
@@ -0,0 +1,45 @@
+# Выполняется внутри calibre: calibre-debug -e calibre_worker.py
+# Протокол: одна JSON-строка на запрос в stdin ({"args": [...]}), одна JSON-строка на ответ в stdout.
+import json
+import os
+import resource
+import sys
+import traceback
+
+
+def main():
+    # Всё, что печатает calibre, уходит в stderr, stdout остаётся только для протокола
+    proto = os.fdopen(os.dup(1), "w", buffering=1)
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    from calibre.customize.ui import input_format_plugins, output_format_plugins
+    from calibre.ebooks.conversion.cli import main as convert_main
+
+    # Прогрев: плагины загружаются один раз на процесс
+    list(input_format_plugins())
+    list(output_format_plugins())
+    proto.write(json.dumps({"ready": True}) + "\n")
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        before = _cpu_seconds()
+        try:
+            code = convert_main(["ebook-convert", *request["args"]])
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        # Пиковая память — за всё время жизни процесса, меньше её на одну задачу не узнать
+        maxrss = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+        proto.write(json.dumps({"returncode": code or 0, "cpu": _cpu_seconds() - before, "maxrss": maxrss}) + "\n")
+
+
+def _cpu_seconds() -> float:
+    # Сам процесс и его дочерние процессы (например, pdftohtml)
+    usages = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usages)
+
+
+main()
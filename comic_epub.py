@@ -0,0 +1,152 @@
+import logging
+import struct
+import uuid
+import zipfile
+from datetime import datetime, timezone
+from pathlib import Path
+from xml.sax.saxutils import escape, quoteattr
+
+logger = logging.getLogger(__name__)
+
+IMAGE_MEDIA_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+}
+# Размер страницы, если не удалось прочитать размер изображения
+DEFAULT_PAGE_SIZE = (1072, 1448)
+
+
+def image_size(path: str) -> tuple[int, int] | None:
+    """Читает ширину и высоту JPEG/PNG/GIF из заголовка, не декодируя изображение."""
+    with open(path, "rb") as f:
+        head = f.read(26)
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and len(head) >= 24:
+            return struct.unpack(">II", head[16:24])
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+        if not head.startswith(b"\xff\xd8"):
+            return None
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            code = marker[1]
+            if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+                continue
+            length_bytes = f.read(2)
+            if len(length_bytes) < 2:
+                return None
+            length = struct.unpack(">H", length_bytes)[0]
+            # SOF0..SOF15, кроме DHT (C4), JPG (C8) и DAC (CC)
+            if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">xHH", f.read(5))
+                return width, height
+            f.seek(length - 2, 1)
+
+
+def _page_xhtml(title: str, image_href: str, width: int, height: int) -> str:
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        "<!DOCTYPE html>\n"
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+        f"<head><title>{escape(title)}</title>"
+        f'<meta name="viewport" content="width={width}, height={height}"/>'
+        "<style>html,body{margin:0;padding:0}"
+        f"img{{display:block;width:{width}px;height:{height}px}}</style></head>\n"
+        f'<body><img src={quoteattr(image_href)} alt=""/></body>\n'
+        "</html>\n"
+    )
+
+
+def build_comic_epub(image_files: list[str], output_path: str, title: str, author: str,
+                     language: str = "en") -> str:
+    """
+    Собирает fixed-layout EPUB напрямую из списка изображений: одна XHTML-страница на изображение,
+    OPF, NCX и навигация генерируются, первое изображение становится обложкой.
+    JPEG/PNG записываются без повторного сжатия.
+    :param image_files: пути к изображениям в порядке страниц
+    """
+    if not image_files:
+        raise ValueError("No images to package")
+    book_id = f"urn:uuid:{uuid.uuid4()}"
+    modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    manifest, spine, nav_points = [], [], []
+    first_size = None
+
+    with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr(
+            "META-INF/container.xml",
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+            "</rootfiles></container>\n",
+        )
+        for index, image_path in enumerate(image_files, start=1):
+            suffix = Path(image_path).suffix.lower()
+            media_type = IMAGE_MEDIA_TYPES.get(suffix, "image/jpeg")
+            image_href = f"images/img-{index:04d}{suffix}"
+            page_href = f"pages/page-{index:04d}.xhtml"
+            width, height = image_size(image_path) or DEFAULT_PAGE_SIZE
+            first_size = first_size or (width, height)
+
+            zf.write(image_path, f"OEBPS/{image_href}", compress_type=zipfile.ZIP_STORED)
+            zf.writestr(f"OEBPS/{page_href}", _page_xhtml(title, f"../{image_href}", width, height))
+
+            image_props = ' properties="cover-image"' if index == 1 else ""
+            manifest.append(f'<item id="img{index}" href="{image_href}" media-type="{media_type}"{image_props}/>')
+            manifest.append(f'<item id="page{index}" href="{page_href}" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="page{index}"/>')
+            nav_points.append((index, page_href))
+
+        nav_items = "".join(f'<li><a href="{href}">Page {i}</a></li>' for i, href in nav_points)
+        zf.writestr(
+            "OEBPS/nav.xhtml",
+            '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+            f"<head><title>{escape(title)}</title></head>\n"
+            f'<body><nav epub:type="toc"><ol>{nav_items}</ol></nav></body>\n</html>\n',
+        )
+        ncx_points = "".join(
+            f'<navPoint id="np{i}" playOrder="{i}"><navLabel><text>Page {i}</text></navLabel>'
+            f'<content src="{href}"/></navPoint>'
+            for i, href in nav_points
+        )
+        zf.writestr(
+            "OEBPS/toc.ncx",
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            f'<head><meta name="dtb:uid" content="{book_id}"/></head>'
+            f"<docTitle><text>{escape(title)}</text></docTitle>"
+            f"<navMap>{ncx_points}</navMap></ncx>\n",
+        )
+        width, height = first_size
+        zf.writestr(
+            "OEBPS/content.opf",
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid" '
+            'prefix="rendition: http://www.idpf.org/vocab/rendition/#">\n'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">'
+            f'<dc:identifier id="bookid">{book_id}</dc:identifier>'
+            f"<dc:title>{escape(title)}</dc:title>"
+            f"<dc:creator>{escape(author)}</dc:creator>"
+            f"<dc:language>{escape(language)}</dc:language>"
+            f'<meta property="dcterms:modified">{modified}</meta>'
+            '<meta property="rendition:layout">pre-paginated</meta>'
+            '<meta property="rendition:spread">none</meta>'
+            '<meta name="cover" content="img1"/>'
+            '<meta name="fixed-layout" content="true"/>'
+            f'<meta name="original-resolution" content="{width}x{height}"/>'
+            '<meta name="book-type" content="comic"/>'
+            "</metadata>\n"
+            '<manifest><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+            '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+            f'{"".join(manifest)}</manifest>\n'
+            f'<spine toc="ncx">{"".join(spine)}</spine>\n'
+            "</package>\n",
+        )
+    logger.info(f"Packaged {len(image_files)} pages into {output_path}")
+    return output_path
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedArtifact:
+    path: str
+    filename: str
+    meta: dict
+
+
+def make_key(content_id: str, params: dict) -> str:
+    """
+    Ключ кэша: идентификатор содержимого (file_unique_id или SHA-256) плюс параметры конвертации.
+    """
+    payload = json.dumps({"content": content_id, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def sha256_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConversionCache:
+    """
+    Кэш готовых EPUB/PDF с метаданными на диске, с ограничением объёма и вытеснением LRU.
+    :param cache_dir: каталог для артефактов и индекса
+    :param max_bytes: максимальный суммарный размер артефактов
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 2 * 1024 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.cache_dir / "index.db", check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts ("
+            "key TEXT PRIMARY KEY, file TEXT NOT NULL, filename TEXT NOT NULL, "
+            "meta TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS artifacts_last_used ON artifacts (last_used)")
+        self._conn.commit()
+
+    def get(self, key: str) -> CachedArtifact | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file, filename, meta FROM artifacts WHERE key = ?", (key,)
+            ).fetchone()
+            if not row:
+                return None
+            path = self.cache_dir / row[0]
+            if not path.exists():
+                self._conn.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE artifacts SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return CachedArtifact(str(path), row[1], json.loads(row[2]))
+
+    def put(self, key: str, path: str, filename: str, meta: dict, aliases: tuple[str, ...] = ()):
+        """
+        :param aliases: дополнительные ключи того же артефакта (например, по file_unique_id и по SHA-256);
+            файл хранится один раз, его объём учитывается на основном ключе
+        """
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            logger.info(f"Not caching {filename}: {size} bytes exceeds cache budget")
+            return
+        stored_name = key + Path(filename).suffix.lower()
+        tmp_path = self.cache_dir / (stored_name + ".part")
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, self.cache_dir / stored_name)
+        with self._lock:
+            self._conn.execute(
+                "REPLACE INTO artifacts (key, file, filename, meta, size, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, stored_name, filename, json.dumps(meta), size, time.time()),
+            )
+            self._conn.executemany(
+                "REPLACE INTO artifacts (key, file, filename, meta, size, last_used) VALUES (?, ?, ?, ?, 0, ?)",
+                [(alias, stored_name, filename, json.dumps(meta), time.time()) for alias in aliases if alias != key],
+            )
+            self._conn.commit()
+            self._evict()
+
+    def total_size(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Вытесняем файлы целиком, вместе со всеми ключами, которые на них ссылаются
+        rows = self._conn.execute(
+            "SELECT file, SUM(size) FROM artifacts GROUP BY file ORDER BY MAX(last_used)"
+        ).fetchall()
+        for stored_name, size in rows:
+            if total <= self.max_bytes:
+                break
+            try:
+                (self.cache_dir / stored_name).unlink()
+            except FileNotFoundError:
+                pass
+            self._conn.execute("DELETE FROM artifacts WHERE file = ?", (stored_name,))
+            total -= size
+            logger.info(f"Evicted cached artifact {stored_name} ({size} bytes)")
+        self._conn.commit()
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+# Сколько первых байт нужно для определения формата (у EPUB mimetype лежит по смещению 30)
+HEAD_BYTES = 4096
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+def _too_large(size: int, max_bytes: int) -> DownloadTooLarge:
+    return DownloadTooLarge(f"File is larger than the {max_bytes / 1e6:.0f} MB left for this job ({size / 1e6:.0f} MB so far)")
+
+
+@dataclass
+class Download:
+    path: str
+    size: int
+    sha256: str
+    # Формат по сигнатуре: "zip", "epub", "rar", "pdf", "fb2" или None
+    kind: str | None
+
+
+def sniff(head: bytes) -> str | None:
+    """Определяет формат по первым байтам файла, не доверяя расширению."""
+    if head.startswith(b"PK\x03\x04"):
+        return "epub" if head[30:58] == b"mimetypeapplication/epub+zip" else "zip"
+    if head.startswith((b"Rar!\x1a\x07\x00", b"Rar!\x1a\x07\x01\x00")):
+        return "rar"
+    if head.startswith(b"%PDF-"):
+        return "pdf"
+    if b"<FictionBook" in head:
+        return "fb2"
+    return None
+
+
+class _Digest:
+    """SHA-256 и первые байты файла, которые накапливаются по мере чтения или записи."""
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.head = b""
+        self.size = 0
+
+    def update(self, chunk: bytes):
+        self.sha256.update(chunk)
+        if len(self.head) < HEAD_BYTES:
+            self.head += chunk[:HEAD_BYTES - len(self.head)]
+        self.size += len(chunk)
+
+    def result(self, path: str) -> Download:
+        return Download(path, self.size, self.sha256.hexdigest(), sniff(self.head))
+
+
+def _hash_file(source: str, copy_to: str | None = None) -> _Digest:
+    digest = _Digest()
+    with open(source, "rb") as src:
+        dst = open(copy_to, "wb") if copy_to else None
+        try:
+            while chunk := src.read(1024 * 1024):
+                digest.update(chunk)
+                if dst:
+                    dst.write(chunk)
+        finally:
+            if dst:
+                dst.close()
+    return digest
+
+
+def pick_up_local(source: str, path: str, max_bytes: int | None = None) -> Download:
+    """
+    Забирает файл, который локальный Bot API сервер уже сохранил на общий том: жёсткая ссылка
+    вместо копирования. Если ссылку создать нельзя (другая файловая система), файл копируется.
+    Перед правкой такого файла на месте нужен unshare(). Блокирующий вызов, выполнять в пуле потоков.
+    :param max_bytes: лимит для копии (ссылка места не занимает)
+    """
+    try:
+        os.link(source, path)
+    except OSError as e:
+        size = os.path.getsize(source)
+        if max_bytes is not None and size > max_bytes:
+            raise _too_large(size, max_bytes)
+        logger.info(f"Cannot hard-link {source} ({e}), copying")
+        return _hash_file(source, copy_to=path).result(path)
+    return _hash_file(path).result(path)
+
+
+def unshare(path: str):
+    """Если у файла есть другие жёсткие ссылки, заменяет его собственной копией, чтобы правка на месте их не задела."""
+    if os.stat(path).st_nlink < 2:
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class Downloader:
+    """
+    Скачивает файлы Telegram потоком: SHA-256 и сигнатура формата считаются на лету,
+    поэтому кешу и определению формата не нужен второй проход по файлу.
+    Файлы локального Bot API сервера (file_path — путь, а не URL) не копируются, см. pick_up_local.
+    """
+
+    def __init__(self, timeout: float = 60, chunk_size: int = CHUNK_SIZE):
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._client: httpx.AsyncClient | None = None
+
+    async def fetch(self, file_path: str, path: str, max_bytes: int | None = None) -> Download:
+        """
+        :param file_path: File.file_path из getFile: URL или путь на диске в локальном режиме
+        :param path: куда сохранить файл
+        :param max_bytes: сколько байт можно записать; больше — DownloadTooLarge, не дожидаясь конца скачивания
+        """
+        # Остаток прошлой попытки может быть жёсткой ссылкой: запись поверх него испортила бы файл сервера
+        if os.path.lexists(path):
+            os.unlink(path)
+        if not file_path.startswith(("http://", "https://")):
+            return await asyncio.to_thread(pick_up_local, file_path, path, max_bytes)
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        digest = _Digest()
+        try:
+            async with self._client.stream("GET", file_path) as response:
+                response.raise_for_status()
+                length = int(response.headers.get("content-length") or 0)
+                if max_bytes is not None and length > max_bytes:
+                    raise _too_large(length, max_bytes)
+                with open(path, "wb") as f:
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        digest.update(chunk)
+                        if max_bytes is not None and digest.size > max_bytes:
+                            raise _too_large(digest.size, max_bytes)
+                        f.write(chunk)
+        except BaseException:
+            if os.path.exists(path):
+                os.unlink(path)
+            raise
+        return digest.result(path)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
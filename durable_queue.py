@@ -0,0 +1,277 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from pipeline import QueueFull
+
+logger = logging.getLogger(__name__)
+
+# Причина, с которой помечается failed задача, владельцы которой max_attempts раз не успели её закончить
+LEASE_EXPIRED = "lease expired too many times"
+
+
+@dataclass
+class LeasedJob:
+    id: int
+    payload: dict
+    attempts: int
+
+
+class DurableQueue:
+    """
+    Очередь задач в SQLite (WAL) на общем томе: из неё забирают задачи несколько процессов или контейнеров.
+    Забранная задача арендуется на lease секунд; владелец продлевает аренду, а если процесс умер,
+    задача по истечении аренды снова становится доступной. После max_attempts попыток задача помечается failed.
+    Порядок выдачи — справедливая очередь по пользователям, как у scheduler.FairQueue: виртуальное время
+    окончания хранится в строке задачи, виртуальные часы — в таблице fair_clock.
+    """
+
+    def __init__(self, db_path: str, lease: float = 60, max_attempts: int = 3, per_user: int = 2):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.per_user = per_user
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'queued', "
+            "attempts INTEGER NOT NULL DEFAULT 0, owner TEXT, lease_expires REAL, error TEXT, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        # Очереди, созданные до справедливого планировщика, дополняются новыми колонками
+        for column, ddl in (
+            ("user_id", "INTEGER NOT NULL DEFAULT 0"),
+            ("cost", "REAL NOT NULL DEFAULT 1"),
+            ("finish", "REAL NOT NULL DEFAULT 0"),
+            ("lane", "INTEGER NOT NULL DEFAULT 1"),
+        ):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {ddl}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_fair ON jobs (status, lane, finish, id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS fair_clock (id INTEGER PRIMARY KEY CHECK (id = 0), virtual REAL NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO fair_clock (id, virtual) VALUES (0, 0)")
+
+    def _write(self, func, *args):
+        # BEGIN IMMEDIATE сразу берёт блокировку записи, поэтому два процесса не заберут одну задачу
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+                self._conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, payload: dict, max_queued: int | None = None, user: int = 0,
+                cost: float = 1.0, priority: bool = False) -> tuple[int, int, float]:
+        """
+        Добавляет задачу; при переполнении бросает QueueFull.
+        :param cost: оценка длительности задачи в секундах
+        :param priority: приоритетная полоса (задачи администратора)
+        :return: (id, позиция в очереди, оценка работы перед задачей в секундах)
+        """
+        def insert():
+            queued = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if max_queued is not None and queued >= max_queued:
+                raise QueueFull(f"Job queue is full ({max_queued} jobs)")
+            virtual = self._conn.execute("SELECT virtual FROM fair_clock").fetchone()[0]
+            user_finish = self._conn.execute(
+                "SELECT MAX(finish) FROM jobs WHERE user_id = ? AND status IN ('queued', 'leased')", (user,)
+            ).fetchone()[0]
+            finish = max(virtual, user_finish or 0.0) + cost
+            lane = 0 if priority else 1
+            now = time.time()
+            cur = self._conn.execute(
+                "INSERT INTO jobs (payload, user_id, cost, finish, lane, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (json.dumps(payload), user, cost, finish, lane, now, now),
+            )
+            ahead, ahead_cost = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(cost), 0) FROM jobs "
+                "WHERE status = 'queued' AND (lane, finish, id) < (?, ?, ?)",
+                (lane, finish, cur.lastrowid),
+            ).fetchone()
+            return cur.lastrowid, ahead + 1, ahead_cost
+        return self._write(insert)
+
+    def claim(self, owner: str) -> LeasedJob | None:
+        """
+        Арендует следующую по справедливой очереди доступную задачу, включая задачи с истёкшей арендой.
+        Задачи пользователя, у которого уже per_user задач в работе, пропускаются.
+        """
+        def take():
+            now = time.time()
+            # Задачи умерших владельцев, исчерпавшие попытки, не выдаём: их помечает failed reap()
+            row = self._conn.execute(
+                "SELECT id, payload, attempts, lane, finish FROM jobs AS j "
+                "WHERE (status = 'queued' OR (status = 'leased' AND lease_expires < ? AND attempts < ?)) "
+                "AND (SELECT COUNT(*) FROM jobs AS r WHERE r.user_id = j.user_id "
+                "AND r.status = 'leased' AND r.lease_expires >= ?) < ? "
+                "ORDER BY lane, finish, id LIMIT 1",
+                (now, self.max_attempts, now, self.per_user),
+            ).fetchone()
+            if not row:
+                return None
+            if row[3]:
+                self._conn.execute("UPDATE fair_clock SET virtual = MAX(virtual, ?)", (row[4],))
+            self._conn.execute(
+                "UPDATE jobs SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE id = ?",
+                (owner, now + self.lease, now, row[0]),
+            )
+            return LeasedJob(row[0], json.loads(row[1]), row[2] + 1)
+        return self._write(take)
+
+    def reap(self) -> list[LeasedJob]:
+        """
+        Помечает failed задачи с истёкшей арендой, исчерпавшие попытки (их обработчики раз за разом умирали),
+        и возвращает их, чтобы сообщить пользователям. Каждую задачу возвращает ровно один вызов.
+        """
+        def expire():
+            now = time.time()
+            rows = self._conn.execute(
+                "SELECT id, payload, attempts FROM jobs "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE jobs SET status = 'failed', owner = NULL, lease_expires = NULL, error = ?, updated_at = ? "
+                "WHERE id = ?",
+                [(LEASE_EXPIRED, now, row[0]) for row in rows],
+            )
+            return [LeasedJob(job_id, json.loads(payload), attempts) for job_id, payload, attempts in rows]
+        return self._write(expire)
+
+    def heartbeat(self, job_id: int, owner: str) -> bool:
+        """Продлевает аренду. False — аренда потеряна (задачу забрал другой процесс)."""
+        def extend():
+            now = time.time()
+            cur = self._conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND owner = ? AND status = 'leased'",
+                (now + self.lease, now, job_id, owner),
+            )
+            return cur.rowcount == 1
+        return self._write(extend)
+
+    def complete(self, job_id: int, owner: str):
+        self._write(lambda: self._conn.execute("DELETE FROM jobs WHERE id = ? AND owner = ?", (job_id, owner)))
+
+    def fail(self, job_id: int, owner: str, error: str, retry: bool = False):
+        """Возвращает задачу в очередь (если retry и попытки не исчерпаны) или помечает failed."""
+        def mark():
+            self._conn.execute(
+                "UPDATE jobs SET status = CASE WHEN ? AND attempts < ? THEN 'queued' ELSE 'failed' END, "
+                "owner = NULL, lease_expires = NULL, error = ?, updated_at = ? WHERE id = ? AND owner = ?",
+                (retry, self.max_attempts, error, time.time(), job_id, owner),
+            )
+        self._write(mark)
+
+    def position(self, job_id: int) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM jobs AS j, jobs AS me WHERE me.id = ? AND j.status = 'queued' "
+                "AND (j.lane, j.finish, j.id) <= (me.lane, me.finish, me.id)",
+                (job_id,),
+            ).fetchone()[0]
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def purge_failed(self, older_than: float = 7 * 24 * 3600):
+        self._write(lambda: self._conn.execute(
+            "DELETE FROM jobs WHERE status = 'failed' AND updated_at < ?", (time.time() - older_than,)
+        ))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class QueueConsumer:
+    """
+    Забирает задачи из DurableQueue и выполняет их handler'ом в workers параллельных корутинах.
+    Пока задача выполняется, аренда продлевается; если аренда потеряна, задача отменяется,
+    чтобы её не выполняли два процесса одновременно. О задачах, которые окончательно не выполнены
+    (handler бросил исключение или попытки исчерпаны истечением аренды), сообщает on_failed(задача, причина).
+    """
+
+    def __init__(self, queue: DurableQueue, handler: Callable[[dict], Awaitable[None]],
+                 workers: int = 4, poll_interval: float = 1.0,
+                 on_failed: Callable[[LeasedJob, str], Awaitable[None]] | None = None):
+        self.queue = queue
+        self.handler = handler
+        self.on_failed = on_failed
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.in_flight = 0
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self):
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(f"{self.owner}:{i}"), name=f"queue-consumer-{i}"))
+        logger.info(f"Queue consumer {self.owner} started with {self.workers} workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _heartbeat(self, job: LeasedJob, owner: str, task: asyncio.Task):
+        while True:
+            await asyncio.sleep(self.queue.lease / 3)
+            if not await asyncio.to_thread(self.queue.heartbeat, job.id, owner):
+                logger.warning(f"Lost lease on job {job.id}, cancelling it")
+                task.cancel()
+                return
+
+    async def _report(self, job: LeasedJob, error: str):
+        if not self.on_failed:
+            return
+        try:
+            await self.on_failed(job, error)
+        except Exception:
+            logger.exception(f"Failed to report failed job {job.id}")
+
+    async def _worker(self, owner: str):
+        while True:
+            for expired in await asyncio.to_thread(self.queue.reap):
+                logger.warning(f"Queued job {expired.id} failed: {LEASE_EXPIRED} ({expired.attempts} attempts)")
+                await self._report(expired, LEASE_EXPIRED)
+            job = await asyncio.to_thread(self.queue.claim, owner)
+            if not job:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            self.in_flight += 1
+            task = asyncio.create_task(self.handler(job.payload))
+            heartbeat = asyncio.create_task(self._heartbeat(job, owner, task))
+            try:
+                await task
+                await asyncio.to_thread(self.queue.complete, job.id, owner)
+            except asyncio.CancelledError:
+                # _heartbeat завершается сам только при потере аренды; иначе останавливают потребителя,
+                # и задача вернётся в очередь по истечении аренды
+                if not (heartbeat.done() and not heartbeat.cancelled()):
+                    task.cancel()
+                    raise
+            except Exception as e:
+                logger.exception(f"Queued job {job.id} failed")
+                await asyncio.to_thread(self.queue.fail, job.id, owner, str(e))
+                await self._report(job, str(e))
+            finally:
+                heartbeat.cancel()
+                self.in_flight -= 1
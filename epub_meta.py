@@ -0,0 +1,264 @@
+import io
+import mimetypes
+import os
+import posixpath
+import re
+import struct
+import tempfile
+import uuid
+import xml.etree.ElementTree as ET
+import zipfile
+from pathlib import Path
+
+CONTAINER_PATH = "META-INF/container.xml"
+NS = {
+    "container": "urn:oasis:names:tc:opendocument:xmlns:container",
+    "opf": "http://www.idpf.org/2007/opf",
+    "dc": "http://purl.org/dc/elements/1.1/",
+}
+OPF = "{%s}" % NS["opf"]
+DC = "{%s}" % NS["dc"]
+
+
+class EpubMetadataError(Exception):
+    pass
+
+
+# Префиксы при записи OPF, иначе ElementTree перепишет их как ns0, ns1... Регистрация глобальная,
+# поэтому один раз при импорте, а не из рабочих потоков. OPF — пространство имён по умолчанию, как в исходных
+# файлах; атрибуты opf:role/opf:scheme без префикса потеряли бы namespace, их пишет _prefix_opf_attributes.
+for _prefix, _uri in (
+    ("", NS["opf"]),
+    ("dc", NS["dc"]),
+    ("dcterms", "http://purl.org/dc/terms/"),
+    ("xsi", "http://www.w3.org/2001/XMLSchema-instance"),
+    ("calibre", "http://calibre.kovidgoyal.net/2009/metadata"),
+):
+    ET.register_namespace(_prefix, _uri)
+
+# EPUB3: тип идентификатора задаётся префиксом значения и <meta refines>, а не атрибутом opf:scheme
+IDENTIFIER_PREFIXES = {"ISBN": "urn:isbn:", "AMAZON": "amazon:"}
+# ONIX codelist 5: 02 — ISBN-10, 15 — ISBN-13
+ONIX_ISBN_TYPES = {10: "02", 13: "15"}
+
+
+def _prefix_opf_attributes(root: ET.Element):
+    """Атрибуты из пространства имён OPF записываются с явным префиксом opf:, объявленным в корне."""
+    prefixed = False
+    for element in root.iter():
+        for key in [k for k in element.attrib if k.startswith(OPF)]:
+            element.set("opf:" + key[len(OPF):], element.attrib.pop(key))
+            prefixed = True
+    if prefixed:
+        root.set("xmlns:opf", NS["opf"])
+
+
+def _opf_path(zf: zipfile.ZipFile) -> str:
+    try:
+        container = ET.fromstring(zf.read(CONTAINER_PATH))
+    except (KeyError, ET.ParseError) as e:
+        raise EpubMetadataError(f"Invalid EPUB container: {e}")
+    rootfile = container.find(".//container:rootfile", NS)
+    if rootfile is None or not rootfile.get("full-path"):
+        raise EpubMetadataError("EPUB container has no rootfile")
+    return rootfile.get("full-path")
+
+
+def _load_opf(zf: zipfile.ZipFile) -> tuple[str, bytes, ET.Element]:
+    opf_path = _opf_path(zf)
+    try:
+        data = zf.read(opf_path)
+        return opf_path, data, ET.fromstring(data)
+    except (KeyError, ET.ParseError) as e:
+        raise EpubMetadataError(f"Invalid OPF {opf_path}: {e}")
+
+
+def _member_info(info: zipfile.ZipInfo) -> zipfile.ZipInfo:
+    # Новый ZipInfo, чтобы не портить header_offset у читаемого архива
+    clone = zipfile.ZipInfo(info.filename, info.date_time)
+    clone.compress_type = info.compress_type
+    clone.external_attr = info.external_attr
+    clone.file_size = info.file_size
+    return clone
+
+
+def _copy_raw(zin: zipfile.ZipFile, info: zipfile.ZipInfo, zout: zipfile.ZipFile):
+    """Копирует член архива в сжатом виде, без распаковки и повторного сжатия."""
+    zin.fp.seek(info.header_offset)
+    header = zin.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise EpubMetadataError(f"Bad local header for {info.filename}")
+    name_length, extra_length = struct.unpack(zipfile.structFileHeader, header)[-2:]
+    zin.fp.seek(name_length + extra_length, os.SEEK_CUR)
+    clone = _member_info(info)
+    clone.CRC = info.CRC
+    clone.compress_size = info.compress_size
+    # Размеры и CRC пишутся в локальный заголовок, дескриптор данных после них не нужен
+    clone.flag_bits = info.flag_bits & ~0x08
+    clone.header_offset = zout.fp.tell()
+    zout.fp.write(clone.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        chunk = zin.fp.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise EpubMetadataError(f"Truncated member {info.filename}")
+        zout.fp.write(chunk)
+        remaining -= len(chunk)
+    zout.filelist.append(clone)
+    zout.NameToInfo[clone.filename] = clone
+    zout.start_dir = zout.fp.tell()
+    # Центральный каталог записывается при close() только после изменений
+    zout._didModify = True
+
+
+def split_authors(authors: str) -> list[str]:
+    return [a.strip() for a in re.split(r"\s*&\s*", authors) if a.strip()]
+
+
+def read_metadata(epub_path: str) -> dict:
+    """
+    Читает название и авторов из OPF без запуска ebook-meta.
+    :return: {"title": ..., "authors": "Автор 1 & Автор 2"}
+    """
+    try:
+        with zipfile.ZipFile(epub_path) as zf:
+            _, _, root = _load_opf(zf)
+    except zipfile.BadZipFile as e:
+        raise EpubMetadataError(f"Not a zip archive: {e}")
+    metadata = root.find(f"{OPF}metadata")
+    if metadata is None:
+        return {}
+    meta = {}
+    title = metadata.find(f"{DC}title")
+    if title is not None and title.text:
+        meta["title"] = title.text.strip()
+    creators = [c.text.strip() for c in metadata.findall(f"{DC}creator") if c.text and c.text.strip()]
+    if creators:
+        meta["authors"] = " & ".join(creators)
+    return meta
+
+
+def _set_identifier(metadata: ET.Element, scheme: str, value: str, epub3: bool):
+    scheme_attr = f"{OPF}scheme"
+    if not epub3:
+        for identifier in metadata.findall(f"{DC}identifier"):
+            if (identifier.get(scheme_attr) or "").upper() == scheme:
+                identifier.text = value
+                return
+        identifier = ET.SubElement(metadata, f"{DC}identifier", {scheme_attr: scheme})
+        identifier.text = value
+        return
+    prefix = IDENTIFIER_PREFIXES[scheme]
+    for identifier in metadata.findall(f"{DC}identifier"):
+        if (identifier.text or "").strip().lower().startswith(prefix) or \
+                (identifier.get(scheme_attr) or "").upper() == scheme:
+            identifier.attrib.pop(scheme_attr, None)
+            break
+    else:
+        identifier = ET.SubElement(metadata, f"{DC}identifier")
+    identifier.text = prefix + value
+    if not identifier.get("id"):
+        identifier.set("id", f"{scheme.lower()}-{uuid.uuid4().hex[:8]}")
+    refines = f"#{identifier.get('id')}"
+    for meta in metadata.findall(f"{OPF}meta[@refines='{refines}'][@property='identifier-type']"):
+        metadata.remove(meta)
+    meta = ET.SubElement(metadata, f"{OPF}meta", {"refines": refines, "property": "identifier-type"})
+    onix = ONIX_ISBN_TYPES.get(len(re.sub(r"[^0-9Xx]", "", value))) if scheme == "ISBN" else None
+    if onix:
+        meta.set("scheme", "onix:codelist5")
+        meta.text = onix
+    else:
+        meta.text = scheme
+
+
+def _set_cover(root: ET.Element, metadata: ET.Element, opf_dir: str, cover_path: str) -> tuple[str, bytes]:
+    """Прописывает обложку в OPF и возвращает (путь внутри архива, данные)."""
+    manifest = root.find(f"{OPF}manifest")
+    if manifest is None:
+        raise EpubMetadataError("OPF has no manifest")
+    media_type = mimetypes.guess_type(cover_path)[0] or "image/jpeg"
+    item = None
+    cover_meta = metadata.find(f"{OPF}meta[@name='cover']")
+    if cover_meta is not None:
+        item = manifest.find(f"{OPF}item[@id='{cover_meta.get('content')}']")
+    if item is None:
+        item = next((i for i in manifest.findall(f"{OPF}item") if "cover-image" in (i.get("properties") or "").split()), None)
+    if item is None:
+        item_id = f"cover-{uuid.uuid4().hex[:8]}"
+        item = ET.SubElement(manifest, f"{OPF}item", {
+            "id": item_id,
+            "href": "cover" + (Path(cover_path).suffix.lower() or ".jpg"),
+        })
+        if root.get("version", "").startswith("3"):
+            item.set("properties", "cover-image")
+    if cover_meta is None:
+        cover_meta = ET.SubElement(metadata, f"{OPF}meta", {"name": "cover"})
+    cover_meta.set("content", item.get("id"))
+    item.set("media-type", media_type)
+    with open(cover_path, "rb") as f:
+        return posixpath.normpath(posixpath.join(opf_dir, item.get("href"))), f.read()
+
+
+def update_metadata(epub_path: str, title: str | None = None, authors: str | None = None,
+                    isbn: str | None = None, asin: str | None = None, cover_path: str | None = None):
+    """
+    Правит OPF внутри EPUB за один проход: перезаписывается только OPF (и обложка),
+    остальные файлы копируются в сжатом виде без пересжатия.
+    :param authors: авторы через " & ", как у ebook-meta --authors
+    :param asin: ASIN; префикс "amazon:" отбрасывается
+    """
+    try:
+        zin = zipfile.ZipFile(epub_path)
+    except zipfile.BadZipFile as e:
+        raise EpubMetadataError(f"Not a zip archive: {e}")
+    with zin:
+        opf_path, _, root = _load_opf(zin)
+        epub3 = root.get("version", "").startswith("3")
+        metadata = root.find(f"{OPF}metadata")
+        if metadata is None:
+            raise EpubMetadataError("OPF has no metadata element")
+
+        if title:
+            element = metadata.find(f"{DC}title")
+            if element is None:
+                element = ET.SubElement(metadata, f"{DC}title")
+            element.text = title
+        if authors:
+            creators = metadata.findall(f"{DC}creator")
+            for creator in creators:
+                metadata.remove(creator)
+            for name in reversed(split_authors(authors)):
+                creator = ET.Element(f"{DC}creator")
+                creator.text = name
+                if not epub3:
+                    creator.set(f"{OPF}role", "aut")
+                metadata.insert(0, creator)
+        if isbn:
+            _set_identifier(metadata, "ISBN", isbn, epub3)
+        if asin:
+            _set_identifier(metadata, "AMAZON", asin.removeprefix("amazon:"), epub3)
+        replaced = {}
+        if cover_path:
+            cover_member, cover_data = _set_cover(root, metadata, posixpath.dirname(opf_path), cover_path)
+            replaced[cover_member] = cover_data
+
+        _prefix_opf_attributes(root)
+        buf = io.BytesIO()
+        ET.ElementTree(root).write(buf, encoding="utf-8", xml_declaration=True)
+        replaced[opf_path] = buf.getvalue()
+
+        fd, tmp_path = tempfile.mkstemp(suffix=".epub", dir=os.path.dirname(os.path.abspath(epub_path)))
+        os.close(fd)
+        try:
+            with zipfile.ZipFile(tmp_path, "w") as zout:
+                for info in zin.infolist():
+                    if info.filename in replaced:
+                        zout.writestr(_member_info(info), replaced.pop(info.filename))
+                    else:
+                        _copy_raw(zin, info, zout)
+                for name, member_data in replaced.items():
+                    zout.writestr(name, member_data, compress_type=zipfile.ZIP_STORED)
+            os.replace(tmp_path, epub_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
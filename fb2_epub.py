@@ -0,0 +1,377 @@
+import base64
+import binascii
+import logging
+import re
+import uuid
+import xml.etree.ElementTree as ET
+import zipfile
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape, quoteattr
+
+logger = logging.getLogger(__name__)
+
+FB2 = "{http://www.gribuser.ru/xml/fictionbook/2.0}"
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+# Прозрачный GIF 1x1 вместо изображений, на которые есть ссылка, но нет <binary>
+PLACEHOLDER_GIF = base64.b64decode("R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7")
+
+STYLESHEET = (
+    "body{margin:0 2%}p{margin:0;text-indent:1.5em;text-align:justify}"
+    "h1,h2,h3,h4,h5,h6{text-align:center;text-indent:0;margin:1em 0 .5em}"
+    ".subtitle,.text-author{text-align:center;text-indent:0}.text-author{font-style:italic}"
+    "blockquote{margin:1em 0 1em 10%}.poem{margin:1em 0 1em 10%}.stanza{margin-bottom:1em}"
+    ".v{text-indent:0}img{max-width:100%}.image{text-align:center;text-indent:0}"
+    "table{border-collapse:collapse}td,th{border:1px solid;padding:.2em}"
+)
+
+# Простые элементы FB2, у которых есть прямой аналог в XHTML
+INLINE_TAGS = {
+    "emphasis": "em", "strong": "strong", "strikethrough": "del", "sub": "sub", "sup": "sup", "code": "code",
+}
+BLOCK_TAGS = {
+    "epigraph": ("blockquote", "epigraph"), "cite": ("blockquote", "cite"), "annotation": ("div", "annotation"),
+    "poem": ("div", "poem"), "stanza": ("div", "stanza"), "section": ("div", "section"),
+    "table": ("table", None), "tr": ("tr", None),
+}
+# Внутри этих элементов <image> — строчная картинка, в остальных — отдельный блок
+INLINE_PARENTS = {"p", "v", "subtitle", "text-author", "a", "td", "th", *INLINE_TAGS}
+
+
+class Fb2Error(Exception):
+    pass
+
+
+def _local(tag) -> str:
+    # Комментарии и инструкции обработки имеют нестроковый tag
+    return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+
+
+def _text(element: ET.Element | None) -> str:
+    return " ".join("".join(element.itertext()).split()) if element is not None else ""
+
+
+def _image_href(image_id: str) -> str:
+    return "images/" + re.sub(r"[^A-Za-z0-9._-]", "_", image_id)
+
+
+class _Writer:
+    """Превращает элементы FB2 в XHTML и пишет главы в EPUB по мере разбора."""
+
+    def __init__(self, zf: zipfile.ZipFile, title: str):
+        self.zf = zf
+        self.title = title
+        self.chapters: list[str] = []
+        self.toc: list[tuple[str, str]] = []
+        # id элемента -> файл главы, чтобы ссылки внутри книги вели в нужный файл
+        self.anchors: dict[str, str] = {}
+        self.images_used: set[str] = set()
+        self.notes_file = "notes.xhtml"
+        self._current = ""
+        self._numbered = 0
+        # Главы со ссылками вперёд ждут конца разбора, когда станет известно, где цели
+        self._deferred: list[tuple[str, str]] = []
+        self._unresolved = False
+
+    def _attrs(self, element: ET.Element, html_class: str | None = None) -> str:
+        attrs = ""
+        element_id = element.get("id")
+        if element_id:
+            attrs += f" id={quoteattr(element_id)}"
+            self.anchors[element_id] = self._current
+        if html_class:
+            attrs += f' class="{html_class}"'
+        return attrs
+
+    def _children(self, element: ET.Element, depth: int) -> str:
+        parts = [escape(element.text or "")]
+        for child in element:
+            if _local(child.tag) == "image":
+                parts.append(self._image(child, block=_local(element.tag) not in INLINE_PARENTS))
+            else:
+                parts.append(self._render(child, depth))
+            parts.append(escape(child.tail or ""))
+        return "".join(parts)
+
+    def _image(self, element: ET.Element, block: bool) -> str:
+        href = element.get(XLINK_HREF, "")
+        if not href.startswith("#"):
+            return ""
+        image_href = _image_href(href[1:])
+        self.images_used.add(image_href)
+        img = f'<img src={quoteattr(image_href)} alt={quoteattr(element.get("alt", ""))}/>'
+        return f'<div class="image"{self._attrs(element)}>{img}</div>' if block else img
+
+    def _link(self, element: ET.Element, depth: int) -> str:
+        href = element.get(XLINK_HREF, "")
+        if href.startswith("#"):
+            target = href[1:]
+            if target in self.anchors:
+                href = f"{self.anchors[target]}{href}"
+            elif element.get("type") == "note":
+                # Сноски ведут в примечания, которые идут после основного текста
+                href = f"{self.notes_file}{href}"
+            else:
+                href = f"\0{target}\0"
+                self._unresolved = True
+        body = self._children(element, depth)
+        if element.get("type") == "note":
+            body = f"<sup>{body}</sup>"
+        return f"<a href={quoteattr(href)}>{body}</a>"
+
+    def _render(self, element: ET.Element, depth: int) -> str:
+        tag = _local(element.tag)
+        if tag in INLINE_TAGS:
+            html = INLINE_TAGS[tag]
+            return f"<{html}>{self._children(element, depth)}</{html}>"
+        if tag == "p":
+            return f"<p{self._attrs(element)}>{self._children(element, depth)}</p>"
+        if tag == "v":
+            return f"<p{self._attrs(element, 'v')}>{self._children(element, depth)}</p>"
+        if tag in ("subtitle", "text-author"):
+            return f"<p{self._attrs(element, tag)}>{self._children(element, depth)}</p>"
+        if tag == "title":
+            level = min(depth, 6)
+            lines = [self._children(p, depth) for p in element if _local(p.tag) == "p"]
+            return f"<h{level}{self._attrs(element)}>{'<br/>'.join(lines)}</h{level}>"
+        if tag == "empty-line":
+            return "<br/>"
+        if tag == "a":
+            return self._link(element, depth)
+        if tag == "image":
+            return self._image(element, block=True)
+        if tag in ("td", "th"):
+            span = "".join(f' {name}={quoteattr(element.get(name))}' for name in ("colspan", "rowspan") if element.get(name))
+            return f"<{tag}{span}>{self._children(element, depth)}</{tag}>"
+        if tag in BLOCK_TAGS:
+            html, html_class = BLOCK_TAGS[tag]
+            inner_depth = depth + 1 if tag == "section" else depth
+            return f"<{html}{self._attrs(element, html_class)}>{self._children(element, inner_depth)}</{html}>"
+        # Неизвестные элементы (в том числе из чужих пространств имён) — только содержимое
+        return self._children(element, depth)
+
+    def write_page(self, name: str, body: str):
+        self.zf.writestr(f"OEBPS/{name}", _xhtml(self.title, body))
+        self.chapters.append(name)
+
+    def write_chapter(self, elements: list[ET.Element], name: str | None = None, label: str | None = None):
+        """Записывает элементы одной главой; label или первый заголовок попадает в оглавление."""
+        if not name:
+            self._numbered += 1
+            name = f"chapter-{self._numbered:04d}.xhtml"
+        self._current = name
+        self._unresolved = False
+        body = "".join(self._render(element, 1) for element in elements)
+        if self._unresolved:
+            self._deferred.append((name, body))
+            self.chapters.append(name)
+        else:
+            self.write_page(name, body)
+        if not label:
+            for element in elements:
+                heading = element if _local(element.tag) == "title" else element.find(f"{FB2}title")
+                if heading is not None and _text(heading):
+                    label = _text(heading)
+                    break
+        if label:
+            self.toc.append((label, name))
+
+
+    def flush_deferred(self):
+        for name, body in self._deferred:
+            body = re.sub(
+                "\0([^\0]*)\0", lambda m: f"{self.anchors.get(m.group(1), self.notes_file)}#{m.group(1)}", body
+            )
+            self.zf.writestr(f"OEBPS/{name}", _xhtml(self.title, body))
+        self._deferred.clear()
+
+
+def _xhtml(title: str, body: str) -> str:
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        "<!DOCTYPE html>\n"
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+        f'<head><title>{escape(title)}</title><link rel="stylesheet" type="text/css" href="style.css"/></head>\n'
+        f"<body>{body}</body>\n</html>\n"
+    )
+
+
+def _read_description(description: ET.Element) -> dict:
+    info = description.find(f"{FB2}title-info")
+    if info is None:
+        raise Fb2Error("No <title-info> in description")
+    authors = []
+    for author in info.findall(f"{FB2}author"):
+        names = [_text(author.find(f"{FB2}{part}")) for part in ("first-name", "middle-name", "last-name")]
+        name = " ".join(n for n in names if n) or _text(author.find(f"{FB2}nickname"))
+        if name:
+            authors.append(name)
+    cover = info.find(f"{FB2}coverpage/{FB2}image")
+    return {
+        "title": _text(info.find(f"{FB2}book-title")),
+        "authors": authors,
+        "language": _text(info.find(f"{FB2}lang")) or "en",
+        "annotation": info.find(f"{FB2}annotation"),
+        "cover": (cover.get(XLINK_HREF) or "").lstrip("#") if cover is not None else "",
+        "isbn": _text(description.find(f"{FB2}publish-info/{FB2}isbn")),
+    }
+
+
+def convert_fb2(fb2_path: str, epub_path: str) -> dict:
+    """
+    Конвертирует FB2 в EPUB 3 за один потоковый проход (iterparse): каждая секция верхнего уровня
+    пишется в EPUB отдельной главой сразу после разбора и выбрасывается из памяти, <binary>
+    декодируются прямо в архив. Метаданные берутся из <title-info>.
+    Документы, которые не удаётся разобрать, вызывают Fb2Error — их нужно отдать calibre.
+    :return: {"title", "author(s)", "language", "isbn"} в формате extract_metadata
+    """
+    book_id = f"urn:uuid:{uuid.uuid4()}"
+    meta = None
+    images: dict[str, str] = {}
+    stack: list[ET.Element] = []
+    # Элементы <body> до первой секции (заголовок книги, эпиграф) — отдельной главой
+    pending: list[ET.Element] = []
+    try:
+        with zipfile.ZipFile(epub_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+            writer = None
+            for event, element in ET.iterparse(fb2_path, events=("start", "end")):
+                tag = _local(element.tag)
+                if event == "start":
+                    stack.append(element)
+                    body = stack[1] if len(stack) == 3 else None
+                    if tag == "section" and body is not None and _local(body.tag) == "body" and pending:
+                        if not body.get("name"):
+                            writer.write_chapter(pending)
+                            for done in pending:
+                                body.remove(done)
+                            pending.clear()
+                    continue
+                stack.pop()
+                parent = stack[-1] if stack else None
+                if tag == "description" and len(stack) == 1:
+                    meta = _read_description(element)
+                    writer = _Writer(zf, meta["title"] or "Untitled")
+                    if meta["cover"]:
+                        cover_href = _image_href(meta["cover"])
+                        writer.images_used.add(cover_href)
+                        writer.write_page("cover.xhtml", f'<div class="image"><img src={quoteattr(cover_href)} alt=""/></div>')
+                    if meta["annotation"] is not None:
+                        writer.write_chapter([meta["annotation"]], name="annotation.xhtml")
+                    parent.remove(element)
+                elif tag == "binary" and len(stack) == 1:
+                    content_type = element.get("content-type", "image/jpeg")
+                    href = _image_href(element.get("id", ""))
+                    try:
+                        data = base64.b64decode("".join((element.text or "").split()), validate=True)
+                    except binascii.Error as e:
+                        raise Fb2Error(f"Broken binary {element.get('id')}: {e}")
+                    zf.writestr(f"OEBPS/{href}", data, compress_type=zipfile.ZIP_STORED)
+                    images[href] = content_type
+                    parent.remove(element)
+                elif len(stack) == 2 and _local(parent.tag) == "body":
+                    if writer is None:
+                        raise Fb2Error("<body> before <description>")
+                    if tag == "section" and not parent.get("name"):
+                        writer.write_chapter([element])
+                        parent.remove(element)
+                    elif tag != "section":
+                        pending.append(element)
+                elif tag == "body" and len(stack) == 1:
+                    if element.get("name"):
+                        # Примечания — одним файлом, на него по умолчанию ведут ссылки вперёд
+                        name = writer.notes_file if writer.notes_file not in writer.chapters else None
+                        label = _text(element.find(f"{FB2}title")) or "Notes"
+                        writer.write_chapter(list(element), name=name, label=label)
+                    elif pending:
+                        writer.write_chapter(pending)
+                    pending.clear()
+                    parent.remove(element)
+            if writer is None or not writer.chapters:
+                raise Fb2Error("No text found")
+            writer.flush_deferred()
+            _write_package(zf, writer, meta, images, book_id)
+    except ET.ParseError as e:
+        raise Fb2Error(f"Malformed FB2: {e}")
+    except Fb2Error:
+        raise
+    except (KeyError, ValueError, AttributeError, TypeError, IndexError) as e:
+        raise Fb2Error(f"Unsupported FB2 structure: {e}")
+    logger.info(f"Converted FB2 natively: {epub_path}, {len(writer.chapters)} pages, {len(images)} images")
+    return {
+        "title": meta["title"],
+        "author(s)": " & ".join(meta["authors"]),
+        "language": meta["language"],
+        "isbn": meta["isbn"],
+    }
+
+
+def _write_package(zf: zipfile.ZipFile, writer: _Writer, meta: dict, images: dict[str, str], book_id: str):
+    for href in writer.images_used - images.keys():
+        logger.warning(f"FB2 references missing image {href}, using a placeholder")
+        zf.writestr(f"OEBPS/{href}", PLACEHOLDER_GIF)
+        images[href] = "image/gif"
+    cover_href = _image_href(meta["cover"]) if meta["cover"] else None
+
+    zf.writestr(
+        "META-INF/container.xml",
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+        '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+        "</rootfiles></container>\n",
+    )
+    zf.writestr("OEBPS/style.css", STYLESHEET)
+    toc = writer.toc or [(writer.title, writer.chapters[0])]
+    nav_items = "".join(f"<li><a href={quoteattr(href)}>{escape(label)}</a></li>" for label, href in toc)
+    zf.writestr(
+        "OEBPS/nav.xhtml",
+        '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+        f"<head><title>{escape(writer.title)}</title></head>\n"
+        f'<body><nav epub:type="toc"><ol>{nav_items}</ol></nav></body>\n</html>\n',
+    )
+    ncx_points = "".join(
+        f'<navPoint id="np{i}" playOrder="{i}"><navLabel><text>{escape(label)}</text></navLabel>'
+        f"<content src={quoteattr(href)}/></navPoint>"
+        for i, (label, href) in enumerate(toc, start=1)
+    )
+    zf.writestr(
+        "OEBPS/toc.ncx",
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+        f'<head><meta name="dtb:uid" content="{book_id}"/></head>'
+        f"<docTitle><text>{escape(writer.title)}</text></docTitle>"
+        f"<navMap>{ncx_points}</navMap></ncx>\n",
+    )
+
+    manifest = [
+        '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+        '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>',
+        '<item id="css" href="style.css" media-type="text/css"/>',
+    ]
+    spine = []
+    for index, name in enumerate(writer.chapters, start=1):
+        manifest.append(f'<item id="text{index}" href="{name}" media-type="application/xhtml+xml"/>')
+        spine.append(f'<itemref idref="text{index}"/>')
+    for index, (href, media_type) in enumerate(sorted(images.items()), start=1):
+        props = ' properties="cover-image"' if href == cover_href else ""
+        manifest.append(f'<item id="{"cover" if props else f"img{index}"}" href={quoteattr(href)} media-type="{media_type}"{props}/>')
+
+    modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    creators = "".join(f"<dc:creator>{escape(name)}</dc:creator>" for name in meta["authors"])
+    cover_meta = '<meta name="cover" content="cover"/>' if cover_href in images else ""
+    zf.writestr(
+        "OEBPS/content.opf",
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">\n'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">'
+        f'<dc:identifier id="bookid">{book_id}</dc:identifier>'
+        f"<dc:title>{escape(writer.title)}</dc:title>{creators}"
+        f"<dc:language>{escape(meta['language'])}</dc:language>"
+        f'<meta property="dcterms:modified">{modified}</meta>'
+        f"{cover_meta}"
+        "</metadata>\n"
+        f'<manifest>{"".join(manifest)}</manifest>\n'
+        f'<spine toc="ncx">{"".join(spine)}</spine>\n'
+        "</package>\n",
+    )
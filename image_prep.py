@@ -0,0 +1,159 @@
+import io
+import logging
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow необязателен: без него предобработка просто отключается
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class DeviceProfile:
+    width: int = 1264
+    height: int = 1680
+    grayscale: bool = True
+    quality: int = 80
+
+    @classmethod
+    def parse(cls, size: str, grayscale: bool = True, quality: int = 80) -> "DeviceProfile":
+        """Профиль из строки вида "1264x1680"."""
+        width, height = (int(v) for v in size.lower().split("x", 1))
+        return cls(width, height, grayscale, quality)
+
+    def key(self) -> str:
+        return f"{self.width}x{self.height}-{'gray' if self.grayscale else 'color'}-q{self.quality}"
+
+
+@dataclass
+class PrepResult:
+    paths: list[str]
+    bytes_before: int
+    bytes_after: int
+
+    @property
+    def saved(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def _init_worker():
+    # Сигналы остановки обрабатывает бот, он же завершает пул
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Плагины форматов Pillow регистрируются сразу, а не на первом файле
+    Image.init()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Не fork: процесс бота многопоточный, форк с захваченными блокировками небезопасен.
+        # forkserver: процессы пула форкаются из отдельного сервера, где уже импортирован этот модуль (с Pillow),
+        # вместо запуска нового интерпретатора на каждый процесс, как при spawn
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__])
+        else:
+            context = multiprocessing.get_context("spawn")
+        _executor = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=context, initializer=_init_worker)
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _prepare_one(src: str, dst: str, profile: DeviceProfile) -> tuple[str, int, int]:
+    before = os.path.getsize(src)
+    try:
+        with Image.open(src) as img:
+            img = ImageOps.exif_transpose(img)
+            img = img.convert("L" if profile.grayscale else "RGB")
+            # Только уменьшаем, с сохранением пропорций
+            img.thumbnail((profile.width, profile.height), Image.LANCZOS)
+            img.save(dst, "JPEG", quality=profile.quality, optimize=True)
+    except Exception as e:
+        logger.warning(f"Image preprocessing failed for {src}: {e}")
+        return src, before, before
+    after = os.path.getsize(dst)
+    if after >= before:
+        os.unlink(dst)
+        return src, before, before
+    return dst, before, after
+
+
+def prepare_images(image_files: list[str], out_dir: str, profile: DeviceProfile) -> PrepResult:
+    """
+    Уменьшает изображения под экран устройства, переводит в оттенки серого и пережимает в JPEG
+    параллельно на всех ядрах. Если результат не меньше исходника, остаётся исходный файл.
+    Блокирующий вызов, выполнять в пуле потоков.
+    """
+    if not available():
+        return PrepResult(list(image_files), 0, 0)
+    os.makedirs(out_dir, exist_ok=True)
+    targets = [str(Path(out_dir) / f"{i:05d}.jpg") for i in range(len(image_files))]
+    chunksize = max(1, len(image_files) // ((os.cpu_count() or 1) * 4))
+    results = list(_get_executor().map(
+        _prepare_one, image_files, targets, [profile] * len(image_files), chunksize=chunksize
+    ))
+    result = PrepResult(
+        [path for path, _, _ in results],
+        sum(before for _, before, _ in results),
+        sum(after for _, _, after in results),
+    )
+    logger.info(
+        f"Preprocessed {len(image_files)} images for {profile.key()}: "
+        f"{result.bytes_before / 1e6:.1f} MB -> {result.bytes_after / 1e6:.1f} MB"
+    )
+    return result
+
+
+def _shrink_one(data: bytes, quality: int, scale: float) -> bytes:
+    """Пережимает изображение в том же формате; PNG уменьшается и переводится в палитру."""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            fmt = img.format
+            if fmt not in ("JPEG", "PNG") or (fmt == "PNG" and scale >= 1 and img.mode in ("L", "P")):
+                # Качество на PNG без палитры не влияет, без уменьшения пережимать нечего
+                return data
+            if scale < 1:
+                img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
+            out = io.BytesIO()
+            if fmt == "JPEG":
+                img = img if img.mode in ("L", "RGB") else img.convert("RGB")
+                img.save(out, "JPEG", quality=quality, optimize=True)
+            else:
+                if img.mode not in ("L", "P"):
+                    img = img.convert("RGB").quantize(256)
+                img.save(out, "PNG", compress_level=9)
+    except Exception as e:
+        logger.warning(f"Image shrinking failed: {e}")
+        return data
+    result = out.getvalue()
+    return result if len(result) < len(data) else data
+
+
+def shrink_images(images: list[bytes], quality: int, scale: float) -> list[bytes]:
+    """
+    Пережимает изображения из памяти параллельно на всех ядрах: JPEG с качеством quality,
+    размеры умножаются на scale. Если результат не меньше исходника, остаётся исходник.
+    """
+    if not available():
+        return list(images)
+    return list(_get_executor().map(_shrink_one, images, [quality] * len(images), [scale] * len(images)))
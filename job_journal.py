@@ -0,0 +1,116 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class JournalEntry:
+    """
+    Запись журнала о задаче: исходные данные (payload) и состояние по файлам — скачанный файл,
+    готовые вложения, отправлено ли. Состояние меняется в цикле событий и сохраняется checkpoint().
+    """
+
+    def __init__(self, journal: "JobJournal", job_id: str, payload: dict, state: dict, resumes: int):
+        self.journal = journal
+        self.id = job_id
+        self.payload = payload
+        self.state = state
+        self.resumes = resumes
+
+    def file(self, index: int) -> dict:
+        return self.state.setdefault("files", {}).setdefault(str(index), {})
+
+    async def checkpoint(self, stage: str):
+        # Сериализуем здесь: в потоке словарь могли бы менять соседние задачи пачки
+        data = json.dumps(self.state)
+        await asyncio.to_thread(self.journal.save, self.id, stage, data)
+
+    def save(self, stage: str):
+        """Синхронный вариант checkpoint для рабочего потока, пока цикл событий ждёт его результата."""
+        self.journal.save(self.id, stage, json.dumps(self.state))
+
+    async def finish(self):
+        await asyncio.to_thread(self.journal.finish, self.id)
+
+
+class JobJournal:
+    """
+    Журнал задач в базе бота: запись создаётся при постановке задачи, обновляется после каждой
+    стадии и удаляется, когда задача завершена (успешно или с ошибкой, о которой сообщено пользователю).
+    Записи, оставшиеся после перезапуска, — незавершённые задачи: их продолжают с последней стадии.
+    Задачи общей очереди (durable) помечены queued: их после перезапуска снова выдаёт очередь.
+    """
+
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        # synchronous по умолчанию (FULL): отметка «отправлено» не должна теряться при сбое питания
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            "id TEXT PRIMARY KEY, payload TEXT NOT NULL, stage TEXT NOT NULL, state TEXT NOT NULL, "
+            "queued INTEGER NOT NULL DEFAULT 0, resumes INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def open(self, payload: dict, job_id: str | None = None, queued: bool = False) -> JournalEntry:
+        """Создаёт запись или, если задача с таким id уже есть (повторная выдача из очереди), возвращает её."""
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO journal (id, payload, stage, state, queued, created_at, updated_at) "
+                "VALUES (?, ?, 'queued', '{}', ?, ?, ?)",
+                (job_id, json.dumps(payload), queued, now, now),
+            )
+            self._conn.commit()
+            state, resumes = self._conn.execute("SELECT state, resumes FROM journal WHERE id = ?", (job_id,)).fetchone()
+        return JournalEntry(self, job_id, payload, json.loads(state), resumes)
+
+    def save(self, job_id: str, stage: str, state: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE journal SET stage = ?, state = ?, updated_at = ? WHERE id = ?",
+                (stage, state, time.time(), job_id),
+            )
+            self._conn.commit()
+
+    def finish(self, job_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM journal WHERE id = ?", (job_id,))
+            self._conn.commit()
+
+    def unfinished(self) -> list[JournalEntry]:
+        """Задачи этого процесса, прерванные перезапуском; счётчик возобновлений увеличивается."""
+        with self._lock:
+            self._conn.execute("UPDATE journal SET resumes = resumes + 1 WHERE NOT queued")
+            self._conn.commit()
+            rows = self._conn.execute(
+                "SELECT id, payload, stage, state, resumes FROM journal WHERE NOT queued ORDER BY created_at"
+            ).fetchall()
+        entries = []
+        for job_id, payload, stage, state, resumes in rows:
+            logger.info(f"Unfinished job {job_id} at stage {stage} (resume {resumes})")
+            entries.append(JournalEntry(self, job_id, json.loads(payload), json.loads(state), resumes))
+        return entries
+
+    def workspaces(self) -> set[str]:
+        """Рабочие каталоги незавершённых задач: уборка не должна их удалить."""
+        with self._lock:
+            rows = self._conn.execute("SELECT state FROM journal").fetchall()
+        return {name for (state,) in rows if (name := json.loads(state).get("workspace"))}
+
+    def purge(self, older_than: float = 7 * 24 * 3600):
+        """Удаляет записи, которые давно не обновлялись (например, задачи очереди, помеченные failed)."""
+        with self._lock:
+            self._conn.execute("DELETE FROM journal WHERE updated_at < ?", (time.time() - older_than,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
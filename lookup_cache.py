@@ -0,0 +1,68 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(title: str, author: str) -> str:
+    """Приводит пару (название, автор) к ключу: нижний регистр, без пунктуации и лишних пробелов."""
+    text = f"{title} | {author}".lower()
+    text = re.sub(r"[^\w|]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class LookupCache:
+    """
+    Кэш результатов поиска ISBN/ASIN в базе бота с TTL. Промахи кэшируются на меньший срок.
+    :param ttl: срок жизни найденного значения, секунды
+    :param negative_ttl: срок жизни «не найдено», секунды
+    """
+
+    def __init__(self, db_path: str, ttl: float = 30 * 24 * 3600, negative_ttl: float = 24 * 3600):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS lookups ("
+            "kind TEXT NOT NULL, query TEXT NOT NULL, value TEXT, expires REAL NOT NULL, "
+            "PRIMARY KEY (kind, query))"
+        )
+        self._conn.commit()
+
+    def _read(self, kind: str, query: str) -> tuple[bool, str | None]:
+        row = self._conn.execute(
+            "SELECT value, expires FROM lookups WHERE kind = ? AND query = ?", (kind, query)
+        ).fetchone()
+        if row and row[1] > time.time():
+            return True, row[0]
+        return False, None
+
+    def _write(self, kind: str, query: str, value: str | None):
+        expires = time.time() + (self.ttl if value else self.negative_ttl)
+        self._conn.execute(
+            "REPLACE INTO lookups (kind, query, value, expires) VALUES (?, ?, ?, ?)",
+            (kind, query, value, expires),
+        )
+        self._conn.commit()
+
+    def lookup(self, kind: str, title: str, author: str) -> tuple[bool, str | None]:
+        """Возвращает (найдено ли в кэше, значение). Значение None при найденной записи — закэшированный промах."""
+        query = normalize_query(title, author)
+        with self._lock:
+            found, value = self._read(kind, query)
+        if found:
+            logger.info(f"Lookup cache hit: {kind} '{query}' -> {value}")
+        return found, value
+
+    def store(self, kind: str, title: str, author: str, value: str | None):
+        with self._lock:
+            self._write(kind, normalize_query(title, author), value)
+
+    def purge_expired(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM lookups WHERE expires <= ?", (time.time(),))
+            self._conn.commit()
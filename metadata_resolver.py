@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import re
+
+import httpx
+
+from lookup_cache import LookupCache, normalize_query
+
+logger = logging.getLogger(__name__)
+
+BROWSER_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
+
+
+# --- Источники метаданных ---
+class Provider:
+    """
+    Источник идентификатора книги. kind — имя поля результата и раздел кэша,
+    skip_if — kind, после получения которого этот источник больше не нужен.
+    fetch() возвращает None, если ничего не найдено, и бросает исключение при сбое (сбой не кэшируется).
+    """
+    kind = ""
+    skip_if: str | None = None
+
+    async def fetch(self, client: httpx.AsyncClient, title: str, author: str) -> str | None:
+        raise NotImplementedError
+
+
+class GoogleBooksProvider(Provider):
+    kind = "isbn"
+
+    def __init__(self, url: str = "https://www.googleapis.com/books/v1/volumes"):
+        self.url = url
+
+    async def fetch(self, client: httpx.AsyncClient, title: str, author: str) -> str | None:
+        query = f"{title} {author}".strip()
+        resp = await client.get(self.url, params={"q": query})
+        resp.raise_for_status()
+        for item in resp.json().get("items", []):
+            industry_ids = item.get("volumeInfo", {}).get("industryIdentifiers", [])
+            for id_entry in industry_ids:
+                if id_entry["type"] in {"ISBN_10", "ISBN_13"}:
+                    return id_entry["identifier"]
+        return None
+
+
+class AmazonSearchProvider(Provider):
+    kind = "asin"
+    skip_if = "isbn"
+
+    def __init__(self, url: str = "https://www.amazon.com/s"):
+        self.url = url
+
+    async def fetch(self, client: httpx.AsyncClient, title: str, author: str) -> str | None:
+        query = f"{title} {author}".strip()
+        logger.info(f"Searching ASIN for: {query}")
+        resp = await client.get(self.url, params={"k": query}, headers={"User-Agent": BROWSER_USER_AGENT})
+        if resp.status_code != 200:
+            raise RuntimeError(f"Amazon search failed: HTTP {resp.status_code}")
+        matches = re.findall(r"/dp/([A-Z0-9]{10})", resp.text)
+        logger.info(f"ASIN raw matches: {matches}")
+        return matches[0] if matches else None
+
+
+# --- Резолвер ---
+class MetadataResolver:
+    """
+    Сначала смотрит в кэш, затем опрашивает недостающие источники через общий пул HTTP-соединений:
+    независимые одновременно, источник со skip_if — только если его условие не выполнилось.
+    resolve() никогда не ждёт дольше deadline: незавершённые запросы отменяются.
+    :param providers: источники, по одному на каждый kind
+    :param deadline: общий бюджет времени на один resolve(), секунды
+    :param cache: кэш результатов (см. LookupCache), необязателен
+    """
+
+    def __init__(self, providers: list[Provider], deadline: float = 8.0, cache: LookupCache | None = None):
+        self.providers = providers
+        self.deadline = deadline
+        self.cache = cache
+        self._client: httpx.AsyncClient | None = None
+        self._pending: dict[str, asyncio.Future] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.deadline),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                follow_redirects=True,
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _cached(self, title: str, author: str) -> dict[str, str | None]:
+        """Результаты из кэша по kind; None — в кэше записано, что ничего не найдено."""
+        if not self.cache:
+            return {}
+
+        def read() -> dict[str, str | None]:
+            known = {}
+            for provider in self.providers:
+                found, value = self.cache.lookup(provider.kind, title, author)
+                if found:
+                    known[provider.kind] = value
+            return known
+
+        return await asyncio.to_thread(read)
+
+    async def _fetch(self, provider: Provider, title: str, author: str) -> str | None:
+        value = await provider.fetch(self.client, title, author)
+        if self.cache:
+            await asyncio.to_thread(self.cache.store, provider.kind, title, author, value)
+        return value
+
+    async def _resolve(self, title: str, author: str) -> dict[str, str]:
+        known = await self._cached(title, author)
+        result = {kind: value for kind, value in known.items() if value}
+        waiting = [provider for provider in self.providers if provider.kind not in known]
+        running: dict[asyncio.Task, Provider] = {}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        while True:
+            # Источник со skip_if запускается, только когда его условие не выполнилось: источник
+            # этого kind ничего не нашёл или сбоил. Остальные запускаются сразу и идут параллельно.
+            unsettled = {provider.kind for provider in waiting} | {provider.kind for provider in running.values()}
+            for provider in list(waiting):
+                if provider.skip_if in result:
+                    waiting.remove(provider)
+                elif provider.skip_if not in unsettled:
+                    waiting.remove(provider)
+                    running[asyncio.create_task(self._fetch(provider, title, author))] = provider
+            if not running or loop.time() >= deadline:
+                break
+            done, _ = await asyncio.wait(running, timeout=deadline - loop.time(), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                provider = running.pop(task)
+                if task.exception():
+                    logger.warning(f"Failed to fetch {provider.kind}: {task.exception()}")
+                elif task.result():
+                    result[provider.kind] = task.result()
+        for task, provider in running.items():
+            task.cancel()
+            logger.warning(f"Metadata provider {provider.kind} exceeded {self.deadline}s deadline")
+        # Если есть ISBN, Kindle принимает его как ASIN; ASIN кэшируется рядом с ISBN
+        if result.get("isbn"):
+            asin = f"amazon:{result['isbn']}"
+            logger.info(f"Using ISBN as ASIN directly: {result['isbn']}")
+            result["asin"] = asin
+            if self.cache and known.get("asin") != asin:
+                await asyncio.to_thread(self.cache.store, "asin", title, author, asin)
+        return result
+
+    async def resolve(self, title: str, author: str) -> dict[str, str]:
+        """
+        Возвращает найденные идентификаторы, например {"isbn": ..., "asin": ...}.
+        Одновременные запросы одной и той же книги объединяются.
+        """
+        if not title and not author:
+            return {}
+        key = normalize_query(title, author)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = asyncio.ensure_future(self._resolve(title, author))
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(pending)
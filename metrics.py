@@ -0,0 +1,208 @@
+import asyncio
+import contextvars
+import logging
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+RSS_BUCKETS = tuple(mb * 1024 * 1024 for mb in (16, 32, 64, 128, 256, 512, 1024, 2048, 4096))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: tuple[str, str] | None = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# --- Типы метрик ---
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """Значение берётся из функции в момент запроса /metrics."""
+
+    def __init__(self, name: str, help_text: str, func: Callable[[], float]):
+        self.name = name
+        self.help = help_text
+        self.func = func
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.func()}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = labels
+        self.buckets = buckets
+        # labels -> [счётчики по корзинам, сумма, количество]
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            entry = self._values.setdefault(labels, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def totals(self) -> dict[tuple, tuple[float, int]]:
+        """Сумма и количество наблюдений по наборам меток."""
+        with self._lock:
+            return {labels: (total, count) for labels, (_, total, count) in self._values.items()}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, ('le', str(bound)))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, ('le', '+Inf'))} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+# --- Метрики бота ---
+STAGE_SECONDS = Histogram("kindle_stage_seconds", "Time spent in a processing stage", ("stage", "ext"))
+STAGE_TOTAL = Counter("kindle_stage_total", "Processing stage runs", ("stage", "ext", "status"))
+STAGE_WAIT_SECONDS = Histogram("kindle_stage_wait_seconds", "Time a stage call waited for a free executor slot", ("stage",))
+TOOL_CPU_SECONDS = Counter("kindle_tool_cpu_seconds_total", "CPU time (user+system) of external tool processes", ("tool",))
+TOOL_MAX_RSS = Histogram("kindle_tool_max_rss_bytes", "Peak RSS of external tool processes", ("tool",), RSS_BUCKETS)
+JOBS_TOTAL = Counter("kindle_jobs_total", "Finished jobs", ("ext", "status"))
+
+# Расширение входного файла текущей задачи, чтобы не передавать его в каждую стадию
+current_ext: contextvars.ContextVar[str] = contextvars.ContextVar("current_ext", default="")
+# Вызываются с (стадия, исключение) при ошибке стадии, в том числе из рабочих потоков
+error_listeners: list[Callable[[str, BaseException], None]] = []
+
+_registry: list = [STAGE_SECONDS, STAGE_TOTAL, STAGE_WAIT_SECONDS, TOOL_CPU_SECONDS, TOOL_MAX_RSS, JOBS_TOTAL]
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def track(stage: str, ext: str | None = None):
+    """
+    Замеряет длительность и исход стадии: with metrics.track("convert"): ...
+    Без ext берётся расширение текущей задачи из current_ext.
+    """
+    ext = current_ext.get() if ext is None else ext
+    started = time.monotonic()
+    status = "ok"
+    try:
+        yield
+    except BaseException as e:
+        status = "error"
+        if isinstance(e, Exception):
+            for listener in error_listeners:
+                try:
+                    listener(stage, e)
+                except Exception:
+                    logger.exception(f"Stage error listener failed for {stage}")
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.monotonic() - started, stage, ext)
+        STAGE_TOTAL.inc(stage, ext, status)
+
+
+def run_measured(cmd: list[str], timeout: float | None = None, **kwargs) -> subprocess.CompletedProcess:
+    """
+    Как subprocess.run(cmd, check=True, timeout=timeout), но дополнительно учитывает CPU и пиковую память
+    дочернего процесса (через wait4, без влияния на другие параллельные процессы).
+    """
+    tool = os.path.basename(cmd[0])
+    proc = subprocess.Popen(cmd, **kwargs)
+    expired = threading.Event()
+
+    def kill():
+        expired.set()
+        proc.kill()
+
+    killer = threading.Timer(timeout, kill) if timeout else None
+    if killer:
+        killer.start()
+    try:
+        # Вывод читаем до wait4, иначе процесс может заблокироваться на заполненном канале
+        output = proc.stdout.read() if proc.stdout else None
+        _, status, usage = os.wait4(proc.pid, 0)
+    finally:
+        if killer:
+            killer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    TOOL_CPU_SECONDS.inc(tool, amount=usage.ru_utime + usage.ru_stime)
+    TOOL_MAX_RSS.observe(usage.ru_maxrss * 1024, tool)
+    if expired.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout, output)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+    return subprocess.CompletedProcess(cmd, proc.returncode, output)
+
+
+# --- HTTP-эндпоинт ---
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body, status, content_type = render().encode(), "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, status, content_type = b"Not Found\n", "404 Not Found", "text/plain"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host: str, port: int) -> asyncio.AbstractServer:
+    server = await asyncio.start_server(_handle, host, port)
+    logger.info(f"Metrics endpoint on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,217 @@
+import asyncio
+import heapq
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from batching import MESSAGE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# rate_limit_args для фоновых сообщений (сводки администратору): они не занимают последние токены общего лимита
+BACKGROUND = {"background": True}
+
+
+class TokenBucket:
+    """
+    Ведро токенов: в среднем rate запросов в секунду, пачкой — до burst.
+    Все вызовы — из одного цикла событий, поэтому проверка и списание токена атомарны без блокировок.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.burst
+
+    async def acquire(self, reserve: float = 0.0):
+        """:param reserve: сколько токенов оставить другим запросам (для фоновых запросов)"""
+        while True:
+            self._refill()
+            if self._tokens >= 1 + reserve:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 + reserve - self._tokens) / self.rate)
+
+
+class RateLimiter(BaseRateLimiter[dict]):
+    """
+    Ограничитель запросов к Bot API для всего бота: ответы пользователям, правки сообщений о ходе
+    пачки и сводки администратору идут через одни и те же вёдра. Общий лимит Telegram — около 30 сообщений
+    в секунду, в один чат — около одного в секунду (в группу — 20 в минуту). Фоновые запросы
+    (rate_limit_args=BACKGROUND) оставляют в общем ведре reserve токенов для ответов пользователям.
+    На RetryAfter все запросы приостанавливаются на указанное время, запрос повторяется до max_retries раз.
+    """
+
+    def __init__(self, overall_rate: float = 30, chat_rate: float = 1.0, chat_burst: float = 3,
+                 group_rate: float = 20 / 60, reserve: float = 10, max_retries: int = 2):
+        self.overall = TokenBucket(overall_rate, overall_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.reserve = min(reserve, overall_rate - 1)
+        self.max_retries = max_retries
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._resume = asyncio.Event()
+        self._resume.set()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Полные вёдра ничем не отличаются от новых
+                self._chats = {key: b for key, b in self._chats.items() if not b.full}
+            # Отрицательный id или @username — группа или канал
+            group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    async def process_request(self, callback: Callable[..., Awaitable], args: Any, kwargs: dict[str, Any],
+                              endpoint: str, data: dict[str, Any], rate_limit_args: dict | None):
+        chat_id = data.get("chat_id")
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+        reserve = self.reserve if (rate_limit_args or {}).get("background") else 0
+        for attempt in range(self.max_retries + 1):
+            await self._resume.wait()
+            # Запросы без чата (getFile, getMe) лимиту сообщений не подлежат
+            if chat_id is not None:
+                await self.overall.acquire(reserve)
+                await self._chat(chat_id).acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Telegram flood control on {endpoint}, pausing requests for {e.retry_after}s")
+                self._resume.clear()
+                try:
+                    await asyncio.sleep(e.retry_after + 0.1)
+                finally:
+                    self._resume.set()
+
+
+class AdminNotifier:
+    """
+    Уведомления администратору без ожидания в задачах: события (загрузки, ошибки стадий, завершённые задачи)
+    копятся в памяти и раз в interval секунд уходят одной сводкой. Методы записи событий синхронные
+    и потокобезопасные: ошибки стадий приходят и из рабочих потоков.
+    """
+
+    def __init__(self, send: Callable[[str], Awaitable], interval: float = 60,
+                 queue_depth: Callable[[], int] | None = None, slowest: int = 5, max_uploads: int = 20):
+        self.send = send
+        self.interval = interval
+        self.queue_depth = queue_depth
+        self.slowest = slowest
+        self.max_uploads = max_uploads
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+        self._reset()
+
+    def _reset(self):
+        self._uploads: list[str] = []
+        self._files = 0
+        self._failures: Counter = Counter()
+        self._last_error: dict[str, str] = {}
+        self._done = 0
+        # min-куча (секунды, имя) — самые долгие задачи за период
+        self._slow: list[tuple[float, str]] = []
+        self._started = time.monotonic()
+
+    def upload(self, user: str, names: list[str]):
+        with self._lock:
+            self._files += len(names)
+            self._uploads.append(f"{user}: {', '.join(names)}")
+
+    def failure(self, stage: str, error: BaseException | str):
+        with self._lock:
+            self._failures[stage] += 1
+            self._last_error[stage] = str(error)[:200]
+
+    def finished(self, name: str, seconds: float):
+        with self._lock:
+            self._done += 1
+            if len(self._slow) < self.slowest:
+                heapq.heappush(self._slow, (seconds, name))
+            else:
+                heapq.heappushpop(self._slow, (seconds, name))
+
+    def render(self) -> str | None:
+        """Текст сводки за период и сброс счётчиков; None — за период ничего не произошло."""
+        with self._lock:
+            if not (self._uploads or self._failures or self._done):
+                return None
+            uploads, files, failures, last_error, done, slow, started = (
+                self._uploads, self._files, self._failures, self._last_error, self._done, self._slow, self._started
+            )
+            self._reset()
+        minutes = max(1, round((time.monotonic() - started) / 60))
+        lines = [f"📊 Last {minutes} min: {files} files uploaded, {done} jobs done, {sum(failures.values())} failures"]
+        if uploads:
+            lines.append("")
+            lines.append("📥 Uploads:")
+            lines += uploads[:self.max_uploads]
+            if len(uploads) > self.max_uploads:
+                lines.append(f"… and {len(uploads) - self.max_uploads} more")
+        if failures:
+            lines.append("")
+            lines.append("❌ Failures by stage:")
+            lines += [f"{stage}: {count} (last: {last_error[stage]})" for stage, count in failures.most_common()]
+        if self.queue_depth:
+            try:
+                lines += ["", f"🕒 Queue: {self.queue_depth()} waiting"]
+            except Exception as e:
+                logger.debug(f"Queue depth unavailable: {e}")
+        if slow:
+            lines.append("")
+            lines.append("🐢 Slowest: " + ", ".join(f"{name} {seconds:.0f}s" for seconds, name in sorted(slow, reverse=True)))
+        text = "\n".join(lines)
+        return text if len(text) <= MESSAGE_LIMIT else text[:MESSAGE_LIMIT - 1] + "…"
+
+    async def flush(self):
+        text = self.render()
+        if not text:
+            return
+        try:
+            await self.send(text)
+        except Exception as e:
+            logger.warning(f"Failed to send admin digest: {e}")
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run(), name="admin-notifier")
+
+    async def stop(self):
+        """Останавливает отправку по расписанию и отправляет то, что накопилось."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
@@ -0,0 +1,106 @@
+import logging
+import os
+import re
+from dataclasses import dataclass
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# Хвост предыдущего куска, чтобы не потерять совпадение на границе
+OVERLAP = 64
+PAGE_RE = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+COUNT_RE = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b", re.S)
+IMAGE_RE = re.compile(rb"/Subtype\s*/Image\b")
+
+
+@dataclass
+class PdfInfo:
+    size: int
+    pages: int
+    images: int
+
+    @property
+    def bytes_per_page(self) -> int:
+        return self.size // max(self.pages, 1)
+
+
+def inspect_pdf(path: str) -> PdfInfo:
+    """
+    Быстрый проход по байтам PDF без рендеринга: число страниц и изображений.
+    Страницы внутри сжатых object stream не видны, тогда берётся /Count из дерева страниц.
+    Изображения всегда хранятся отдельными потоками, поэтому считаются точно.
+    """
+    pages = images = count = 0
+    tail = b""
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            data = tail + chunk
+            # Совпадения, целиком лежащие в хвосте, уже посчитаны на прошлом шаге
+            start = len(tail)
+            pages += sum(1 for m in PAGE_RE.finditer(data) if m.end() > start)
+            images += sum(1 for m in IMAGE_RE.finditer(data) if m.end() > start)
+            for m in COUNT_RE.finditer(data):
+                count = max(count, int(m.group(1) or m.group(2)))
+            tail = data[-OVERLAP:]
+    return PdfInfo(os.path.getsize(path), max(pages, count), images)
+
+
+def compression_skip_reason(info: PdfInfo, min_size: int, min_page_bytes: int) -> str | None:
+    """Причина не запускать Ghostscript или None, если сжатие имеет смысл."""
+    if info.size < min_size:
+        return f"small file ({info.size} bytes)"
+    if not info.images:
+        return "no images"
+    if info.bytes_per_page < min_page_bytes:
+        return f"already compact ({info.bytes_per_page} bytes/page)"
+    return None
+
+
+def _gs_common(threads: int) -> list[str]:
+    return ["gs", "-dSAFER", "-dBATCH", "-dNOPAUSE", "-dQUIET", f"-dNumRenderingThreads={max(1, threads)}"]
+
+
+def compress_pdf(input_path: str, output_path: str, threads: int = 1, preset: str = "/ebook",
+                 min_size: int = 2 * 1024 * 1024, min_page_bytes: int = 64 * 1024, min_saving: float = 0.05) -> bool:
+    """
+    Сжимает PDF через Ghostscript, только если это может помочь.
+    Результат сохраняется, только если он меньше исходника хотя бы на min_saving.
+    :return: True, если нужно использовать output_path
+    """
+    info = inspect_pdf(input_path)
+    reason = compression_skip_reason(info, min_size, min_page_bytes)
+    if reason:
+        logger.info(f"Skipping PDF compression of {input_path}: {reason}")
+        return False
+    metrics.run_measured([
+        *_gs_common(threads),
+        "-sDEVICE=pdfwrite",
+        "-dCompatibilityLevel=1.4",
+        f"-dPDFSETTINGS={preset}",
+        "-dDetectDuplicateImages=true",
+        f"-sOutputFile={output_path}",
+        input_path,
+    ])
+    compressed = os.path.getsize(output_path)
+    if compressed > info.size * (1 - min_saving):
+        logger.info(f"Ghostscript did not shrink {input_path} ({info.size} -> {compressed} bytes), keeping original")
+        os.unlink(output_path)
+        return False
+    logger.info(f"PDF compressed: {info.size} -> {compressed} bytes, {info.pages} pages, {info.images} images")
+    return True
+
+
+def render_cover(pdf_path: str, cover_path: str, threads: int = 1, width: int = 600, height: int = 800):
+    """Рендерит первую страницу в JPEG размером не больше width x height за один вызов Ghostscript."""
+    metrics.run_measured([
+        *_gs_common(threads),
+        "-sDEVICE=jpeg",
+        "-dJPEGQ=85",
+        "-dFirstPage=1", "-dLastPage=1",
+        f"-g{width}x{height}", "-dPDFFitPage",
+        "-dTextAlphaBits=4", "-dGraphicsAlphaBits=4",
+        f"-sOutputFile={cover_path}",
+        pdf_path,
+    ])
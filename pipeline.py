@@ -0,0 +1,171 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, TypeVar
+
+import metrics
+from scheduler import FairQueue
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# --- Стадии обработки и их лимиты по умолчанию ---
+STAGES = ("download", "preprocess", "convert", "metadata", "deliver")
+
+DEFAULT_STAGE_LIMITS = {
+    "download": 4,
+    "preprocess": 2,
+    "convert": 2,
+    "metadata": 4,
+    "deliver": 8,
+}
+
+
+class QueueFull(Exception):
+    pass
+
+
+def stage_limits_from_env() -> dict[str, int]:
+    """
+    Читает лимиты параллельности стадий из окружения: DOWNLOAD_CONCURRENCY, CONVERT_CONCURRENCY и т.д.
+    """
+    return {
+        stage: max(1, int(os.getenv(f"{stage.upper()}_CONCURRENCY", str(default))))
+        for stage, default in DEFAULT_STAGE_LIMITS.items()
+    }
+
+
+class JobPipeline:
+    """
+    Очередь задач с отдельным пулом потоков на каждую стадию.
+    Задачи выдаются справедливо между пользователями с учётом оценки их стоимости, см. FairQueue.
+    :param limits: максимум одновременных операций на стадию
+    :param workers: сколько задач обрабатывается одновременно
+    :param max_queued: максимальная длина очереди, дальше enqueue() бросает QueueFull
+    :param per_user: сколько задач одного пользователя обрабатывается одновременно
+    """
+
+    def __init__(self, limits: dict[str, int] | None = None, workers: int = 8, max_queued: int = 100,
+                 per_user: int = 2):
+        self.limits = {**DEFAULT_STAGE_LIMITS, **(limits or {})}
+        self.workers = workers
+        self._executors = {
+            stage: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"stage-{stage}")
+            for stage, limit in self.limits.items()
+        }
+        self._slots = {stage: asyncio.Semaphore(limit) for stage, limit in self.limits.items()}
+        self._queue = FairQueue(max_queued, per_user)
+        self._tasks: list[asyncio.Task] = []
+        self._spawned: set[asyncio.Task] = set()
+        self.in_flight = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    async def run(self, stage: str, func: Callable, *args, **kwargs):
+        """Выполняет блокирующую функцию в пуле потоков стадии (с текущим contextvars-контекстом)."""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        submitted = time.monotonic()
+
+        def call():
+            metrics.STAGE_WAIT_SECONDS.observe(time.monotonic() - submitted, stage)
+            return context.run(functools.partial(func, *args, **kwargs))
+
+        return await loop.run_in_executor(self._executors[stage], call)
+
+    def slot(self, stage: str) -> asyncio.Semaphore:
+        """Семафор стадии для асинхронных операций (например, скачивания через Bot API)."""
+        return self._slots[stage]
+
+    def enqueue(self, name: str, job: Callable[[], Awaitable[None]], user: int = 0,
+                cost: float = 1.0, priority: bool = False) -> tuple[int, float]:
+        """
+        Ставит задачу в очередь и сразу возвращает её позицию и оценку работы перед ней в секундах.
+        :param cost: оценка длительности задачи в секундах
+        :param priority: приоритетная полоса (задачи администратора)
+        """
+        try:
+            return self._queue.put_nowait(name, job, user, cost, priority=priority)
+        except asyncio.QueueFull:
+            raise QueueFull(f"Job queue is full ({self._queue.max_queued} jobs)")
+
+    def preview(self, user: int, cost: float, count: int = 1, priority: bool = False) -> tuple[int, float]:
+        """
+        Позиция и оценка работы перед задачей без постановки в очередь — для пачки, файлы которой
+        встают в очередь по отдельности (call). Бросает QueueFull, если count файлов не поместятся.
+        """
+        try:
+            return self._queue.preview(user, cost, count, priority=priority)
+        except asyncio.QueueFull:
+            raise QueueFull(f"Job queue is full ({self._queue.max_queued} jobs)")
+
+    async def call(self, name: str, job: Callable[[], Awaitable[T]], user: int = 0,
+                   cost: float = 1.0, priority: bool = False) -> T:
+        """
+        Выполняет часть уже принятой задачи (файл пачки) как отдельную задачу очереди и возвращает её результат:
+        она ждёт своей очереди наравне с остальными и учитывается в лимите per_user. Длина очереди
+        не проверяется — задача принята целиком. Отмена вызывающего снимает её с очереди или прерывает.
+        """
+        started: asyncio.Future[asyncio.Future[T]] = asyncio.get_running_loop().create_future()
+
+        async def run():
+            if started.cancelled():
+                return
+            task = asyncio.ensure_future(job())
+            started.set_result(task)
+            try:
+                # Ошибку получает вызывающий, в журнал обработчика она не попадает
+                await asyncio.wait([task])
+            finally:
+                task.cancel()
+
+        self._queue.put_nowait(name, run, user, cost, priority=priority, force=True)
+        try:
+            task = await started
+        except asyncio.CancelledError:
+            self._queue.remove(run)
+            raise
+        return await task
+
+    def spawn(self, job: Awaitable[None], name: str) -> asyncio.Task:
+        """
+        Запускает задачу, которая сама обработчик не занимает, а раздаёт работу через call() (пачка):
+        иначе она держала бы обработчик и место в лимите per_user, пока ждёт свои же файлы.
+        """
+        task = asyncio.create_task(job, name=name)
+        self._spawned.add(task)
+        task.add_done_callback(self._spawned.discard)
+        return task
+
+    async def start(self):
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f"job-worker-{i}"))
+        logger.info(f"Job pipeline started: {self.workers} workers, stage limits {self.limits}")
+
+    async def stop(self):
+        tasks = [*self._spawned, *self._tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _worker(self):
+        while True:
+            ticket = await self._queue.get()
+            self.in_flight += 1
+            try:
+                await ticket.job()
+            except Exception:
+                logger.exception(f"Job {ticket.name} failed")
+            finally:
+                self.in_flight -= 1
+                self._queue.task_done(ticket)
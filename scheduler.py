@@ -0,0 +1,164 @@
+import asyncio
+import itertools
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+MB = 1024 * 1024
+# Априорная оценка до первых замеров: (секунд на задачу, секунд на мегабайт)
+DEFAULT_COSTS = {
+    ".epub": (1.0, 0.05),
+    ".txt": (3.0, 0.5),
+    ".fb2": (4.0, 0.5),
+    ".pdf": (5.0, 0.5),
+    ".zip": (5.0, 0.5),
+    ".cbz": (5.0, 0.5),
+    ".cbr": (6.0, 0.6),
+}
+FALLBACK_COST = (5.0, 0.5)
+
+
+class CostModel:
+    """
+    Оценка длительности задачи по формату и размеру: seconds ≈ a + b * MB отдельно для каждого расширения.
+    Коэффициенты подбираются по прошлым задачам методом наименьших квадратов с экспоненциальным
+    забыванием (decay на каждое наблюдение), так что модель следует за нагрузкой и железом.
+    """
+
+    def __init__(self, decay: float = 0.98, min_samples: int = 5):
+        self.decay = decay
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        # ext -> [n, Σx, Σy, Σxx, Σxy]
+        self._sums: dict[str, list[float]] = {}
+        self._samples: Counter = Counter()
+
+    def observe(self, ext: str, size: int, seconds: float):
+        x = size / MB
+        with self._lock:
+            sums = self._sums.setdefault(ext, [0.0] * 5)
+            for i, value in enumerate((1.0, x, seconds, x * x, x * seconds)):
+                sums[i] = sums[i] * self.decay + value
+            self._samples[ext] += 1
+
+    def coefficients(self, ext: str) -> tuple[float, float]:
+        base, per_mb = DEFAULT_COSTS.get(ext, FALLBACK_COST)
+        with self._lock:
+            if self._samples[ext] < self.min_samples:
+                return base, per_mb
+            n, sx, sy, sxx, sxy = self._sums[ext]
+        mean_x, mean_y = sx / n, sy / n
+        variance = sxx / n - mean_x ** 2
+        if variance > 1e-6:
+            per_mb = max(0.0, (sxy / n - mean_x * mean_y) / variance)
+        else:
+            # Все файлы одного размера: наклон не определить, оставляем априорный
+            per_mb = min(per_mb, mean_y / max(mean_x, 1e-6))
+        return max(0.1, mean_y - per_mb * mean_x), per_mb
+
+    def estimate(self, ext: str, size: int | None) -> float:
+        base, per_mb = self.coefficients(ext)
+        return base + per_mb * (size or 0) / MB
+
+
+@dataclass(order=True)
+class Ticket:
+    # Порядок выдачи: сначала приоритетная полоса, затем виртуальное время окончания, затем очередь поступления
+    lane: int
+    finish: float
+    seq: int
+    user: int = field(compare=False)
+    cost: float = field(compare=False)
+    name: str = field(compare=False)
+    job: Callable[[], Awaitable[None]] | None = field(compare=False, repr=False)
+
+
+class FairQueue:
+    """
+    Взвешенная справедливая очередь (self-clocked fair queuing): задача пользователя получает
+    виртуальное время окончания max(V, окончание его предыдущей задачи) + cost / weight,
+    выдаётся задача с наименьшим. Поэтому пачка тяжёлых задач одного пользователя не задерживает
+    лёгкие задачи остальных. Сверху — лимит одновременных задач на пользователя и приоритетная полоса.
+    Очередь короткая (max_queued), поэтому выбор — линейный проход.
+    """
+
+    def __init__(self, max_queued: int = 100, per_user: int = 2):
+        self.max_queued = max_queued
+        self.per_user = per_user
+        self._tickets: list[Ticket] = []
+        self._virtual = 0.0
+        self._user_finish: dict[int, float] = {}
+        self._running: Counter = Counter()
+        self._seq = itertools.count()
+        self._changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._tickets)
+
+    def _ticket(self, name: str, job: Callable[[], Awaitable[None]] | None, user: int,
+                cost: float, weight: float, priority: bool) -> Ticket:
+        start = max(self._virtual, self._user_finish.get(user, 0.0))
+        return Ticket(0 if priority else 1, start + cost / weight, next(self._seq), user, cost, name, job)
+
+    def _position(self, ticket: Ticket) -> tuple[int, float]:
+        ahead = [t for t in self._tickets if t < ticket]
+        return len(ahead) + 1, sum(t.cost for t in ahead)
+
+    def put_nowait(self, name: str, job: Callable[[], Awaitable[None]], user: int,
+                   cost: float, weight: float = 1.0, priority: bool = False, force: bool = False) -> tuple[int, float]:
+        """
+        Ставит задачу в очередь; при переполнении бросает asyncio.QueueFull.
+        :param force: не проверять длину очереди (часть уже принятой задачи)
+        :return: позиция в очереди и суммарная оценка задач перед ней (секунды)
+        """
+        if not force and len(self._tickets) >= self.max_queued:
+            raise asyncio.QueueFull
+        ticket = self._ticket(name, job, user, cost, weight, priority)
+        self._user_finish[user] = ticket.finish
+        position = self._position(ticket)
+        self._tickets.append(ticket)
+        self._changed.set()
+        return position
+
+    def preview(self, user: int, cost: float, count: int = 1, weight: float = 1.0,
+                priority: bool = False) -> tuple[int, float]:
+        """
+        Позиция, которую получила бы задача, без постановки в очередь; asyncio.QueueFull, если count задач не поместятся.
+        """
+        if len(self._tickets) + count > self.max_queued:
+            raise asyncio.QueueFull
+        return self._position(self._ticket("", None, user, cost, weight, priority))
+
+    def remove(self, job: Callable[[], Awaitable[None]]) -> bool:
+        """Снимает с очереди ещё не выданную задачу; False — её уже выдали."""
+        for ticket in self._tickets:
+            if ticket.job is job:
+                self._tickets.remove(ticket)
+                if not any(t.user == ticket.user for t in self._tickets) and not self._running[ticket.user]:
+                    self._user_finish.pop(ticket.user, None)
+                return True
+        return False
+
+    def _eligible(self) -> Ticket | None:
+        return min((t for t in self._tickets if self._running[t.user] < self.per_user), default=None)
+
+    async def get(self) -> Ticket:
+        while (ticket := self._eligible()) is None:
+            self._changed.clear()
+            await self._changed.wait()
+        self._tickets.remove(ticket)
+        self._running[ticket.user] += 1
+        if ticket.lane:
+            # Виртуальное время — окончание последней выданной задачи (приоритетная полоса его не двигает)
+            self._virtual = max(self._virtual, ticket.finish)
+        return ticket
+
+    def task_done(self, ticket: Ticket):
+        self._running[ticket.user] -= 1
+        if not self._running[ticket.user]:
+            del self._running[ticket.user]
+            # Простаивающий пользователь не копит «кредит»: следующая его задача стартует от V
+            if not any(t.user == ticket.user for t in self._tickets):
+                self._user_finish.pop(ticket.user, None)
+        self._changed.set()
@@ -0,0 +1,106 @@
+import logging
+import os
+import tempfile
+import zipfile
+from pathlib import Path, PurePosixPath
+from typing import Callable
+
+import image_prep
+import pdf_tools
+
+logger = logging.getLogger(__name__)
+
+# Ступени пережатия изображений EPUB: (качество JPEG, масштаб), каждая считается от исходника
+IMAGE_STEPS = ((75, 1.0), (60, 0.85), (45, 0.7), (35, 0.55))
+GS_PRESETS = ("/ebook", "/screen")
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+BATCH_SIZE = 64
+
+
+def shrink_epub_images(src: str, dst: str, quality: int, scale: float):
+    """Копирует EPUB, пережимая изображения пачками; имена и форматы файлов не меняются."""
+    with zipfile.ZipFile(src) as zin, zipfile.ZipFile(dst, "w", zipfile.ZIP_DEFLATED) as zout:
+        batch: list[zipfile.ZipInfo] = []
+
+        def flush():
+            shrunk = image_prep.shrink_images([zin.read(info) for info in batch], quality, scale)
+            for info, data in zip(batch, shrunk):
+                zout.writestr(info.filename, data, compress_type=zipfile.ZIP_STORED)
+            batch.clear()
+
+        for info in zin.infolist():
+            if PurePosixPath(info.filename).suffix.lower() in IMAGE_SUFFIXES:
+                batch.append(info)
+                if len(batch) >= BATCH_SIZE:
+                    flush()
+            else:
+                zout.writestr(info.filename, zin.read(info), compress_type=info.compress_type)
+        if batch:
+            flush()
+
+
+def _candidates(path: str, threads: int):
+    """Варианты артефакта по возрастанию потерь: (описание, функция src, dst; False — результата нет)."""
+    suffix = Path(path).suffix.lower()
+    if suffix == ".epub" and image_prep.available():
+        for quality, scale in IMAGE_STEPS:
+            yield (f"images q{quality} x{scale}",
+                   lambda src, dst, q=quality, s=scale: shrink_epub_images(src, dst, q, s))
+    elif suffix == ".pdf":
+        for preset in GS_PRESETS:
+            yield (f"gs {preset}",
+                   lambda src, dst, p=preset: pdf_tools.compress_pdf(
+                       src, dst, threads=threads, preset=p, min_size=0, min_page_bytes=0, min_saving=0))
+
+
+def fit_artifact(path: str, fits: Callable[[str], bool], threads: int = 1) -> bool:
+    """
+    Добивается, чтобы файл проходил проверку fits (например, размер письма не больше лимита):
+    пробует ступени пережатия от мягкой к жёсткой и подменяет файл первой подходящей.
+    :return: False, если файл не удалось уложить в лимит (исходник не меняется)
+    """
+    if fits(path):
+        return True
+    before = os.path.getsize(path)
+    for label, shrink in _candidates(path, threads):
+        fd, candidate = tempfile.mkstemp(suffix=Path(path).suffix, dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        try:
+            if shrink(path, candidate) is False:
+                continue
+            if fits(candidate):
+                os.replace(candidate, path)
+                logger.info(f"Shrunk {path} with {label}: {before} -> {os.path.getsize(path)} bytes")
+                return True
+            logger.info(f"{label} is not enough for {path}: {os.path.getsize(candidate)} bytes")
+        except Exception as e:
+            logger.warning(f"Shrinking {path} with {label} failed: {e}")
+        finally:
+            if os.path.exists(candidate):
+                os.unlink(candidate)
+    return False
+
+
+def split_volumes(image_files: list[str], max_bytes: int) -> list[list[str]]:
+    """
+    Делит страницы на тома так, чтобы изображения каждого тома весили не больше max_bytes.
+    Объём делится поровну, а не жадно, чтобы последний том не оказался из пары страниц.
+    """
+    sizes = [os.path.getsize(p) for p in image_files]
+    total = sum(sizes)
+    count = max(1, -(-total // max(max_bytes, 1)))
+    while True:
+        target = total / count
+        volumes, volume_sizes, current, current_size = [], [], [], 0
+        for path, size in zip(image_files, sizes):
+            if current and current_size + size > target * 1.05:
+                volumes.append(current)
+                volume_sizes.append(current_size)
+                current, current_size = [], 0
+            current.append(path)
+            current_size += size
+        volumes.append(current)
+        volume_sizes.append(current_size)
+        if max(volume_sizes) <= max_bytes or count >= len(image_files):
+            return volumes
+        count += 1
@@ -0,0 +1,191 @@
+import logging
+import queue
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from typing import Callable
+from streaming_mime import StreamingMessage
+
+logger = logging.getLogger(__name__)
+
+
+def is_transient(error: Exception) -> bool:
+    """Временные ошибки: обрыв соединения, таймаут или ответ сервера 4xx."""
+    if isinstance(error, (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return False
+
+
+class SmtpPool:
+    """
+    Пул авторизованных SMTP-соединений, которые переиспользуются между отправками.
+    :param size: максимальное число одновременно открытых соединений
+    :param max_idle: через сколько секунд простоя соединение проверяется NOOP перед отправкой
+    :param retries: число повторов при временных ошибках (4xx, обрыв соединения)
+    :param backoff: начальная задержка между повторами, удваивается с каждой попыткой
+    """
+
+    def __init__(self, host: str, port: int, login: str | None, password: str | None,
+                 size: int = 4, starttls: bool = True, timeout: float = 60,
+                 max_idle: float = 30, retries: int = 3, backoff: float = 1.0):
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.retries = retries
+        self.backoff = backoff
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                server.starttls()
+            if self.login:
+                server.login(self.login, self.password)
+        except Exception:
+            server.close()
+            raise
+        logger.info(f"Opened SMTP connection to {self.host}:{self.port}")
+        return server
+
+    def _acquire(self) -> smtplib.SMTP:
+        while True:
+            try:
+                server, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - last_used < self.max_idle:
+                return server
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._discard(server)
+
+    def _release(self, server: smtplib.SMTP):
+        self._idle.put((server, time.monotonic()))
+
+    @staticmethod
+    def _discard(server: smtplib.SMTP):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    @staticmethod
+    def _send_streaming(server: smtplib.SMTP, msg: StreamingMessage):
+        server.ehlo_or_helo_if_needed()
+        options = []
+        if server.does_esmtp and server.has_extn("size"):
+            options.append(f"SIZE={msg.encoded_size()}")
+        code, resp = server.mail(msg.sender, options)
+        if code != 250:
+            server.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, msg.sender)
+        code, resp = server.rcpt(msg.recipient)
+        if code not in (250, 251):
+            server.rset()
+            raise smtplib.SMTPRecipientsRefused({msg.recipient: (code, resp)})
+        code, resp = server.docmd("data")
+        if code != 354:
+            server.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        for chunk in msg.iter_bytes():
+            server.send(chunk)
+        server.send(b".\r\n")
+        code, resp = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+    def _deliver(self, msg: EmailMessage | StreamingMessage, server: smtplib.SMTP | None) -> tuple[smtplib.SMTP, int]:
+        """
+        Отправляет одно письмо с повторами при временных ошибках.
+        :param server: уже открытое соединение или None, чтобы взять его из пула
+        :return: живое соединение (его нужно вернуть в пул) и число повторов
+        """
+        attempt = 0
+        while True:
+            try:
+                if server is None:
+                    server = self._acquire()
+                if isinstance(msg, StreamingMessage):
+                    self._send_streaming(server, msg)
+                else:
+                    server.send_message(msg)
+                return server, attempt
+            except Exception as e:
+                if server is not None:
+                    self._discard(server)
+                    server = None
+                if attempt >= self.retries or not is_transient(e):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                logger.warning(f"Transient SMTP error, retry {attempt}/{self.retries} in {delay:.1f}s: {e}")
+                time.sleep(delay)
+
+    @staticmethod
+    def _recipient(msg: EmailMessage | StreamingMessage) -> str:
+        return msg.recipient if isinstance(msg, StreamingMessage) else msg["To"]
+
+    def send(self, msg: EmailMessage | StreamingMessage) -> float:
+        """
+        Отправляет письмо через пул. Блокирующий вызов, выполнять в пуле потоков.
+        :return: время отправки в секундах
+        """
+        started = time.monotonic()
+        with self._slots:
+            server, attempt = self._deliver(msg, None)
+            self._release(server)
+        latency = time.monotonic() - started
+        logger.info(f"SMTP send to {self._recipient(msg)} took {latency:.3f}s ({attempt} retries)")
+        return latency
+
+    def send_many(self, messages: list[EmailMessage | StreamingMessage],
+                  on_sent: Callable[[int], None] | None = None) -> list[Exception | None]:
+        """
+        Отправляет несколько писем подряд в одной SMTP-сессии, занимая один слот пула.
+        Ошибка одного письма не прерывает остальные.
+        :param on_sent: вызывается с номером письма сразу после его отправки (например, чтобы записать это в журнал)
+        :return: для каждого письма None при успехе или исключение
+        """
+        started = time.monotonic()
+        results: list[Exception | None] = []
+        with self._slots:
+            server = None
+            for i, msg in enumerate(messages):
+                try:
+                    server, _ = self._deliver(msg, server)
+                except Exception as e:
+                    # _deliver уже закрыл сломанное соединение, следующее письмо откроет новое
+                    server = None
+                    results.append(e)
+                    continue
+                results.append(None)
+                if on_sent:
+                    on_sent(i)
+            if server is not None:
+                self._release(server)
+        sent = sum(1 for error in results if error is None)
+        recipient = self._recipient(messages[0]) if messages else "-"
+        logger.info(f"SMTP batch to {recipient}: {sent}/{len(messages)} sent in {time.monotonic() - started:.3f}s")
+        return results
+
+    def close(self):
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(server)
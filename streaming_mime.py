@@ -0,0 +1,88 @@
+import base64
+import os
+import re
+import uuid
+from email import policy
+from email.message import EmailMessage, MIMEPart
+from typing import Iterator
+
+# 57 байт исходных данных дают ровно одну строку base64 длиной 76 символов
+LINE_BYTES = 57
+CHUNK_BYTES = LINE_BYTES * 4096
+
+
+def _quote_periods(data: bytes) -> bytes:
+    return re.sub(rb"(?m)^\.", b"..", data)
+
+
+def _part_headers(part: MIMEPart) -> bytes:
+    return b"".join(policy.SMTP.fold_binary(name, value) for name, value in part.items())
+
+
+def encoded_file_size(path: str) -> int:
+    """Размер файла после base64 с переносами CRLF каждые LINE_BYTES исходных байт."""
+    size = os.path.getsize(path)
+    lines = -(-size // LINE_BYTES)
+    return -(-size // 3) * 4 + lines * 2
+
+
+class StreamingMessage:
+    """
+    Письмо с вложениями, которые кодируются в base64 по частям прямо при отправке.
+    Файлы никогда не читаются в память целиком: пиковое потребление — один CHUNK_BYTES.
+    Дополнительные вложения добавляются через attach().
+    """
+
+    def __init__(self, sender: str, recipient: str, path: str, filename: str,
+                 subject: str = "", body: str = "Document for Kindle",
+                 maintype: str = "application", subtype: str = "octet-stream"):
+        self.sender = sender
+        self.recipient = recipient
+        self.path = path
+        self.maintype = maintype
+        self.subtype = subtype
+        self._boundary = f"=={uuid.uuid4().hex}=="
+
+        outer = EmailMessage(policy=policy.SMTP)
+        outer["Subject"] = subject
+        outer["From"] = sender
+        outer["To"] = recipient
+        outer["MIME-Version"] = "1.0"
+        outer["Content-Type"] = f'multipart/mixed; boundary="{self._boundary}"'
+
+        text = MIMEPart(policy=policy.SMTP)
+        text.set_content(body)
+
+        self._head = _quote_periods(
+            _part_headers(outer) + b"\r\n"
+            + f"--{self._boundary}\r\n".encode() + text.as_bytes(policy=policy.SMTP) + b"\r\n"
+        )
+        # (заголовки части, путь к файлу) для каждого вложения
+        self._attachments: list[tuple[bytes, str]] = []
+        # encodebytes() завершает каждую строку переводом, поэтому CRLF перед границей уже есть
+        self._tail = f"--{self._boundary}--\r\n".encode()
+        self.attach(path, filename)
+
+    def attach(self, path: str, filename: str):
+        attachment = MIMEPart(policy=policy.SMTP)
+        attachment.set_content(b"", maintype=self.maintype, subtype=self.subtype, filename=filename)
+        headers = _quote_periods(f"--{self._boundary}\r\n".encode() + _part_headers(attachment) + b"\r\n")
+        self._attachments.append((headers, path))
+
+    def encoded_size(self) -> int:
+        """Точный размер письма в байтах после кодирования, без чтения файлов."""
+        return (
+            len(self._head) + len(self._tail)
+            + sum(len(headers) + encoded_file_size(path) for headers, path in self._attachments)
+        )
+
+    def iter_bytes(self, chunk_size: int = CHUNK_BYTES) -> Iterator[bytes]:
+        """Готовые к передаче после команды DATA байты, с CRLF и экранированием точек."""
+        chunk_size -= chunk_size % LINE_BYTES
+        yield self._head
+        for headers, path in self._attachments:
+            yield headers
+            with open(path, "rb") as f:
+                while chunk := f.read(chunk_size):
+                    yield base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+        yield self._tail
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Миграции схемы по PRAGMA user_version; новые таблицы добавляются без перезаписи существующих
+MIGRATIONS = [
+    "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, email TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS user_settings ("
+    "user_id INTEGER NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (user_id, key))",
+    "CREATE TABLE IF NOT EXISTS deliveries ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, file_name TEXT NOT NULL, "
+    "size INTEGER, status TEXT NOT NULL, error TEXT, created_at REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS deliveries_user ON deliveries (user_id, created_at)",
+]
+
+_MISSING = object()
+
+
+class UserStore:
+    """
+    Хранилище пользователей на одном долгоживущем соединении SQLite в режиме WAL.
+    Все обращения к базе идут через один поток, email кэшируется в памяти:
+    повторный get_email() — просто поиск в словаре.
+    """
+
+    def __init__(self, db_path: str):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-store")
+        self._emails: dict[int, str | None] = {}
+        self._conn = self._executor.submit(self._open, db_path).result()
+
+    @staticmethod
+    def _open(db_path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, statement in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+            logger.info(f"Applied user store migration {number}")
+        conn.commit()
+        return conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # --- Email ---
+    def _load_email(self, user_id: int) -> str | None:
+        row = self._conn.execute("SELECT email FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def _save_email(self, user_id: int, email: str):
+        self._conn.execute("REPLACE INTO users (user_id, email) VALUES (?, ?)", (user_id, email))
+        self._conn.commit()
+
+    async def get_email(self, user_id: int) -> str | None:
+        email = self._emails.get(user_id, _MISSING)
+        if email is _MISSING:
+            email = self._emails[user_id] = await self._run(self._load_email, user_id)
+        return email
+
+    async def set_email(self, user_id: int, email: str):
+        self._emails.pop(user_id, None)
+        await self._run(self._save_email, user_id, email)
+        self._emails[user_id] = email
+
+    # --- Настройки пользователя ---
+    def _load_setting(self, user_id: int, key: str) -> str | None:
+        row = self._conn.execute(
+            "SELECT value FROM user_settings WHERE user_id = ? AND key = ?", (user_id, key)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _save_setting(self, user_id: int, key: str, value: str):
+        self._conn.execute(
+            "REPLACE INTO user_settings (user_id, key, value) VALUES (?, ?, ?)", (user_id, key, value)
+        )
+        self._conn.commit()
+
+    async def get_setting(self, user_id: int, key: str, default: str | None = None) -> str | None:
+        value = await self._run(self._load_setting, user_id, key)
+        return default if value is None else value
+
+    async def set_setting(self, user_id: int, key: str, value: str):
+        await self._run(self._save_setting, user_id, key, value)
+
+    # --- История доставок ---
+    def _insert_delivery(self, user_id: int, file_name: str, size: int | None, status: str, error: str | None):
+        self._conn.execute(
+            "INSERT INTO deliveries (user_id, file_name, size, status, error, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, file_name, size, status, error, time.time()),
+        )
+        self._conn.commit()
+
+    async def record_delivery(self, user_id: int, file_name: str, size: int | None,
+                              status: str = "sent", error: str | None = None):
+        await self._run(self._insert_delivery, user_id, file_name, size, status, error)
+
+    def _select_deliveries(self, user_id: int, limit: int) -> list[tuple]:
+        return self._conn.execute(
+            "SELECT file_name, size, status, error, created_at FROM deliveries "
+            "WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit),
+        ).fetchall()
+
+    async def recent_deliveries(self, user_id: int, limit: int = 10) -> list[tuple]:
+        return await self._run(self._select_deliveries, user_id, limit)
+
+    def close(self):
+        self._executor.submit(self._conn.close).result()
+        self._executor.shutdown()
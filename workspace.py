@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import time
+import uuid
+from collections import Counter
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+# Резерв под задачу относительно размера входного файла: сам файл, промежуточные файлы и результат
+RESERVE_FACTOR = 3
+MIN_RESERVE = 16 * 1024 * 1024
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def disk_usage(path: str) -> int:
+    """
+    Объём файлов в каталоге. Жёсткие ссылки на чужие файлы (например, файлы локального
+    Bot API сервера) не считаются: места они не занимают.
+    """
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        if st.st_nlink == 1:
+                            total += st.st_size
+        except FileNotFoundError:
+            continue
+    return total
+
+
+class Workspace:
+    """Каталог одной задачи: все её файлы лежат здесь и удаляются вместе с ним."""
+
+    def __init__(self, path: str, budget: int):
+        self.path = path
+        self.budget = budget
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+    def file(self, name: str) -> str:
+        """Путь к файлу в рабочем каталоге; имя (например, из названия книги) не может выйти за его пределы."""
+        name = Path(name).name
+        if name in ("", ".", ".."):
+            raise ValueError(f"Invalid file name: {name!r}")
+        return os.path.join(self.path, name)
+
+    def mkdir(self, name: str) -> str:
+        path = self.file(name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def subspace(self, name: str) -> "Workspace":
+        """Отдельный подкаталог со своим лимитом, например для файла пачки."""
+        return Workspace(self.mkdir(name), self.budget)
+
+    def usage(self) -> int:
+        return disk_usage(self.path)
+
+    def remaining(self) -> int:
+        return max(0, self.budget - self.usage())
+
+    def check(self):
+        """Бросает QuotaExceeded, если файлы задачи заняли больше бюджета."""
+        used = self.usage()
+        if used > self.budget:
+            raise QuotaExceeded(f"Job used {used / 1e6:.0f} MB of scratch space (limit {self.budget / 1e6:.0f} MB)")
+
+
+class WorkspaceManager:
+    """
+    Выдаёт каждой задаче свой каталог в root (можно на tmpfs) и удаляет его по завершении задачи.
+    Задача резервирует место заранее по размеру входного файла; пока резервы всех задач не помещаются
+    в total_budget, новая задача ждёт. Фоновая уборка удаляет каталоги, оставшиеся после падений:
+    каталоги умерших процессов этого хоста сразу, чужих и сохранённых для возобновления — через max_age секунд.
+    Имя каталога — <хост>-<pid>-<boot>-<случайная часть>, где boot создаётся при каждом запуске: в Docker
+    после перезапуска контейнера и имя хоста, и pid (1) те же. Процесс записывает свой boot в файл-метку
+    .<хост>-<pid>.boot; каталог живого pid с другим boot остался от прошлого запуска.
+    """
+
+    def __init__(self, root: str, job_budget: int, total_budget: int = 0,
+                 max_age: float = 24 * 3600, sweep_interval: float = 600):
+        self.root = Path(root)
+        self.job_budget = job_budget
+        # 0 — 90% свободного места в root на момент запуска
+        self.total_budget = total_budget
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self.host = socket.gethostname()
+        self.boot = ""
+        self.reserved = 0
+        # Резерв каждой активной задачи
+        self._active: dict[str, int] = {}
+        # Задачи, ждущие места под очередной файл (part), и число файлов в обработке
+        self._waiting: Counter = Counter()
+        self._parts = 0
+        # Каталоги прерванных задач, которые будут возобновлены
+        self._kept: set[str] = set()
+        self._room = asyncio.Condition()
+        self._sweeper: asyncio.Task | None = None
+
+    async def start(self, keep: set[str] = frozenset()):
+        """:param keep: каталоги незавершённых задач, которые нужно сохранить до их возобновления"""
+        self._kept = set(keep)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.boot = uuid.uuid4().hex[:8]
+        self._marker(self.host, os.getpid()).write_text(self.boot)
+        if not self.total_budget:
+            self.total_budget = int(shutil.disk_usage(self.root).free * 0.9)
+        removed = await asyncio.to_thread(self.sweep)
+        logger.info(
+            f"Workspaces in {self.root}: {self.job_budget / 1e6:.0f} MB per job, "
+            f"{self.total_budget / 1e6:.0f} MB total, removed {removed} leftovers"
+        )
+        self._sweeper = asyncio.create_task(self._sweep_forever(), name="workspace-sweeper")
+
+    async def stop(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        self._marker(self.host, os.getpid()).unlink(missing_ok=True)
+
+    def _marker(self, host: str, pid: int) -> Path:
+        return self.root / f".{host}-{pid}.boot"
+
+    @asynccontextmanager
+    async def job(self, input_size: int, files: int = 1, name: str | None = None,
+                  keep_on_cancel: bool = False) -> AsyncIterator[Workspace]:
+        """
+        Рабочий каталог задачи на время блока with.
+        :param input_size: суммарный размер входных файлов, по нему резервируется место
+        :param files: число файлов задачи (пачки); лимит задачи — job_budget на файл
+        :param name: каталог прерванной задачи, если он сохранился, — файлы в нём используются повторно
+        :param keep_on_cancel: не удалять каталог при отмене (остановке бота), чтобы продолжить задачу после запуска
+        """
+        budget = self.job_budget * files
+        reserve = self._reserve(input_size, budget)
+        async with self._room:
+            # Одна задача проходит всегда, даже если её резерв больше оставшегося места
+            await self._room.wait_for(lambda: not self._active or self.reserved + reserve <= self.total_budget)
+            self.reserved += reserve
+        if not (name and (self.root / name).is_dir()):
+            name = f"{self.host}-{os.getpid()}-{self.boot}-{uuid.uuid4().hex[:12]}"
+        self._kept.discard(name)
+        self._active[name] = reserve
+        path = self.root / name
+        keep = False
+        try:
+            path.mkdir(parents=True, exist_ok=True)
+            yield Workspace(str(path), budget)
+        except asyncio.CancelledError:
+            keep = keep_on_cancel
+            raise
+        finally:
+            if keep:
+                self._kept.add(name)
+            else:
+                await asyncio.to_thread(shutil.rmtree, path, True)
+            async with self._room:
+                self.reserved -= self._active.pop(name)
+                self._room.notify_all()
+
+    @asynccontextmanager
+    async def part(self, ws: Workspace, name: str, input_size: int) -> AsyncIterator[Workspace]:
+        """
+        Подкаталог файла пачки со своим резервом: место под файл резервируется, только когда до него
+        дошла очередь, а после обработки резерв уменьшается до занятого результатом, который ждёт отправки.
+        Поэтому пачка не занимает сразу всё место, сколько бы файлов в ней ни было.
+        """
+        reserve = self._reserve(input_size, self.job_budget)
+        async with self._room:
+            # Если ни один файл не обрабатывается, а места ждут все активные задачи, его никто не освободит
+            self._waiting[ws.name] += 1
+            try:
+                await self._room.wait_for(
+                    lambda: self.reserved + reserve <= self.total_budget
+                    or (not self._parts and len(self._waiting) >= len(self._active))
+                )
+            finally:
+                self._waiting[ws.name] -= 1
+                if not self._waiting[ws.name]:
+                    del self._waiting[ws.name]
+            self.reserved += reserve
+            self._active[ws.name] += reserve
+            self._parts += 1
+        sub = ws.subspace(name)
+        try:
+            yield sub
+        finally:
+            released = reserve - min(reserve, await asyncio.to_thread(sub.usage))
+            async with self._room:
+                self.reserved -= released
+                self._active[ws.name] -= released
+                self._parts -= 1
+                self._room.notify_all()
+
+    def _reserve(self, input_size: int, budget: int) -> int:
+        reserve = min(max(input_size * RESERVE_FACTOR, MIN_RESERVE), budget)
+        return min(reserve, self.total_budget) if self.total_budget else reserve
+
+    @staticmethod
+    def _pid_exists(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _alive(self, host: str, pid: int, boot: str) -> bool:
+        """Работает ли ещё запуск boot процесса pid этого хоста."""
+        if pid == os.getpid():
+            return boot == self.boot
+        if not self._pid_exists(pid):
+            return False
+        try:
+            return self._marker(host, pid).read_text() == boot
+        except FileNotFoundError:
+            return False
+
+    def _is_stale(self, name: str, mtime: float) -> bool:
+        if name in self._kept:
+            return time.time() - mtime > self.max_age
+        # Имя каталога: <хост>-<pid>-<boot>-<случайная часть>
+        parts = name.rsplit("-", 3)
+        if len(parts) == 4 and parts[0] == self.host and parts[1].isdigit():
+            # Каталог этого запуска, которого нет среди активных (rmtree по завершении не справился),
+            # или запуска, который уже завершился
+            if parts[2] == self.boot or not self._alive(parts[0], int(parts[1]), parts[2]):
+                return True
+        return time.time() - mtime > self.max_age
+
+    def sweep(self) -> int:
+        """Удаляет брошенные каталоги задач. Блокирующий вызов, выполнять в пуле потоков."""
+        removed = 0
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            if entry.name in self._active:
+                continue
+            if entry.name.startswith("."):
+                # Метка запуска: удаляется, когда её процесса уже нет
+                host, _, pid = entry.name[1:].removesuffix(".boot").rpartition("-")
+                if host == self.host and pid.isdigit() and int(pid) != os.getpid() and not self._pid_exists(int(pid)):
+                    Path(entry.path).unlink(missing_ok=True)
+                continue
+            try:
+                if not self._is_stale(entry.name, entry.stat(follow_symlinks=False).st_mtime):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning(f"Failed to remove leftover workspace {entry.path}: {e}")
+        if removed:
+            logger.info(f"Removed {removed} leftover workspaces from {self.root}")
+        return removed
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception:
+                logger.exception("Workspace sweep failed")